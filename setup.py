@@ -1,5 +1,10 @@
+import sys
 from distutils.core import setup
 
+modules = ["dam1021","dam1021_sim","dam1021_bench"]
+if sys.version_info >= (3,5):
+    modules.append("dam1021_aio")
+
 setup(
     name="dam1021",
     version="0.4",
@@ -8,7 +13,7 @@ setup(
     author="Forta(a)",
     author_email="fortaa@users.noreply.github.com",
     description="Python dam1021 interface",
-    install_requires=['pyserial','xmodem'],
-    py_modules=["dam1021"],
+    install_requires=['pyserial>=3.0','xmodem>=0.4'],
+    py_modules=modules,
     package_dir={'': 'src'},
 )
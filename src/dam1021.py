@@ -13,6 +13,11 @@ __status__ = "Beta"
 #you may change these values to meet your requirements
 DEFAULT_SERIAL_DEVICE="/dev/ttyAMA0"
 DEFAULT_SERIAL_TIMEOUT=2
+DEFAULT_HASH_CACHE="~/.dam1021_cache.json"
+DEFAULT_CATALOGUE_CACHE="~/.dam1021_filters.json"
+DEFAULT_IMAGE_LIBRARY="~/.dam1021_images.json"
+MAX_IMAGE_SIZE=16*1024*1024
+DEFAULT_DAEMON_SOCKET="~/.dam1021.sock"
 
 VOLUME_INF=-80
 VOLUME_SUP=10
@@ -22,11 +27,37 @@ INPUT_SRC_SET=range(4)
 FSET_EXT_STR_TO_INT_D = dict(linear=4,mixed=5,minimum=6,soft=7)
 FSET_EXT_NUM_TO_INT_D = {'1':4,'2':5,'3':6,'4':7 }
 
+#FIR filter type -> (bank, slot); other filter types are IIR filters
+FIR_SLOTS = { 4:(1,'FIR1'),5:(2,'FIR1'),6:(3,'FIR1'),7:(4,'FIR1'),8:(1,'FIR2'),9:(2,'FIR2'),10:(3,'FIR2'),11:(4,'FIR2') }
+
 OPMODES = ['normal','invert','bal-left','bal-right']
 
 import logging
-import StringIO
+import io
+import sys
+import os
+import json
+import glob
+import cmd
+import shlex
+import base64
+import socket
+import select
+import threading
+import heapq
+import re
+from functools import partial, wraps
+from bisect import bisect_left
+from collections import namedtuple, OrderedDict
 import hashlib
+import time
+
+try:
+    import Queue as queue
+    import SocketServer as socketserver
+except ImportError:
+    import queue
+    import socketserver
 
 #not included in std python library
 import serial
@@ -34,18 +65,535 @@ import xmodem
 
 log=logging.getLogger('dam1021')
 
+try:
+    _monotonic = time.monotonic
+except AttributeError:
+    _monotonic = time.time
+
+#how much trailing whitespace is examined by a stripped tail match
+_STRIP_SLACK = 16
+
+def _ascii(text):
+    """Returns text as bytes; a line carries bytes, commands and answers are built as text."""
+
+    return text if isinstance(text,(bytes,bytearray)) else text.encode('ascii')
+
+def _text(data):
+    """Returns data read from a line as a native string."""
+
+    return data if isinstance(data,str) else data.decode('ascii','replace')
+
+def _endswith(term,strip=False):
+    """Creates an exit condition matching a buffer that ends with a term. Only a tail of a buffer is examined."""
+
+    term = _ascii(term)
+    span = len(term) + (_STRIP_SLACK if strip else 0)
+    if strip:
+        return lambda buf: buf[-span:].rstrip().endswith(term)
+    return lambda buf: buf[-span:].endswith(term)
+
+def _contains(term):
+    """Creates a case insensitive exit condition looking for a (lowercase) term anywhere in a buffer. Data already scanned is not searched again."""
+
+    term = _ascii(term)
+    scanned = [0]
+    def condition(buf):
+        start = max(0,scanned[0]-len(term)+1)
+        scanned[0] = len(buf)
+        return buf[start:].lower().find(term) != -1
+    return condition
+
+def _then(condition,term):
+    """Creates an exit condition matching a buffer that ends with a term once another condition has been met, e.g. a prompt printed after an acknowledgement. Data may arrive split at any point over a network."""
+
+    met = [False]
+    tail = _endswith(term)
+    def wrapped(buf):
+        met[0] = met[0] or condition(buf)
+        return met[0] and tail(buf)
+    return wrapped
+
+def _remaining(stream):
+    """Returns a number of bytes left in a seekable stream or None if unknown."""
+
+    try:
+        pos = stream.tell()
+        stream.seek(0,2)
+        end = stream.tell()
+        stream.seek(pos)
+    except (AttributeError,IOError,OSError,ValueError):
+        return None
+    return end - pos
+
+def _stream_sha1(stream,chunk_size=65536):
+    """Returns SHA-1 of data left in a seekable stream without moving its position, None if a stream is not seekable."""
+
+    try:
+        pos = stream.tell()
+    except (AttributeError,IOError,OSError,ValueError):
+        return None
+    sha1 = hashlib.sha1()
+    for chunk in iter(lambda: stream.read(chunk_size),b''):
+        sha1.update(chunk)
+    stream.seek(pos)
+    return sha1.hexdigest()
+
+def expand_devices(patterns):
+    """Expands shell style wildcards (e.g. /dev/ttyUSB*) in a list of serial devices. Duplicates are dropped, an order is kept."""
+
+    devices = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for device in matches:
+            if device not in devices:
+                devices.append(device)
+    return devices
+
+def _guess_kind(name):
+    """Guesses a kind of an image from a file name; the .skr format does not tell."""
+
+    name = os.path.basename(name or '').lower()
+    if 'umanager' in name or 'firmware' in name:
+        return 'firmware'
+    if 'filter' in name:
+        return 'filters'
+    return 'unknown'
+
+def _inspect_stream(stream,name=None,chunk_size=65536):
+    """Inspects data left in a seekable stream without moving its position, see :func:`inspect_image`.
+
+    :returns: :class:`ImageInfo` or None if a stream is not seekable
+    """
+
+    try:
+        pos = stream.tell()
+    except (AttributeError,IOError,OSError,ValueError):
+        return None
+    if name is None:
+        name = getattr(stream,'name',None)
+    if not isinstance(name,(str,type(u''))):
+        name = None
+
+    sha1 = hashlib.sha1()
+    size = 0
+    head = b''
+    blank = True
+    for chunk in iter(lambda: stream.read(chunk_size),b''):
+        if not size:
+            head = chunk[:4096]
+        if blank and chunk.count(head[:1]) != len(chunk):
+            blank = False
+        sha1.update(chunk)
+        size += len(chunk)
+    stream.seek(pos)
+
+    problems = []
+    if not size:
+        problems.append("empty")
+    elif blank:
+        problems.append("blank (a single repeated byte)")
+    if size > MAX_IMAGE_SIZE:
+        problems.append("larger than {:d} bytes".format(MAX_IMAGE_SIZE))
+    for signature,description in FOREIGN_SIGNATURES:
+        if head.startswith(signature):
+            problems.append("looks like {}".format(description))
+    if len(head) >= 64 and not blank:
+        printable = sum(1 for c in bytearray(head) if 32 <= c < 127 or c in (9,10,13))
+        if printable > 0.95*len(head):
+            problems.append("looks like a text file (e.g. Intel HEX) rather than a binary image")
+
+    return ImageInfo(name and os.path.basename(name),sha1.hexdigest(),size,_guess_kind(name),problems)
+
+def inspect_image(data,name=None):
+    """Checks whether data may be a dam1021 image, without a device. The .skr format is not documented, so only sanity checks are done: an image must not be empty, blank, larger than MAX_IMAGE_SIZE, text or a known foreign file format. A kind (firmware, filters or unknown) is guessed from a file name only.
+
+    :param data: binary string or a seekable file-like object (its position is kept)
+    :param name: file name [default: a name of a file object]
+    :returns: :class:`ImageInfo`; problems is a list of issues found, empty if none
+    """
+
+    info = _inspect_stream(data if hasattr(data,'read') else io.BytesIO(data),name)
+    if info is None:
+        raise Dam1021Error(27,"Image can't be inspected without consuming it")
+    return info
+
+def _validate_image(stream,um_update):
+    """Rejects data that can't be an image before anything is sent to a device.
+
+    :returns: :class:`ImageInfo` or None if a stream is not seekable (nothing is checked then)
+    """
+
+    info = _inspect_stream(stream)
+    if info is None:
+        log.debug("Data not seekable, image checks skipped")
+        return None
+    if info.problems:
+        raise Dam1021Error(27,"Not a dam1021 image: {}".format('; '.join(info.problems)))
+    if um_update and info.kind == 'filters':
+        raise Dam1021Error(27,"A filter set can't update uManager")
+    return info
+
+def device_identity(device):
+    """Returns a stable name of a serial device: a matching /dev/serial/by-id link (USB adapters with a serial number) if there is one, a device name otherwise."""
+
+    byid = '/dev/serial/by-id'
+    try:
+        real = os.path.realpath(device)
+        for name in sorted(os.listdir(byid)):
+            path = os.path.join(byid,name)
+            if os.path.realpath(path) == real:
+                return path
+    except OSError:
+        pass
+    return device
+
+#errors of a port going away or a network peer closing a connection
+_PORT_ERRORS = (serial.SerialException,select.error,OSError,IOError)
+
+#operations that manage a link; they are not guarded by a link health check
+_LINK_OPERATIONS = ('probe','close','reconnect')
+
+def _measured(conn,name,func,args,kwargs):
+    metrics = conn.metrics
+    if metrics is None:
+        return func(conn,*args,**kwargs)
+    start = _monotonic()
+    error = None
+    try:
+        return func(conn,*args,**kwargs)
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        metrics.observe(name,_monotonic()-start,error)
+
+def _operation(func):
+    """Makes a connection method an operation: operations of a connection never overlap (see :attr:`Connection.lock`) and their durations are recorded in connection metrics, if there are any. An outermost operation is guarded by a link health check (see :meth:`Connection.check_link`)."""
+
+    name = func.__name__
+    @wraps(func)
+    def wrapper(self,*args,**kwargs):
+        with self.lock:
+            if self._nested:
+                return _measured(self,name,func,args,kwargs)
+            self._nested = True
+            try:
+                if name in _LINK_OPERATIONS:
+                    return _measured(self,name,func,args,kwargs)
+                return self._guarded(name,func,args,kwargs)
+            finally:
+                self._nested = False
+    return wrapper
+
+class _HashingReader(object):
+    """Wraps a stream and computes SHA-1 of data as they are read."""
+
+    def __init__(self,stream):
+        self.stream = stream
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+
+    def read(self,size):
+        data = self.stream.read(size)
+        self.sha1.update(data)
+        self.size += len(data)
+        return data
+
+class _EchoMatcher(object):
+    """Exit condition matching echoes of pipelined commands in order. An echo counts only as a whole line found after the previous one; each call scans only data past the last echo found.
+
+    A device answers in order, so once an echo of the last command shows up no other echo is coming; a condition is then met even if some echoes are missing (unless the last echo is ambiguous). matched is a number of commands confirmed in order.
+    """
+
+    def __init__(self,echoes):
+        self.patterns = [ re.compile(b'(?<![^\r\n])'+re.escape(echo.encode('ascii'))+b'(?=[\r\n])') for echo in echoes ]
+        self.matched = 0
+        self.pos = 0
+        self.last_unique = echoes.count(echoes[-1]) == 1 if echoes else False
+
+    def __call__(self,buf):
+        buf = bytes(buf)
+        while self.matched < len(self.patterns):
+            found = self.patterns[self.matched].search(buf,self.pos)
+            if found is None:
+                return self.last_unique and self.patterns[-1].search(buf,self.pos) is not None
+            self.pos = found.end()
+            self.matched += 1
+        return True
+
+class _LinkError(serial.SerialException):
+    """A transport failed: a port went away or a network peer closed a connection. Errors of anything else a command does (e.g. reading a file to download) are not link errors."""
+    pass
+
+def _link(func):
+    """Makes a transport method report failures of a port as :class:`_LinkError`."""
+
+    @wraps(func)
+    def wrapper(self,*args,**kwargs):
+        try:
+            return func(self,*args,**kwargs)
+        except _LinkError:
+            raise
+        except _PORT_ERRORS as e:
+            raise _LinkError(e)
+    return wrapper
+
+def _rewinder(name,args,kwargs):
+    """Returns a callable restoring what an operation has consumed, so it may run again, or None if it may not. Only a download consumes anything: its data stream; an interrupted uManager update is never repeated."""
+
+    if name != 'download':
+        return lambda: None
+    data = args[0] if args else kwargs.get('data')
+    if (args[1] if len(args) > 1 else kwargs.get('um_update')):
+        return None
+    if not hasattr(data,'read'):
+        #a string is wrapped in a new stream on every call
+        return lambda: None
+    try:
+        start = data.tell()
+    except (AttributeError,IOError,OSError,ValueError):
+        return None
+    return lambda: data.seek(start)
+
+class _BlockSizeRejected(Exception):
+    pass
+
+class _TransferCancelled(Exception):
+    """A receiver cancelled a transfer (two CAN characters in a row)."""
+    pass
+
+def _fset_lookup(fset,num_d,str_d):
+    """Resolves a filter set given by a number or a name.
+
+    :returns: tuple of a filter set type (as used by a direct command) and a name (as used by uManager)
+    """
+
+    try:
+        if isinstance(fset,int):
+            fset = str(fset)
+        if fset.isdigit():
+            ftype = num_d[fset]
+        else:
+            ftype = str_d[fset]
+    except KeyError:
+        raise Dam1021Error(11,"Forbbiden filter set")
+    return ftype, [ entry[0] for entry in str_d.items() if entry[1] == ftype ][0]
+
+PipelineResult = namedtuple('PipelineResult','setting value error')
+
+DownloadStats = namedtuple('DownloadStats','bytes blocks retransmits seconds rate attempts recovery')
+
+Filter = namedtuple('Filter','type kind bank slot description')
+
+FleetResult = namedtuple('FleetResult','device value error seconds')
+
+StatusEvent = namedtuple('StatusEvent','field old new time')
+
+ImageInfo = namedtuple('ImageInfo','name sha1 size kind problems')
+
+#leading bytes of files that are certainly not dam1021 images
+FOREIGN_SIGNATURES = ((b'PK\x03\x04','a ZIP archive'),(b'\x1f\x8b\x08','a gzip archive'),(b'\x7fELF','an ELF executable'),
+                      (b'%PDF','a PDF document'),(b'{\\rtf','an RTF document'))
+
 class Dam1021Error(Exception):
     """General exception class that covers all high level errors."""
 
     pass
 
 
+class Transport(object):
+    """A byte link to a device: a serial port, a pseudo-terminal or anything else pyserial opens by a URL (see :func:`open_transport`).
+
+    Failures of a port are raised as link errors (a subclass of serial.SerialException). Every read takes its own timeout. A port timeout is set once, when a link opens; a port which can be waited on (POSIX devices, sockets) is read without blocking and waited on with select, other ports (e.g. rfc2217://) block for poll_interval at most per read. Changing a timeout of an open pyserial port reconfigures it, which costs a system call on a serial device and a parameter negotiation over a network on rfc2217://.
+
+    :param device: serial device or pyserial URL
+    :param baudrate: line speed
+    """
+
+    #seconds a read of a port that can't be waited on blocks at most
+    poll_interval = 0.01
+    #upper bound of a probe timeout (see :meth:`Connection.probe_timeout`)
+    probe_max = 0.25
+
+    @_link
+    def __init__(self,device,baudrate=115200):
+        self.device = device
+        self.ser = serial.serial_for_url(device,baudrate,timeout=self.poll_interval)
+        try:
+            self.fd = self.ser.fileno() if os.name == 'posix' else None
+        except (AttributeError,IOError,OSError,ValueError):
+            self.fd = None
+        if self.fd is not None:
+            self.ser.timeout = 0
+        #state of a device kept between connections sharing a transport (see :class:`TransportPool`)
+        self.session = {}
+        self.configure()
+
+    def configure(self):
+        """Tunes an open link; called once by a constructor."""
+
+        pass
+
+    @property
+    def baudrate(self):
+        return self.ser.baudrate
+
+    @property
+    def in_waiting(self):
+        return self.ser.in_waiting
+
+    def _wait(self,timeout):
+        if self.fd is not None:
+            select.select([self.fd],[],[],timeout)
+
+    @_link
+    def read(self,size,timeout):
+        """Reads size bytes, fewer if a timeout expires first."""
+
+        buf = bytearray()
+        deadline = _monotonic() + timeout
+        while True:
+            buf.extend(self.ser.read(size-len(buf)))
+            if len(buf) >= size:
+                break
+            remaining = deadline - _monotonic()
+            if remaining <= 0:
+                break
+            self._wait(remaining)
+        return bytes(buf)
+
+    @_link
+    def read_available(self,timeout):
+        """Reads data already received, waiting up to timeout seconds for a first byte if there are none."""
+
+        deadline = _monotonic() + timeout
+        while True:
+            chunk = self.ser.read(self.ser.in_waiting or 1)
+            if chunk:
+                return chunk
+            remaining = deadline - _monotonic()
+            if remaining <= 0:
+                return chunk
+            self._wait(remaining)
+
+    @_link
+    def write(self,data):
+        return self.ser.write(_ascii(data))
+
+    @_link
+    def close(self):
+        self.ser.close()
+
+
+class NetworkTransport(Transport):
+    """A serial port exported by a terminal server (e.g. ser2net), as a raw TCP socket (socket://host:port) or by RFC 2217 (rfc2217://host:port).
+
+    Nagle's algorithm is disabled: commands are short and a response is awaited after each of them. A probe may wait longer, since a round trip includes a network.
+    """
+
+    probe_max = 1.0
+
+    def configure(self):
+        sock = getattr(self.ser,'_socket',None)
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+
+
+#pyserial URL scheme -> Transport subclass; other URLs and device names are opened by Transport
+TRANSPORTS = { 'socket':NetworkTransport,'rfc2217':NetworkTransport }
+
+def open_transport(device,baudrate=115200):
+    """Opens a :class:`Transport` of a class registered in :data:`TRANSPORTS` for a scheme of a device URL.
+
+    :param device: serial device (e.g. /dev/ttyUSB0) or pyserial URL (e.g. socket://host:port)
+    """
+
+    scheme = device.partition('://')[0] if '://' in device else None
+    return TRANSPORTS.get(scheme,Transport)(device,baudrate)
+
+
+class TransportPool(object):
+    """Keeps transports open between connections within a process, so a connection to a network serial port does not pay for a new TCP (or RFC 2217) handshake and a state of a device (e.g. whether uManager is open) carries over.
+
+    A transport is used by a single connection at a time; a connection to a device whose transport is in use waits for it.
+
+    :param wait: seconds to wait for a transport in use, None waits forever
+
+    Usage::
+
+    >>> pool = dam1021.TransportPool()
+    >>> for level in (-20,-30):
+    ...     conn = dam1021.Connection('socket://dac:7000',pool=pool)
+    ...     conn.set_current_volume_level(level)
+    ...     conn.close()
+    >>> pool.close()
+    """
+
+    def __init__(self,wait=None):
+        self.wait = wait
+        self.idle = {}
+        self.busy = set()
+        self._cond = threading.Condition()
+
+    def acquire(self,device):
+        """Returns an idle transport to a device or opens a new one."""
+
+        deadline = None if self.wait is None else _monotonic() + self.wait
+        with self._cond:
+            while device in self.busy:
+                remaining = None if deadline is None else deadline - _monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise Dam1021Error(25,"{} is in use".format(device))
+                self._cond.wait(remaining)
+            self.busy.add(device)
+            transport = self.idle.pop(device,None)
+        if transport is not None:
+            log.debug("Pooled transport reused")
+            return transport
+        try:
+            return open_transport(device)
+        except BaseException:
+            with self._cond:
+                self.busy.discard(device)
+                self._cond.notify_all()
+            raise
+
+    def release(self,transport,discard=False):
+        """Returns a transport to a pool.
+
+        :param discard: close a transport instead, e.g. after a failure
+        """
+
+        with self._cond:
+            self.busy.discard(transport.device)
+            if not discard:
+                self.idle[transport.device] = transport
+            self._cond.notify_all()
+        if discard:
+            transport.close()
+
+    def close(self):
+        """Closes idle transports."""
+
+        with self._cond:
+            idle, self.idle = list(self.idle.values()), {}
+        for transport in idle:
+            transport.close()
+
+
 class Connection(object):
     """Creates object for serial communication with a DAC.
     
-    :param device: serial device to use
+    :param device: serial device to use, or a pyserial URL such as socket://host:port or rfc2217://host:port (see :func:`open_transport`)
     :param timeout: default timeout for serial communication
     :param cautious: additional safeguards for non umanager command
+    :param hash_cache: :class:`HashCache` used to skip downloads of an image already programmed
+    :param shadow: remember confirmed settings and skip commands that would not change them
+    :param catalogue_cache: :class:`CatalogueCache` keeping filter listings across connections
+    :param metrics: :class:`Metrics` collecting timings and counters; None disables instrumentation
+    :param pool: :class:`TransportPool` to take a transport from and return it to on :meth:`close`
+    :param auto_reconnect: reopen a link lost to a device reset or a USB adapter re-enumeration and run a failed command again (see :meth:`reconnect`)
+    :param reapply: send remembered runtime settings (see shadow) again after a link is restored
     
     Usage::
    
@@ -57,9 +605,23 @@ class Connection(object):
     >>> conn.set_input_source(0)
     """
 
-    def __init__(self,device=DEFAULT_SERIAL_DEVICE,timeout=DEFAULT_SERIAL_TIMEOUT,cautious = False):
+    def __init__(self,device=DEFAULT_SERIAL_DEVICE,timeout=DEFAULT_SERIAL_TIMEOUT,cautious = False,hash_cache=None,shadow=False,catalogue_cache=None,metrics=None,pool=None,auto_reconnect=False,reapply=False):
         self.cautious = cautious
         self.timeout  = timeout
+        self.device = device
+        self.device_id = device_identity(device)
+        self.hash_cache = hash_cache
+        self.shadow = {} if shadow else None
+        self.catalogue_cache = catalogue_cache
+        self.catalogues = {}
+        self.metrics = metrics
+        self.pool = pool
+        self.auto_reconnect = auto_reconnect
+        self.reapply = reapply
+        #held by an operation; lets other threads (e.g. a Monitor) share a connection
+        self.lock = threading.RLock()
+        self.last_activity = None
+        self.image_sha = hash_cache.get(self.device_id) if hash_cache is not None else None
 
         #cmdlist
         self.cmd_umanager_invocation = '+++'
@@ -77,13 +639,23 @@ class Connection(object):
     
         #internal stuff
         self.cr = '\r'
-        self.umanager_prompt = '# '
-        self.umanager_errtxt = 'invalid command'
-        self.umanager_opened = False
-        self.buf_on_exit = '\r\n'
-        self.read_loop_timeout = 0.25
+        self.umanager_prompt = b'# '
+        self.umanager_errtxt = b'invalid command'
+        #True, False or None if a state of a device is not known (a new connection, a failure)
+        self.umanager_opened = None
+        self.umanager_holds = 0
+        self.buf_on_exit = b'\r\n'
         self.readsize = 300
+        #uManager responses (a prompt after +++, an update) are awaited timeout*umanager_waitcoeff at most, see open_umanager
         self.umanager_waitcoeff = 1.5
+        #a probe waits probe_latency_coeff times a measured round trip, within [probe_min,probe_max]
+        self.probe_min = 0.02
+        self.probe_max = 0.25
+        self.probe_latency_coeff = 4
+        self.probe_sample_size = 32
+        self.probe_settle = 0.02
+        self.latency = None
+        self._sent_at = None
         self.volume_inf = VOLUME_INF
         self.volume_sup = VOLUME_SUP
         self.volume_pot = VOLUME_POT
@@ -91,45 +663,117 @@ class Connection(object):
         self.fset_num_d = FSET_EXT_NUM_TO_INT_D
         self.opmodes = OPMODES
         self.input_src_set = INPUT_SRC_SET
-        self.xmodem_crc = 'C'
-        self.reprogram_ack = 'programmed'
-        self.update_confirmation = 'umanager firmware update, are you sure ? '
+        self.xmodem_crc = b'C'
+        self.xmodem_block_size = 128
+        #errors tolerated per block, seconds to wait for an acknowledgement
+        self.xmodem_retry = 16
+        self.xmodem_timeout = 60
+        #monotonic time after which a transfer is abandoned and not repeated, None for no limit
+        self.deadline = None
+        #whole transfers repeated after a failure, base of an exponential backoff in seconds
+        self.download_retries = 2
+        self.download_backoff = 0.5
+        self.resync_tries = 3
+        #seconds a device may take to boot after an update
+        self.boot_timeout = 10.0
+        #exchanges a device has not answered since it last did (a reset counts too)
+        self.failures = 0
+        #probes telling a dead link from a failed command, reopen attempts and their exponential backoff in seconds
+        self.health_probes = 3
+        self.reconnect_tries = 15
+        self.reconnect_backoff = 0.1
+        self.reconnect_backoff_max = 1.0
+        self.recovery_time = None
+        self._nested = False
+        self.download_stats = None
+        self.reprogram_ack = b'programmed'
+        self.update_confirmation = b'umanager firmware update, are you sure ? '
         self.update_ack = 'y'
-        self.update_reset = 'updated, reset'
+        self.update_reset = b'updated, reset'
 
-        def putc_generator(ser):
+        #the transport is looked up on every call, a link may be reopened
+        def putc_generator():
             def putc(data,timeout=1):
-                instance_timeout = ser.timeout
-                ser.timeout = timeout
-                rv = ser.write(data)
-                ser.timeout = instance_timeout
+                rv = self.transport.write(data)
+                if self.metrics is not None:
+                    self.metrics.count('bytes_written',len(data))
                 return rv if rv else None
             return putc
     
-        def getc_generator(ser):
+        def getc_generator():
             def getc(size,timeout=1):
-                instance_timeout = ser.timeout
-                ser.timeout = timeout
-                rv = ser.read(size)
-                ser.timeout = instance_timeout
+                if self.deadline is not None:
+                    timeout = min(timeout,self.deadline-_monotonic())
+                    if timeout <= 0:
+                        raise _TransferCancelled()
+                if self._xmodem_unread:
+                    #already counted by read_loop
+                    rv, self._xmodem_unread = self._xmodem_unread[:size], self._xmodem_unread[size:]
+                    return rv
+                rv = self.transport.read(size,timeout)
+                if self.metrics is not None:
+                    self.metrics.count('bytes_read',len(rv))
+                    if not rv:
+                        self.metrics.count('timeouts')
+                #the xmodem module treats a cancellation during a transfer as a line error
+                if rv == self._xmodem_reply == b'\x18':
+                    self._xmodem_reply = None
+                    raise _TransferCancelled()
+                self._xmodem_reply = rv
                 return rv if rv else None
             return getc
 
-        self.ser = serial.Serial(device,115200,timeout=0.25)
-        self.xmodem = xmodem.XMODEM(getc_generator(self.ser),putc_generator(self.ser))
+        #last character a device sent during a transfer, data read before a transfer that belong to it
+        self._xmodem_reply = None
+        self._xmodem_unread = b''
+        self._open_transport()
+        #a pooled transport remembers what a previous connection knew about a device
+        self.umanager_opened = self.transport.session.get('umanager_opened')
+        self.latency = self.transport.session.get('latency')
+        self.xmodem = xmodem.XMODEM(getc_generator(),putc_generator())
+        self.xmodem_1k = xmodem.XMODEM(getc_generator(),putc_generator(),mode='xmodem1k')
 
         log.debug("Serial port opened")
 
     def read_loop(self,exit_condition,timeout,callback=None):
-        buf = ''
-        rv  = False 
-        while timeout > 0:
-            buf += self.ser.read(self.readsize)
-            if exit_condition(buf):
-                rv = True
+        """Reads from a serial device until an exit condition is met or a timeout expires. A condition is checked as soon as new data arrive.
+
+        :param exit_condition: callable accepting a buffer (bytearray) read so far
+        :param timeout: timeout in seconds
+        :param callback: callable invoked with a result, a buffer (string) and a condition
+        """
+
+        buf = bytearray()
+        rv  = False
+        deadline = _monotonic() + timeout
+        while True:
+            chunk = self.transport.read_available(deadline-_monotonic())
+            if chunk:
+                buf.extend(chunk)
+                if exit_condition(buf):
+                    rv = True
+                    break
+            if _monotonic() >= deadline:
                 break
-            else:
-                timeout -= self.read_loop_timeout
+
+        if rv:
+            self.failures = 0
+        else:
+            self.failures += 1
+
+        if rv and self._sent_at is not None:
+            #round trips of short exchanges only, long responses take longer to transmit
+            if len(buf) <= self.probe_sample_size:
+                sample = _monotonic() - self._sent_at
+                self.latency = sample if self.latency is None else 0.8*self.latency + 0.2*sample
+            self._sent_at = None
+
+        buf = bytes(buf)
+
+        if self.metrics is not None:
+            self.metrics.count('bytes_read',len(buf))
+            if not rv:
+                self.metrics.count('timeouts')
 
         if hasattr(callback,'__call__'):
             callback(rv,buf,exit_condition)
@@ -138,99 +782,581 @@ class Connection(object):
 
         return rv
 
+    def _write(self,data):
+        if self.metrics is not None:
+            self.metrics.count('bytes_written',len(data))
+        self.last_activity = self._sent_at = _monotonic()
+        return self.transport.write(data)
+
+    def probe_timeout(self):
+        """Returns how long a probe waits for an answer: a few measured round trips, probe_max until a round trip is measured."""
+
+        if self.latency is None:
+            return self.probe_max
+        return max(self.probe_min,min(self.probe_max,self.latency*self.probe_latency_coeff))
+
+    @_operation
+    def probe(self):
+        """Used to find out whether a device is in uManager, takes direct commands or does not answer. A single carriage return is sent: uManager answers with a fresh prompt, a direct command parser with a bare line end. Once an answer starts to arrive, a probe waits probe_settle seconds at most for its rest.
+
+        :returns: 'umanager', 'direct' or 'unresponsive'
+        """
+
+        buf = bytearray()
+        prompt = self.umanager_prompt
+        self._write(self.cr)
+        sent_at = self._sent_at
+        self._sent_at = None
+        deadline = sent_at + self.probe_timeout()
+        while not buf.endswith(prompt):
+            remaining = deadline - _monotonic()
+            if remaining <= 0:
+                break
+            chunk = self.transport.read_available(remaining)
+            if not chunk:
+                break
+            if not buf:
+                sample = _monotonic() - sent_at
+                self.latency = sample if self.latency is None else 0.8*self.latency + 0.2*sample
+                deadline = min(deadline,_monotonic()+self.probe_settle)
+            buf.extend(chunk)
+
+        if self.metrics is not None:
+            self.metrics.count('bytes_read',len(buf))
+
+        if buf.endswith(prompt):
+            state = 'umanager'
+        elif buf:
+            state = 'direct'
+        else:
+            state = 'unresponsive'
+        self.failures = self.failures + 1 if state == 'unresponsive' else 0
+        log.debug("Device state: {} ({!r})".format(state,bytes(buf)))
+
+        return state
+
+    def _umanager_command(self,cmd):
+        """Sends a command to uManager and waits for a fresh prompt. A command is considered accepted unless an error message shows up.
+
+        :param cmd: command to send
+        :returns: False if uManager rejected a command
+        """
+
+        rbuf = []
+        self._write(''.join((cmd,self.cr)))
+        self.read_loop(_endswith(self.umanager_prompt),self.timeout,lambda x,y,z: rbuf.append(y))
+        return rbuf[0].lower().find(self.umanager_errtxt) == -1
+
+    @_operation
     def close(self):
-        """Closes serial port
+        """Closes serial port, or returns it to a pool a connection took it from.
       
         """
 
-        self.close_umanager()
-        self.ser.close()
+        if self.transport is None:
+            return
+        try:
+            self.close_umanager()
+        except _LinkError as e:
+            #there is no session left to close over a dead link
+            log.debug(e)
+            self._drop_transport()
+            return
+        except Exception:
+            self._drop_transport()
+            raise
+        if self.pool is not None:
+            self.transport.session.update(umanager_opened=self.umanager_opened,latency=self.latency)
+            self.pool.release(self.transport)
+            self.transport = None
+        else:
+            self._drop_transport()
         log.debug("Serial port closed")
 
+    #link health
+
+    def _open_transport(self):
+        self.transport = self.pool.acquire(self.device) if self.pool is not None else open_transport(self.device)
+        self.probe_max = self.transport.probe_max
+
+    def _drop_transport(self):
+        transport, self.transport = self.transport, None
+        if transport is None:
+            return
+        try:
+            if self.pool is not None:
+                self.pool.release(transport,discard=True)
+            else:
+                transport.close()
+        except _LinkError as e:
+            log.debug(e)
+
+    def _answers(self):
+        """Probes a device up to health_probes times.
+
+        :returns: a device state, 'unresponsive' if a link is dead
+        """
+
+        state = 'unresponsive'
+        for _ in range(self.health_probes):
+            try:
+                state = self.probe()
+            except _LinkError as e:
+                log.debug(e)
+                return 'unresponsive'
+            if state != 'unresponsive':
+                break
+        return state
+
+    def check_link(self):
+        """Tells a dead link from a failed command with a few fast probes (a single carriage return each, see :meth:`probe`), so a lost device fails a command at once instead of after every timeout of it. A lost link is reopened if auto_reconnect is set.
+
+        Run before an operation when a device has not answered since the last exchange.
+
+        :returns: a device state (umanager or direct)
+        """
+
+        with self.lock:
+            state = 'unresponsive' if self.transport is None else self._answers()
+            if state != 'unresponsive':
+                self.umanager_opened = state == 'umanager'
+                return state
+            if not self.auto_reconnect:
+                raise Dam1021Error(31,"Device not responding")
+            return self.reconnect()
+
+    @_operation
+    def reconnect(self):
+        """Reopens a link after a device has been lost, e.g. reset or re-enumerated by USB (a stable name such as /dev/serial/by-id/... helps then). Attempts are repeated with an exponential backoff until a device answers a probe.
+
+        A session state is restored: uManager state comes from a probe, and since a device may have been power cycled, runtime settings remembered by a shadow are sent again if reapply is set (see :meth:`refresh`) and forgotten otherwise. Time to recover is kept in recovery_time and recorded as a reconnect operation in metrics.
+
+        :returns: a device state (umanager or direct)
+        """
+
+        start = _monotonic()
+        self._drop_transport()
+        delay = self.reconnect_backoff
+        state = 'unresponsive'
+        for attempt in range(self.reconnect_tries):
+            if attempt:
+                time.sleep(delay)
+                delay = min(delay*2,self.reconnect_backoff_max)
+            try:
+                self._open_transport()
+            except _LinkError as e:
+                log.debug("Reconnect attempt {:d} failed: {}".format(attempt+1,e))
+                continue
+            self.latency = None
+            state = self._answers()
+            if state != 'unresponsive':
+                break
+            self._drop_transport()
+        else:
+            self.umanager_opened = None
+            raise Dam1021Error(31,"Device lost, {:d} reconnect attempts failed".format(self.reconnect_tries))
+
+        self.umanager_opened = state == 'umanager'
+        self.failures = 0
+        if self.reapply:
+            self.refresh()
+        else:
+            self.invalidate('volume','input','fset')
+        self.recovery_time = _monotonic() - start
+        if self.metrics is not None:
+            self.metrics.count('reconnects')
+        log.info("Link restored in {:.3f} s".format(self.recovery_time))
+        return state
+
+    def _guarded(self,name,func,args,kwargs):
+        """Runs an operation over a healthy link; a failure that turns out to be a lost link is followed by a reconnect and a single retry. A download is retried only if its data can be rewound (see :func:`_rewinder`), an uManager update never."""
+
+        if self.failures or self.transport is None:
+            self.check_link()
+        rewind = _rewinder(name,args,kwargs)
+        try:
+            return _measured(self,name,func,args,kwargs)
+        except _LinkError as e:
+            if not self.auto_reconnect:
+                raise
+            log.warning("Link failed: {}".format(e))
+            error = e
+        except Dam1021Error as e:
+            #a device that still answers just failed a command
+            if not (self.auto_reconnect and self.failures) or self._answers() != 'unresponsive':
+                raise
+            error = e
+        self.reconnect()
+        if rewind is None:
+            raise error
+        rewind()
+        return _measured(self,name,func,args,kwargs)
+
+    @_operation
     def open_umanager(self):
         """Used to open an uManager session.
-        
+
+        A wait for a prompt after +++ ends as soon as the prompt arrives, so its bound (timeout*umanager_waitcoeff) costs time only when a device does not answer. The bound is deliberately not derived from a measured latency: the latency is a round trip of short direct commands, while entering uManager takes a device time of its own which is not measured, and a prompt missed by a shorter wait would be read by a following probe only after a probe timeout.
         """
 
         if self.umanager_opened:
             return
-        self.ser.write(self.cmd_umanager_invocation)
-        # optimistic approach first: assume umanager is not invoked
-        if self.read_loop(lambda x: x.endswith(self.umanager_prompt),self.timeout*self.umanager_waitcoeff):
+        # a state we have not seen is probed first; a probe in uManager gives us a fresh prompt
+        state = 'direct' if self.umanager_opened is False else self.probe()
+        if state == 'umanager':
             self.umanager_opened = True
         else:
-            #if we are already in umanager, this will give us a fresh prompt
-            self.ser.write(self.cr)
-            if self.read_loop(lambda x: x.endswith(self.umanager_prompt),self.timeout):
+            self._write(self.cmd_umanager_invocation)
+            if self.read_loop(_endswith(self.umanager_prompt),self.timeout*self.umanager_waitcoeff):
+                self.umanager_opened = True
+            elif self.probe() == 'umanager':
+                # a device was not where we thought it was
                 self.umanager_opened = True
         
         if self.umanager_opened:
             log.debug("uManager opened")
+            if self.metrics is not None:
+                self.metrics.count('sessions_opened')
         else:
+            self.umanager_opened = None
             raise Dam1021Error(1,"Failed to open uManager")
 
+    @_operation
     def close_umanager(self, force=False):
         """Used to close an uManager session.
         
         :param force: try to close a session regardless of a connection object internal state
         """
       
-        if not (force or self.umanager_opened):
+        if not force and self.umanager_opened is False:
             return
-        # make sure we've got a fresh prompt
-        self.ser.write(self.cr)
-        if self.read_loop(lambda x: x.endswith(self.umanager_prompt),self.timeout):
-            self.ser.write(''.join((self.cmd_umanager_termination,self.cr)))
-            if self.read_loop(lambda x: x.endswith(self.buf_on_exit),self.timeout):
+        # make sure we've got a fresh prompt; a state we are not sure about is probed
+        if self.umanager_opened:
+            self._write(self.cr)
+            fresh = self.read_loop(_endswith(self.umanager_prompt),self.timeout)
+        else:
+            fresh = self.probe() == 'umanager'
+        if fresh:
+            self._write(''.join((self.cmd_umanager_termination,self.cr)))
+            if self.read_loop(_endswith(self.buf_on_exit),self.timeout):
                 log.debug("uManager closed")
             else:
+                self.umanager_opened = None
                 raise Dam1021Error(2,"Failed to close uManager")
         else:
             log.debug("uManager already closed")
             
+        if self.umanager_opened and self.metrics is not None:
+            self.metrics.count('sessions_closed')
         self.umanager_opened = False
 
-    def download(self,data,um_update=False):
-        """Used to download firmware or filter set.
-        
-        :param data: binary string to push via serial 
-        :param um_update: flag whether to update umanager
+    def _unchanged(self,key,value):
+        """Checks whether a setting is known to have a value already."""
+
+        return self.shadow is not None and key in self.shadow and self.shadow[key] == value
+
+    def _confirm(self,key,value):
+        if self.shadow is not None:
+            self.shadow[key] = value
+
+    def invalidate(self,*keys):
+        """Forgets remembered settings, so the next command changing them goes to a device.
+
+        :param keys: settings to forget (volume, input, fset, mode, flash_volume, flash_fset); all if omitted
         """
-        
-        self.open_umanager()
-        self.ser.write(''.join((self.cmd_download,self.cr)))
-        if self.read_loop(lambda x: x.endswith(self.xmodem_crc),self.timeout):
-            if self.xmodem.send(StringIO.StringIO(data)):
-                log.info("Data sent")
-            else:
-                raise Dam1021Error(4,"Error during file download")
-        else:
-            raise Dam1021Error(3,"uManager is not ready to accept a data")
-      
-        if self.read_loop(lambda x: x.lower().find(self.reprogram_ack) != -1,self.timeout):
-            skr_sum = hashlib.sha1(data).hexdigest()
-            log.info("File downloaded. Data SHA-1 checksum: {}".format(skr_sum))
+
+        if self.shadow is None:
+            return
+        if keys:
+            for key in keys:
+                self.shadow.pop(key,None)
         else:
-            raise Dam1021Error(5,"uManager accepted data and not reprogrammed")
+            self.shadow.clear()
+
+    @_operation
+    def refresh(self):
+        """Sends remembered runtime settings (volume, input, filter set) to a device again, e.g. after it has been power cycled."""
+
+        if self.shadow is None:
+            return
+        state = dict(self.shadow)
+        self.invalidate('volume','input','fset')
+        if 'input' in state:
+            self.set_input_source(state['input'])
+        if 'fset' in state:
+            self.set_current_filter_set([ key for key,value in self.fset_num_d.items() if value == state['fset'] ][0])
+        if 'volume' in state:
+            self.set_current_volume_level(state['volume'])
+
+    def _release_umanager(self):
+        """Closes an uManager session unless it is held open by a batch."""
+
+        if not self.umanager_holds:
+            self.close_umanager()
+
+    def _leave_umanager(self):
+        """Makes sure an uManager session is not active before a direct command is sent."""
+
+        if self.cautious:
+            self.close_umanager(True)
+        elif self.umanager_opened is not False:
+            self.close_umanager()
+
+    def session(self,stop_on_error=False):
+        """Creates a batch of uManager commands executed within a single uManager session.
+
+        :param stop_on_error: skip remaining commands after the first failure
+
+        Usage::
+
+        >>> with conn.session() as batch:
+        ...     batch.set_mode('normal')
+        ...     batch.set_flash_filter_set('mixed')
+        ...     batch.set_flash_volume_level(-20)
+        ...     batch.list_all_filters()
+        >>> for result in batch.results:
+        ...     print(result.command, result.value, result.error)
+        """
+
+        return Batch(self,stop_on_error)
+
+    def _xmodem_send(self,stream,block_size,progress=None):
+        """Sends a stream via XMODEM. Data are hashed while they are read.
+
+        :returns: tuple of a :class:`_HashingReader` and :class:`DownloadStats`, None if a transfer failed
+        """
+
+        reader = _HashingReader(stream)
+        total = _remaining(stream)
+        modem = self.xmodem_1k if block_size == 1024 else self.xmodem
+        counters = dict(acked=0,retransmits=0)
+
+        def callback(total_packets,success_count,error_count):
+            if success_count > counters['acked']:
+                counters['acked'] = success_count
+                if hasattr(progress,'__call__'):
+                    progress(min(success_count*block_size,reader.size),total,counters['retransmits'])
+            else:
+                counters['retransmits'] += 1
+                #a device answering the very first 1K block with NAK or CAN doesn't take 1K blocks, a timeout or line noise is retried as usual
+                if block_size == 1024 and not success_count and self._xmodem_reply in (xmodem.NAK,xmodem.CAN):
+                    raise _BlockSizeRejected()
+
+        self._xmodem_reply = None
+        started = _monotonic()
+        try:
+            if not modem.send(reader,retry=self.xmodem_retry,timeout=self.xmodem_timeout,callback=callback):
+                return None
+        except _TransferCancelled:
+            log.debug("Transfer cancelled")
+            return None
+        elapsed = _monotonic() - started
+
+        if self.metrics is not None:
+            self.metrics.count('retransmits',counters['retransmits'])
+
+        return reader, DownloadStats(reader.size,counters['acked'],counters['retransmits'],elapsed,reader.size/elapsed if elapsed else 0.0,1,0.0)
+
+    @_operation
+    def download(self,data,um_update=False,block_size=None,progress=None,force=False,check=True,retries=None):
+        """Used to download firmware or filter set. Data are streamed, so a file is never loaded into memory as a whole.
+
+        Data that can't be an image (see :func:`inspect_image`) are rejected before a transfer starts. If a connection has a hash cache and data match an image last programmed into a device, a transfer is skipped.
+
+        A block is sent again up to xmodem_retry times. A failed transfer is cancelled, an uManager prompt is brought back and a transfer starts over (seekable data only) after a growing pause (download_backoff doubled on each attempt).
+
+        :param data: binary string or a file-like object (e.g. a file opened in binary mode or a mmap) to push via serial
+        :param um_update: flag whether to update umanager; a download returns once a restarted device answers (boot_timeout at most)
+        :param block_size: XMODEM block size, 128 or 1024 [default: xmodem_block_size]; 1024 falls back to 128 if a device rejects the first block
+        :param progress: callable invoked after each block with a number of bytes sent, a total number of bytes (None if unknown) and a number of retransmissions
+        :param force: download even if a hash cache says data are already programmed
+        :param check: reject data that can't be an image
+        :param retries: how many times a failed transfer is repeated [default: download_retries]
+        :returns: data SHA-1 checksum; transfer statistics, including attempts made and seconds lost to recovery, are kept as :class:`DownloadStats` in download_stats (None if skipped)
+        """
+
+        stream = data if hasattr(data,'read') else io.BytesIO(data)
+        cache = self.hash_cache
+        info = _validate_image(stream,um_update) if check else None
+
+        if cache is not None and not (force or um_update):
+            skr_sum = info.sha1 if info is not None else _stream_sha1(stream)
+            if skr_sum is not None and skr_sum == cache.get(self.device_id):
+                log.info("Data already programmed, download skipped. Data SHA-1 checksum: {}".format(skr_sum))
+                self.download_stats = None
+                self._image_changed(skr_sum)
+                return skr_sum
+
+        try:
+            skr_sum = self._download(stream,um_update,block_size,progress,self.download_retries if retries is None else retries)
+        except BaseException:
+            self._image_changed(None)
+            if cache is not None:
+                cache.invalidate(self.device_id)
+            raise
+
+        self._image_changed(None if um_update else skr_sum)
+        if cache is not None:
+            if um_update:
+                cache.invalidate(self.device_id)
+            else:
+                cache.set(self.device_id,skr_sum)
+
+        return skr_sum
+
+    def _image_changed(self,skr_sum):
+        """Records an image programmed into a device; cached filter listings of a different (or unknown) image are dropped."""
+
+        if skr_sum is None or skr_sum != self.image_sha:
+            self.catalogues.clear()
+        self.image_sha = skr_sum
+
+    def _download(self,stream,um_update,block_size,progress,retries):
+        block_size = block_size or self.xmodem_block_size
+        try:
+            start = stream.tell()
+        except (AttributeError,IOError,OSError,ValueError):
+            start = None
+        attempts = 0
+        lost = 0.0
+
+        self.open_umanager()
+        while True:
+            attempts += 1
+            began = _monotonic()
+            error = None
+            try:
+                reader, stats = self._transfer(stream,block_size,progress)
+                break
+            except _BlockSizeRejected:
+                log.info("1K blocks rejected, falling back to 128 byte blocks")
+                block_size = 128
+                attempts -= 1
+            except Dam1021Error as e:
+                #only a device not ready (3) or a failed transfer (4) may succeed on another attempt
+                if e.args[0] not in (3,4):
+                    raise
+                error = e
+
+            #data not seekable can't be sent again
+            resynced = self._resync_umanager()
+            expired = self.deadline is not None and _monotonic() >= self.deadline
+            if start is None or not resynced or expired or (error is not None and attempts > retries):
+                raise error or Dam1021Error(4,"Error during file download")
+            if error is not None:
+                log.warning("Download attempt {:d} failed: {}".format(attempts,error))
+                if self.metrics is not None:
+                    self.metrics.count('retries')
+                time.sleep(self.download_backoff*2**(attempts-1))
+            stream.seek(start)
+            lost += _monotonic() - began
+
+        self.download_stats = stats._replace(attempts=attempts,recovery=lost)
+        skr_sum = reader.sha1.hexdigest()
+        log.info("File downloaded. Data SHA-1 checksum: {}".format(skr_sum))
+        if attempts > 1:
+            log.info("Download succeeded after {:d} attempts, {:.3f} s lost to recovery".format(attempts,lost))
 
         if um_update:
-            self.ser.write(''.join((self.cmd_update,self.cr)))
-            if self.read_loop(lambda x: x.lower().find(self.update_confirmation) != -1,self.timeout*self.umanager_waitcoeff):
-                self.ser.write(self.update_ack)
+            self._write(''.join((self.cmd_update,self.cr)))
+            if self.read_loop(_contains(self.update_confirmation),self.timeout*self.umanager_waitcoeff):
+                self._write(self.update_ack)
             else:
                 raise Dam1021Error(13,"Error during update command invocation")
 
-            if self.read_loop(lambda x: x.lower().find(self.update_reset) != -1,self.timeout*self.umanager_waitcoeff):
+            if self.read_loop(_contains(self.update_reset),self.timeout*self.umanager_waitcoeff):
+                self.umanager_opened = False
+                if self.metrics is not None:
+                    self.metrics.count('sessions_closed')
+                self.invalidate()
                 log.info("uManager updated")
+                self._await_boot()
             else:
                 raise Dam1021Error(14,"Update failed")
         else:
-            self.close_umanager()            
-
+            self._release_umanager()
 
         return skr_sum
 
+    def _await_boot(self):
+        """Probes a device restarting after an update until it answers or boot_timeout expires. A device still silent by then is left failed, so its link is checked before the next command."""
+
+        deadline = _monotonic() + self.boot_timeout
+        if self.deadline is not None:
+            deadline = min(deadline,self.deadline)
+        try:
+            while True:
+                state = self.probe()
+                if state != 'unresponsive':
+                    self.umanager_opened = state == 'umanager'
+                    log.info("Device restarted")
+                    return
+                if _monotonic() >= deadline:
+                    break
+        except _LinkError as e:
+            #e.g. a USB adapter re-enumerated by a reset
+            log.debug(e)
+            self._drop_transport()
+            self.failures += 1
+        log.warning("Device not answering after an update")
+
+    def _transfer(self,stream,block_size,progress):
+        """Runs a single XMODEM transfer and waits for a device to program data.
+
+        :returns: tuple of a :class:`_HashingReader` and :class:`DownloadStats`
+        """
+
+        self._write(''.join((self.cmd_download,self.cr)))
+        if not self.read_loop(_endswith(self.xmodem_crc),self.timeout):
+            raise Dam1021Error(3,"uManager is not ready to accept a data")
+        #a receiver start request is handed to the modem, which would wait for another one otherwise
+        self._xmodem_unread = self.xmodem_crc
+        try:
+            sent = self._xmodem_send(stream,block_size,progress)
+        finally:
+            self._xmodem_unread = b''
+        if sent is None:
+            raise Dam1021Error(4,"Error during file download")
+        log.info("Data sent: {0.bytes} bytes in {0.blocks} blocks, {0.retransmits} retransmissions, {0.rate:.0f} bytes/s".format(sent[1]))
+        #a prompt follows; it must not be left for the next command to find
+        rbuf = []
+        rv = self.read_loop(_then(_contains(self.reprogram_ack),self.umanager_prompt),self.timeout,lambda x,y,z: rbuf.append(y))
+        if not rv and rbuf[0].lower().find(self.reprogram_ack) == -1:
+            raise Dam1021Error(5,"uManager accepted data and not reprogrammed")
+        return sent
+
+    def _drain(self,quiet,timeout):
+        """Drops incoming data until a line is quiet for a while or a timeout expires."""
+
+        deadline = _monotonic() + timeout
+        dropped = 0
+        while _monotonic() < deadline:
+            chunk = self.transport.read_available(quiet)
+            if not chunk:
+                break
+            dropped += len(chunk)
+        if self.metrics is not None:
+            self.metrics.count('bytes_read',dropped)
+        log.debug("{:d} bytes dropped".format(dropped))
+
+    def _resync_umanager(self):
+        """Brings an uManager prompt back after a failed transfer: a receiver still waiting for data is cancelled, whatever a device prints is dropped until a line is quiet and a device is probed for a fresh prompt.
 
+        :returns: False if uManager does not answer
+        """
+
+        self.xmodem.abort(timeout=self.timeout)
+        #a block sent before a cancellation was noticed may still be arriving at a device
+        self._drain(self.probe_timeout()+1029*10.0/self.transport.baudrate,self.timeout*self.umanager_waitcoeff)
+        for _ in range(self.resync_tries):
+            if self.probe() == 'umanager':
+                self.umanager_opened = True
+                return True
+        self.umanager_opened = None
+        return False
+
+
+    @_operation
     def set_current_volume_level(self,level):
         """Used to set current volume level. Not to be confused with a volume level stored in flash.
         
@@ -239,21 +1365,107 @@ class Connection(object):
 
         if level != self.volume_pot and not (self.volume_inf <= level <= self.volume_sup):
             raise Dam1021Error(6,"Forbbiden volume level")
+
+        if self._unchanged('volume',level):
+            return
          
-        if self.cautious:
-            self.close_umanager(True)
+        self._leave_umanager()
          
         tries = 2
         while tries:
-            self.ser.write(''.join((self.cmd_current_volume.format(level),self.cr)))
-            if self.read_loop(lambda x: x.rstrip().endswith(self.cmd_current_volume.format(level)),self.timeout):
+            self._write(''.join((self.cmd_current_volume.format(level),self.cr)))
+            if self.read_loop(_endswith(self.cmd_current_volume.format(level),True),self.timeout):
                 log.info("Current volume level set to {0:d}".format(level))
+                self._confirm('volume',level)
                 break
             else:
                 tries -= 1
+                if tries and self.metrics is not None:
+                    self.metrics.count('retries')
         if tries == 0:
+            self.invalidate('volume')
             raise Dam1021Error(7,"Failed to set current volume level")
 
+    def _prepare_direct(self,key,value):
+        """Validates a direct command setting.
+
+        :returns: tuple of a command and a normalized value
+        """
+
+        if key == 'volume':
+            if value != self.volume_pot and not (self.volume_inf <= value <= self.volume_sup):
+                raise Dam1021Error(6,"Forbbiden volume level")
+            return self.cmd_current_volume.format(value), value
+        elif key == 'input':
+            if value not in self.input_src_set:
+                raise Dam1021Error(9,"Forbbiden input source")
+            return self.cmd_input_selection.format(value), value
+        elif key == 'fset':
+            value = _fset_lookup(value,self.fset_num_d,self.fset_str_d)[0]
+            return self.cmd_current_fset.format(value), value
+        raise Dam1021Error(23,"Unsupported setting")
+
+    @_operation
+    def pipeline(self,settings,tries=2):
+        """Used to change several current settings at once. Direct commands are written back to back and their echoes are matched in order, so a change costs about a single round trip. Commands from the first one without an echo on are sent again in their order, a setting repeated among them with its last value only.
+
+        :param settings: list of (setting, value) tuples; accepted settings: volume,input,fset (values as for set_current_volume_level, set_input_source and set_current_filter_set)
+        :param tries: how many times a command is sent at most
+        :returns: list of :class:`PipelineResult` tuples in order of settings; an error is a :class:`Dam1021Error` instance or None
+
+        Usage::
+
+        >>> conn.pipeline([('input',1),('fset','mixed'),('volume',-20)])
+        """
+
+        failures = dict(volume=(7,"Failed to set current volume level"),input=(10,"Failed to set input source"),fset=(12,"Failed to change filter set"))
+        results = [None]*len(settings)
+        commands = []
+
+        for idx,(key,value) in enumerate(settings):
+            try:
+                cmd, value = self._prepare_direct(key,value)
+            except Dam1021Error as e:
+                results[idx] = PipelineResult(key,value,e)
+                continue
+            if self._unchanged(key,value):
+                results[idx] = PipelineResult(key,value,None)
+            else:
+                commands.append((idx,key,value,cmd))
+
+        if commands:
+            self._leave_umanager()
+
+        #commands left out of a retry, each with an index of a later command of the same setting
+        superseded = []
+
+        while commands and tries:
+            matcher = _EchoMatcher([ cmd for idx,key,value,cmd in commands ])
+            self._write(''.join([ cmd+self.cr for idx,key,value,cmd in commands ]))
+            self.read_loop(matcher,self.timeout)
+            for idx,key,value,cmd in commands[:matcher.matched]:
+                log.info("Current {} set to {}".format(key,settings[idx][1]))
+                self._confirm(key,value)
+                results[idx] = PipelineResult(key,value,None)
+            #echoes after a missing one don't tell whether a device applied commands in order
+            commands = commands[matcher.matched:]
+            latest = dict((key,idx) for idx,key,value,cmd in commands)
+            superseded.extend([ (idx,key,value,latest[key]) for idx,key,value,cmd in commands if latest[key] != idx ])
+            commands = [ entry for entry in commands if latest[entry[1]] == entry[0] ]
+            tries -= 1
+            if commands and tries and self.metrics is not None:
+                self.metrics.count('retries',len(commands))
+
+        for idx,key,value,cmd in commands:
+            self.invalidate(key)
+            results[idx] = PipelineResult(key,value,Dam1021Error(*failures[key]))
+
+        for idx,key,value,later in superseded:
+            results[idx] = PipelineResult(key,value,results[later].error)
+
+        return results
+
+    @_operation
     def set_flash_volume_level(self,level): 
         """Used to set volume level on flash. Not to be confused with current volume level. Current volume is set to this value during power-up.
         
@@ -263,14 +1475,19 @@ class Connection(object):
         if level != self.volume_pot and not (self.volume_inf <= level <= self.volume_sup):
             raise Dam1021Error(6,"Forbbiden volume level")
 
+        if self._unchanged('flash_volume',level):
+            return
+
         self.open_umanager()
-        self.ser.write(''.join((self.cmd_flash_volume.format(level),self.cr)))
-        if self.read_loop(lambda x: x.rstrip().lower().endswith(self.umanager_errtxt),self.timeout):
+        if not self._umanager_command(self.cmd_flash_volume.format(level)):
+            self.invalidate('flash_volume')
             raise Dam1021Error(8,"Failed to set flash volume level")
         else:
             log.info("Flash volume level set to {0:d}".format(level))
-        self.close_umanager()
+            self._confirm('flash_volume',level)
+        self._release_umanager()
 
+    @_operation
     def set_mode(self,opmode): 
         """Used to set mode of operation.
         
@@ -280,14 +1497,19 @@ class Connection(object):
         if opmode not in self.opmodes:
             raise Dam1021Error(15,"Forbbiden mode")
 
+        if self._unchanged('mode',opmode):
+            return
+
         self.open_umanager()
-        self.ser.write(''.join((self.cmd_mode.format(opmode),self.cr)))
-        if self.read_loop(lambda x: x.rstrip().lower().endswith(self.umanager_errtxt),self.timeout):
+        if not self._umanager_command(self.cmd_mode.format(opmode)):
+            self.invalidate('mode')
             raise Dam1021Error(8,"Failed to set flash volume level")
         else:
             log.info("Mode of operation set to {0:s}".format(opmode))
-        self.close_umanager()
+            self._confirm('mode',opmode)
+        self._release_umanager()
 
+    @_operation
     def set_input_source(self,input_src):
         """Used to set input source for a DAC.
         
@@ -296,21 +1518,28 @@ class Connection(object):
 
         if input_src not in self.input_src_set:
             raise Dam1021Error(9,"Forbbiden input source")
+
+        if self._unchanged('input',input_src):
+            return
          
-        if self.cautious:
-            self.close_umanager(True)
+        self._leave_umanager()
          
         tries = 2
         while tries:
-            self.ser.write(''.join((self.cmd_input_selection.format(input_src),self.cr)))
-            if self.read_loop(lambda x: x.rstrip().endswith(self.cmd_input_selection.format(input_src)),self.timeout):
+            self._write(''.join((self.cmd_input_selection.format(input_src),self.cr)))
+            if self.read_loop(_endswith(self.cmd_input_selection.format(input_src),True),self.timeout):
                 log.info("Input source set to {0:d}".format(input_src))
+                self._confirm('input',input_src)
                 break
             else:
                 tries -= 1
+                if tries and self.metrics is not None:
+                    self.metrics.count('retries')
         if tries == 0:
+            self.invalidate('input')
             raise Dam1021Error(10,"Failed to set input source")  
 
+    @_operation
     def set_current_filter_set(self,fset):
         """Used to set current filter set.
         
@@ -318,31 +1547,29 @@ class Connection(object):
         """.format('|'.join([ "({}|{})".format(i[0],j[0]) for i in sorted(FSET_EXT_NUM_TO_INT_D.items()) for j in FSET_EXT_STR_TO_INT_D.items() if j[1]==i[1]]))
 
         origfset = fset
+        fset = _fset_lookup(fset,self.fset_num_d,self.fset_str_d)[0]
 
-        try:
-            if isinstance(fset,int):
-                fset = str(fset)
-            if fset.isdigit():
-                fset = self.fset_num_d[fset]
-            else:
-                fset = self.fset_str_d[fset]
-        except KeyError:
-            raise Dam1021Error(11,"Forbbiden filter set")
+        if self._unchanged('fset',fset):
+            return
          
-        if self.cautious:
-            self.close_umanager(True)
+        self._leave_umanager()
          
         tries = 2
         while tries:
-            self.ser.write(''.join((self.cmd_current_fset.format(fset),self.cr)))
-            if self.read_loop(lambda x: x.rstrip().endswith(self.cmd_current_fset.format(fset)),self.timeout):
+            self._write(''.join((self.cmd_current_fset.format(fset),self.cr)))
+            if self.read_loop(_endswith(self.cmd_current_fset.format(fset),True),self.timeout):
                 log.info("Current filter set is {0}".format(origfset))
+                self._confirm('fset',fset)
                 break
             else:
                 tries -= 1
+                if tries and self.metrics is not None:
+                    self.metrics.count('retries')
         if tries == 0:
+            self.invalidate('fset')
             raise Dam1021Error(12,"Failed to change filter set")
       
+    @_operation
     def set_flash_filter_set(self,fset):
         """Used to set a default filter set on flash. Also changes current filter set. A current filter set matches this value during power-up.
         
@@ -350,93 +1577,1524 @@ class Connection(object):
         """.format('|'.join([ "({}|{})".format(i[0],j[0]) for i in sorted(FSET_EXT_NUM_TO_INT_D.items()) for j in FSET_EXT_STR_TO_INT_D.items() if j[1]==i[1]]))
         
         origfset = fset
+        ftype, intfset = _fset_lookup(fset,self.fset_num_d,self.fset_str_d)
 
-        try:
-            if isinstance(fset,int):
-                fset = str(fset)
-            if fset.isdigit():
-                fset = self.fset_num_d[fset]
-                intfset = [ entry[0] for entry in self.fset_str_d.items() if entry[1] == fset ][0]
-            else:
-                self.fset_str_d[fset]
-                intfset = fset
-        except KeyError:
-            raise Dam1021Error(11,"Forbbiden filter set")
+        if self._unchanged('flash_fset',intfset) and self._unchanged('fset',ftype):
+            return
 
         self.open_umanager()
-        self.ser.write(''.join((self.cmd_flash_fset.format(intfset),self.cr)))
-        if self.read_loop(lambda x: x.rstrip().lower().endswith(self.umanager_errtxt),self.timeout):
+        if not self._umanager_command(self.cmd_flash_fset.format(intfset)):
+            self.invalidate('flash_fset','fset')
             raise Dam1021Error(18,"Failed to set default filter set")
         else:
             log.info("Default filter set changed to {0}".format(origfset))
-        self.close_umanager()
+            self._confirm('flash_fset',intfset)
+            self._confirm('fset',ftype)
+        self._release_umanager()
 
-    def list_current_filter_set(self,raw=False):
-        """User to list a currently selected filter set"""
-        
-        buf = []
+    @_operation
+    def list_current_filter_set(self,raw=False,refresh=False):
+        """User to list a currently selected filter set
 
-        self.open_umanager()
-        self.ser.write(''.join((self.cmd_current_filter_list,self.cr)))
-        if self.read_loop(lambda x: x.endswith(self.umanager_prompt),self.timeout,lambda x,y,z: buf.append(y.rstrip()[:-1])):
-            if raw:
-                rv = buf = buf[0]
-            else:
-                rv, buf = self.filter_organizer(buf[0])
-        else:
-            raise Dam1021Error(16,"Failed to list currently selected filter set")
-        self.close_umanager()
+        :param refresh: query a device even if a listing is cached (see :meth:`filter_catalogue`)
+        """
 
-        log.info(buf)
+        catalogue = self.filter_catalogue(current=True,refresh=refresh)
+        rv = catalogue.raw if raw else catalogue.as_dict()
+        log.info(catalogue.raw if raw else catalogue.describe())
 
         return rv
 
-    def list_all_filters(self,raw=False):
-        """User to list all available filters"""
-        
+    @_operation
+    def list_all_filters(self,raw=False,refresh=False):
+        """User to list all available filters
+
+        :param refresh: query a device even if a listing is cached (see :meth:`filter_catalogue`)
+        """
+
+        catalogue = self.filter_catalogue(refresh=refresh)
+        rv = catalogue.raw if raw else catalogue.as_dict()
+        log.info(catalogue.raw if raw else catalogue.describe())
+
+        return rv
+
+    @_operation
+    def filter_catalogue(self,current=False,refresh=False):
+        """Used to get a filter listing as a :class:`FilterCatalogue`.
+
+        A listing is cached for an image last downloaded, so repeated calls do no serial I/O. A cache is kept in memory and in a catalogue cache if a connection has one (keyed by a device and SHA-1 of the image). It is dropped after a download. A currently selected filter set is cached only if a shadow state knows which set is selected.
+
+        :param current: list a currently selected filter set instead of all available filters
+        :param refresh: query a device even if a listing is cached
+        :returns: :class:`FilterCatalogue`
+        """
+
+        if current:
+            fset = self.shadow.get('fset') if self.shadow is not None else None
+            key = None if fset is None else '{}:{:d}'.format(self.cmd_current_filter_list,fset)
+        else:
+            key = self.cmd_all_filter_list
+
+        if key is not None and not refresh:
+            catalogue = self.catalogues.get(key)
+            if catalogue is None and self.catalogue_cache is not None and self.image_sha:
+                raw = self.catalogue_cache.get(self.device_id,self.image_sha,key)
+                if raw is not None:
+                    catalogue = self.catalogues[key] = FilterCatalogue(raw,self.cr)
+            if catalogue is not None:
+                log.debug("Filter listing served from cache")
+                return catalogue
+
+        if current:
+            raw = self._list_filters(self.cmd_current_filter_list,16,"Failed to list currently selected filter set")
+        else:
+            raw = self._list_filters(self.cmd_all_filter_list,17,"Failed to list all available filters")
+        catalogue = FilterCatalogue(raw,self.cr)
+
+        if key is not None:
+            self.catalogues[key] = catalogue
+            if self.catalogue_cache is not None and self.image_sha:
+                self.catalogue_cache.set(self.device_id,self.image_sha,key,raw)
+
+        return catalogue
+
+    def _list_filters(self,cmd,code,errmsg):
         buf = []
 
         self.open_umanager()
-        self.ser.write(''.join((self.cmd_all_filter_list,self.cr)))
-        if self.read_loop(lambda x: x.endswith(self.umanager_prompt),self.timeout,lambda x,y,z: buf.append(y.rstrip()[:-1])):
-            if raw:
-                rv = buf = buf[0]
+        self._write(''.join((cmd,self.cr)))
+        if not self.read_loop(_endswith(self.umanager_prompt),self.timeout,lambda x,y,z: buf.append(y.rstrip()[:-1])):
+            raise Dam1021Error(code,errmsg)
+        self._release_umanager()
+
+        return _text(buf[0])
+
+    def filter_organizer(self,rdata):
+        return _organize_filters(rdata,self.cr)
+
+
+def _organize_filters(rdata,cr='\r'):
+    """Parses a filter listing.
+
+    :returns: tuple of a dict of FIR and IIR filters and a human readable description
+    """
+
+    catalogue = FilterCatalogue(rdata,cr)
+    return catalogue.as_dict(), catalogue.describe()
+
+
+class FilterCatalogue(object):
+    """Typed view of a filter listing. A listing is parsed once, lookups are dictionary based.
+
+    FIR filters are organised in banks (one per filter set) of two slots, FIR1 and FIR2 (see :data:`FIR_SLOTS`). Other filter types are IIR filters.
+
+    :param raw: listing as printed by a device
+    :param cr: line separator
+
+    Usage::
+
+    >>> catalogue = conn.filter_catalogue()
+    >>> catalogue.bank('mixed')['FIR2']
+    [Filter(type=9, kind='FIR', bank=2, slot='FIR2', description='...')]
+    >>> catalogue.find('44.1kHz')
+    """
+
+    def __init__(self,raw,cr='\r'):
+        self.raw = raw
+        self.filters = []
+        self.types = {}
+        self.banks = {}
+        self.iir = []
+
+        for entry in raw.split(cr):
+            entry = entry.strip()
+            if not entry[:2].isdigit():
+                continue
+            eid, _, edata = entry.partition(' ')
+            eid = int(eid)
+            bank, slot = FIR_SLOTS.get(eid,(None,None))
+            item = Filter(eid,'IIR' if bank is None else 'FIR',bank,slot,edata)
+            self.filters.append(item)
+            self.types.setdefault(eid,[]).append(item)
+            if bank is None:
+                self.iir.append(item)
             else:
-                rv, buf = self.filter_organizer(buf[0])
-        else:
-            raise Dam1021Error(17,"Failed to list all available filters")
-        self.close_umanager()
+                self.banks.setdefault(bank,{}).setdefault(slot,[]).append(item)
 
-        log.info(buf)
+    def __iter__(self):
+        return iter(self.filters)
 
-        return rv
+    def __len__(self):
+        return len(self.filters)
 
-    def filter_organizer(self,rdata):
-        aux1 = { 4:'FIR1',5:'FIR1',6:'FIR1',7:'FIR1',8:'FIR2',9:'FIR2',10:'FIR2',11:'FIR2'}
-        aux2 = { 4:1,5:2,6:3,7:4,8:1,9:2,10:3,11:4}
+    def get(self,ftype):
+        """Returns a list of filters of a type (as printed by a device)."""
+
+        return self.types.get(ftype,[])
+
+    def bank(self,fset):
+        """Returns FIR filters of a filter set given by a number or a name as a dict of slot -> list of filters."""
+
+        ftype = _fset_lookup(fset,FSET_EXT_NUM_TO_INT_D,FSET_EXT_STR_TO_INT_D)[0]
+        return self.banks.get(FIR_SLOTS[ftype][0],{})
+
+    def find(self,name):
+        """Returns a list of filters whose description contains a name (case insensitive)."""
+
+        name = name.lower()
+        return [ item for item in self.filters if name in item.description.lower() ]
+
+    def as_dict(self):
+        """Returns a listing as a dict of FIR filters (bank -> slot -> list of (type, description)) and IIR filters (type -> list of descriptions)."""
 
-        rdata = [ entry.strip() for entry in rdata.split(self.cr) ] 
-        rdata = [ entry.split(' ',1) for entry in rdata if entry[:2].isdigit() ]
         rv = dict(FIR=dict(),IIR=dict())
-        for eid,edata in rdata:
-            eid =  int(eid)
-            if eid in range(4,12):
-                rv['FIR'].setdefault(aux2[eid],dict()).setdefault(aux1[eid],[]).append((eid,edata))
+        for item in self.filters:
+            if item.kind == 'FIR':
+                rv['FIR'].setdefault(item.bank,dict()).setdefault(item.slot,[]).append((item.type,item.description))
             else:
-                rv['IIR'].setdefault(eid,[]).append(edata)
+                rv['IIR'].setdefault(item.type,[]).append(item.description)
+        return rv
+
+    def describe(self):
+        """Returns a human readable description of a listing."""
+
         rbuf = ['\nFIR filters:']
-        for bid,bval in rv['FIR'].items():
+        for bid,bval in sorted(self.banks.items()):
             rbuf.append('  Bank {:02d}:'.format(bid))
-            for fid,fval in bval.items():
-                for entry in fval:
-                    rbuf.append('    {}: type({:02d}) {}'.format(fid,entry[0],entry[1]))
+            for fid,fval in sorted(bval.items()):
+                for item in fval:
+                    rbuf.append('    {}: type({:02d}) {}'.format(fid,item.type,item.description))
         rbuf.append('IIR filters:')
-        for eid, edata in sorted(rv['IIR'].items()):
-            for entry in edata:
-                rbuf.append('  type({:02d}) {}'.format(eid,entry))
+        for item in sorted(self.iir,key=lambda item: item.type):
+            rbuf.append('  type({:02d}) {}'.format(item.type,item.description))
+
+        return '\n'.join(rbuf)
+
+
+class JSONStore(object):
+    """Dictionary of entries stored as a JSON file, written as a whole on every change. A base of caches and an image library.
+
+    :param path: file; None keeps entries in memory only
+    """
+
+    #used in a warning about a corrupted file
+    kind = 'store'
+
+    def __init__(self,path):
+        self.path = os.path.expanduser(path) if path else None
+        self.entries = {}
+        self.lock = threading.RLock()
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                log.warning("Corrupted {} {} ignored".format(self.kind,self.path))
+
+    def _put(self,key,value,drop=()):
+        """Stores an entry, dropping other keys first."""
+
+        with self.lock:
+            for other in drop:
+                self.entries.pop(other,None)
+            self.entries[key] = value
+            self.save()
+
+    def _drop(self,keys):
+        """Removes entries; a file is written only if some were found."""
+
+        with self.lock:
+            found = [ key for key in keys if self.entries.pop(key,None) is not None ]
+            if found:
+                self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            tmp = '{}.tmp'.format(self.path)
+            with open(tmp,'w') as f:
+                json.dump(self.entries,f,indent=2,sort_keys=True)
+            os.rename(tmp,self.path)
+
+
+class HashCache(JSONStore):
+    """Persistent record of SHA-1 checksums of images last programmed into devices. It is stored as a JSON file.
+
+    :param path: cache file; None keeps a cache in memory only
+    """
+
+    kind = 'hash cache'
+
+    def __init__(self,path=DEFAULT_HASH_CACHE):
+        super(HashCache,self).__init__(path)
+
+    def get(self,device):
+        """Returns a checksum of an image last programmed into a device or None."""
+
+        return self.entries.get(device)
+
+    def set(self,device,checksum):
+        """Records a checksum of an image successfully programmed into a device."""
+
+        self._put(device,checksum)
+
+    def invalidate(self,device):
+        """Forgets what has been programmed into a device."""
+
+        self._drop([device])
+
+
+class CatalogueCache(JSONStore):
+    """Persistent record of filter listings of devices, keyed by a device, SHA-1 of an image last programmed into it and a listing command. It is stored as a JSON file.
+
+    :param path: cache file; None keeps a cache in memory only
+    """
+
+    kind = 'catalogue cache'
+
+    def __init__(self,path=DEFAULT_CATALOGUE_CACHE):
+        super(CatalogueCache,self).__init__(path)
+
+    @staticmethod
+    def _key(device,checksum,listing):
+        return '{} {} {}'.format(device,checksum,listing)
+
+    def get(self,device,checksum,listing):
+        """Returns a raw listing or None."""
+
+        return self.entries.get(self._key(device,checksum,listing))
+
+    def set(self,device,checksum,listing,raw):
+        """Records a raw listing. Listings of other images of a device are dropped."""
+
+        prefix = '{} '.format(device)
+        with self.lock:
+            stale = [ key for key in self.entries if key.startswith(prefix) and not key.startswith('{}{} '.format(prefix,checksum)) ]
+            self._put(self._key(device,checksum,listing),raw,stale)
+
+    def invalidate(self,device):
+        """Forgets all listings of a device."""
+
+        prefix = '{} '.format(device)
+        with self.lock:
+            self._drop([ key for key in self.entries if key.startswith(prefix) ])
+
+
+class ImageLibrary(JSONStore):
+    """Index of local dam1021 images: a name, a path, a size and a kind of each image by its SHA-1. It is stored as a JSON file. Images are picked by a name or a checksum without reading them again.
+
+    :param path: index file; None keeps an index in memory only
+
+    Usage::
+
+    >>> library = dam1021.ImageLibrary()
+    >>> library.add('filters/newfilter.skr')
+    >>> conn.download(library.open('newfilter.skr'))
+    """
+
+    kind = 'image library'
+
+    def __init__(self,path=DEFAULT_IMAGE_LIBRARY):
+        super(ImageLibrary,self).__init__(path)
+
+    def add(self,path,kind=None):
+        """Inspects an image and records it.
+
+        :param kind: firmware or filters; guessed from a file name if omitted
+        :returns: :class:`ImageInfo`
+        """
+
+        with open(path,'rb') as f:
+            info = _inspect_stream(f)
+        if info.problems:
+            raise Dam1021Error(27,"Not a dam1021 image: {}".format('; '.join(info.problems)))
+        info = info._replace(kind=kind or info.kind)
+        entry = dict(name=info.name,path=os.path.abspath(path),size=info.size,kind=info.kind,mtime=os.path.getmtime(path))
+        self._put(info.sha1,entry)
+        return info
+
+    def find(self,key):
+        """Looks up an image by a SHA-1 (or its unique prefix of 6 characters at least), a file name or a path.
+
+        :returns: tuple of a SHA-1 and an entry (a dict of name, path, size, kind, mtime) or None
+        """
+
+        with self.lock:
+            if key in self.entries:
+                return key, self.entries[key]
+            matches = [ sha1 for sha1 in self.entries if len(key) >= 6 and sha1.startswith(key.lower()) ]
+            if not matches:
+                path = os.path.abspath(key)
+                matches = [ sha1 for sha1,entry in self.entries.items() if entry['path'] == path ] or \
+                          [ sha1 for sha1,entry in self.entries.items() if entry['name'] == key ]
+            if len(matches) > 1:
+                raise Dam1021Error(28,"Ambiguous image: {}".format(key))
+            return (matches[0], self.entries[matches[0]]) if matches else None
+
+    def open(self,key):
+        """Opens an image given as for :meth:`find`.
+
+        :returns: a file object opened in binary mode
+        """
+
+        found = self.find(key)
+        if found is None:
+            raise Dam1021Error(28,"Unknown image: {}".format(key))
+        sha1, entry = found
+        try:
+            changed = os.path.getsize(entry['path']) != entry['size'] or os.path.getmtime(entry['path']) != entry['mtime']
+        except OSError:
+            raise Dam1021Error(28,"Image {} missing at {}".format(key,entry['path']))
+        if changed:
+            log.warning("{} changed since it was added to a library".format(entry['path']))
+        return open(entry['path'],'rb')
+
+    def remove(self,key):
+        """Forgets an image given as for :meth:`find`."""
+
+        found = self.find(key)
+        if found is not None:
+            self._drop([found[0]])
+
+
+class Metrics(object):
+    """Collects timings and counters of connections. Safe to share between connections and threads.
+
+    Durations of connection operations are kept as histograms. Counters: bytes_read, bytes_written, timeouts (waits for a device that expired), retries (commands sent again), retransmits (XMODEM blocks sent again), sessions_opened and sessions_closed (uManager), reconnects (links restored; a reconnect operation measures time to recover).
+
+    :param hooks: callables invoked with a kind ('latency' or 'counter'), a name and a value on every observation; a latency hook also gets an error (None on success)
+
+    Usage::
+
+    >>> metrics = dam1021.Metrics()
+    >>> conn = dam1021.Connection('/dev/ttyS0',metrics=metrics)
+    >>> conn.set_current_volume_level(-14)
+    >>> print(metrics.prometheus())
+    """
+
+    buckets = (0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0)
+    counter_names = ('bytes_read','bytes_written','timeouts','retries','retransmits','sessions_opened','sessions_closed','reconnects')
+
+    def __init__(self,hooks=()):
+        self.hooks = list(hooks)
+        self.operations = {}
+        self.counters = dict((name,0) for name in self.counter_names)
+        self.lock = threading.Lock()
+
+    def observe(self,operation,seconds,error=None):
+        """Records a duration of an operation."""
+
+        with self.lock:
+            entry = self.operations.get(operation)
+            if entry is None:
+                entry = self.operations[operation] = dict(buckets=[0]*(len(self.buckets)+1),count=0,sum=0.0,errors=0)
+            entry['buckets'][bisect_left(self.buckets,seconds)] += 1
+            entry['count'] += 1
+            entry['sum'] += seconds
+            if error is not None:
+                entry['errors'] += 1
+        for hook in self.hooks:
+            hook('latency',operation,seconds,error)
+
+    def count(self,name,value=1):
+        """Increments a counter."""
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name,0) + value
+        for hook in self.hooks:
+            hook('counter',name,value)
+
+    def snapshot(self):
+        """Returns a copy of collected values as a dict of counters and operations (count, sum, errors and cumulative buckets as (upper bound, count) pairs, None meaning infinity)."""
+
+        with self.lock:
+            operations = {}
+            for name,entry in self.operations.items():
+                total, cumulative = 0, []
+                for bound,hits in zip(self.buckets+(None,),entry['buckets']):
+                    total += hits
+                    cumulative.append((bound,total))
+                operations[name] = dict(count=entry['count'],sum=entry['sum'],errors=entry['errors'],buckets=cumulative)
+            return dict(counters=dict(self.counters),operations=operations)
+
+    def json(self):
+        """Returns collected values as a JSON document."""
+
+        return json.dumps(self.snapshot(),indent=2,sort_keys=True)
+
+    def prometheus(self,prefix='dam1021'):
+        """Returns collected values in a Prometheus text exposition format."""
+
+        snapshot = self.snapshot()
+        rbuf = []
+        for name,value in sorted(snapshot['counters'].items()):
+            rbuf.append('# TYPE {}_{}_total counter'.format(prefix,name))
+            rbuf.append('{}_{}_total {}'.format(prefix,name,value))
+        if snapshot['operations']:
+            rbuf.append('# TYPE {}_operation_seconds histogram'.format(prefix))
+            for name,entry in sorted(snapshot['operations'].items()):
+                for bound,total in entry['buckets']:
+                    rbuf.append('{}_operation_seconds_bucket{{operation="{}",le="{}"}} {}'.format(prefix,name,'+Inf' if bound is None else bound,total))
+                rbuf.append('{}_operation_seconds_sum{{operation="{}"}} {!r}'.format(prefix,name,entry['sum']))
+                rbuf.append('{}_operation_seconds_count{{operation="{}"}} {}'.format(prefix,name,entry['count']))
+            rbuf.append('# TYPE {}_operation_errors_total counter'.format(prefix))
+            for name,entry in sorted(snapshot['operations'].items()):
+                rbuf.append('{}_operation_errors_total{{operation="{}"}} {}'.format(prefix,name,entry['errors']))
+        return '\n'.join(rbuf)
+
+
+BatchResult = namedtuple('BatchResult','command args value error')
+
+
+class Batch(object):
+    """Queues uManager commands and runs them within a single uManager session. Use :meth:`Connection.session` to create one.
+
+    Commands are queued by calling methods of the same name as in :class:`Connection`. The queue is run on a context exit or by :meth:`run`.
+
+    :param conn: connection to use
+    :param stop_on_error: skip remaining commands after the first failure
+    """
+
+    commands = ('download','set_flash_volume_level','set_mode','set_flash_filter_set','list_current_filter_set','list_all_filters')
+
+    def __init__(self,conn,stop_on_error=False):
+        self.conn = conn
+        self.stop_on_error = stop_on_error
+        self.queue = []
+        self.results = []
+
+    def __getattr__(self,name):
+        if name not in self.commands:
+            raise AttributeError(name)
+        def enqueue(*args,**kwargs):
+            self.queue.append((name,args,kwargs))
+        return enqueue
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        if exc_type is None:
+            self.run()
+        else:
+            self.queue = []
+
+    def run(self):
+        """Runs queued commands. Commands queued after a link failure are not run.
+
+        :returns: list of :class:`BatchResult` tuples, one per command; an error is an exception instance (:class:`Dam1021Error` or a serial port error) or None
+        """
+
+        queue, self.queue = self.queue, []
+        self.results = []
+        failed = lost = False
+
+        self.conn.umanager_holds += 1
+        try:
+            for name,args,kwargs in queue:
+                value = error = None
+                if lost:
+                    error = Dam1021Error(19,"Not run, link lost")
+                elif failed and self.stop_on_error:
+                    error = Dam1021Error(19,"Skipped due to a previous failure")
+                else:
+                    try:
+                        value = getattr(self.conn,name)(*args,**kwargs)
+                    except Dam1021Error as e:
+                        error = e
+                        failed = True
+                    except serial.SerialException as e:
+                        log.warning("Link failed: {}".format(e))
+                        error = e
+                        failed = lost = True
+                self.results.append(BatchResult(name,args,value,error))
+        finally:
+            self.conn.umanager_holds -= 1
+            if lost:
+                #a session can't be closed over a dead link, its state is unknown
+                self.conn.umanager_opened = None
+            else:
+                self.conn._release_umanager()
+
+        return self.results
+
+
+class Scheduler(object):
+    """Applies settings from a background thread, so callers never wait for a device. Updates of a setting not applied yet are coalesced: only the newest value goes to a device. Several pending settings are sent together through :meth:`Connection.pipeline`. Intended for fast input such as a rotary encoder.
+
+    :param conn: connection used to apply settings (or any object with the same set_* methods)
+    :param min_interval: minimum time in seconds between two commands sent to a device
+    :param callback: callable invoked with a setting, a value and an error (None on success) after each attempt
+
+    Usage::
+
+    >>> sched = dam1021.Scheduler(conn,min_interval=0.02)
+    >>> for level in range(-40,-20):
+    ...     sched.submit('volume',level)
+    >>> sched.flush()
+    >>> sched.applied['volume']
+    -21
+    """
+
+    setters = dict(volume='set_current_volume_level',input='set_input_source',fset='set_current_filter_set')
+
+    def __init__(self,conn,min_interval=0.0,callback=None):
+        self.conn = conn
+        self.min_interval = min_interval
+        self.callback = callback
+        self.pending = OrderedDict()
+        self.applied = {}
+        self.errors = {}
+        self.busy = False
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run,name='dam1021-scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def depth(self):
+        """Number of settings waiting to be applied."""
+
+        return len(self.pending)
+
+    def submit(self,key,value):
+        """Schedules a setting; replaces a value of the same setting still waiting.
+
+        :param key: setting; accepted values: volume,input,fset
+        """
+
+        if key not in self.setters:
+            raise Dam1021Error(23,"Unsupported setting")
+        with self._cond:
+            if not self._running:
+                raise Dam1021Error(21,"Scheduler closed")
+            self.pending[key] = value
+            self._cond.notify_all()
+
+    def flush(self,timeout=None):
+        """Waits until all scheduled settings are applied.
+
+        :returns: False if a timeout expired
+        """
+
+        deadline = None if timeout is None else _monotonic() + timeout
+        with self._cond:
+            while self.pending or self.busy:
+                remaining = None if deadline is None else deadline - _monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self,timeout=None):
+        """Applies remaining settings and stops a background thread. Settings submitted afterwards are refused."""
+
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self.flush(timeout)
+        self._thread.join(timeout)
+
+    def _run(self):
+        last = None
+        while True:
+            with self._cond:
+                while self._running and not self.pending:
+                    self._cond.wait()
+                if not self.pending:
+                    return
+                items = list(self.pending.items())
+                self.pending.clear()
+                self.busy = True
+
+            if last is not None and self.min_interval:
+                delay = last + self.min_interval - _monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            outcome = []
+            if len(items) > 1 and hasattr(self.conn,'pipeline'):
+                try:
+                    outcome = [ (key,value,result.error) for (key,value),result in zip(items,self.conn.pipeline(items)) ]
+                except Exception as e:
+                    outcome = [ (key,value,e) for key,value in items ]
+            else:
+                for key,value in items:
+                    try:
+                        getattr(self.conn,self.setters[key])(value)
+                        outcome.append((key,value,None))
+                    except Exception as e:
+                        outcome.append((key,value,e))
+            last = _monotonic()
+
+            with self._cond:
+                for key,value,error in outcome:
+                    if error is None:
+                        self.applied[key] = value
+                        self.errors.pop(key,None)
+                    else:
+                        log.error(error)
+                        self.errors[key] = error
+                self.busy = False
+                self._cond.notify_all()
+
+            if hasattr(self.callback,'__call__'):
+                for key,value,error in outcome:
+                    #a failing callback must not stop a scheduler, flush() and close() would wait forever
+                    try:
+                        self.callback(key,value,error)
+                    except Exception as e:
+                        log.exception(e)
+
+
+class Future(object):
+    """A result of a command queued by a :class:`Worker` (Python 2 has no concurrent.futures).
+
+    A deadline covers both a wait in a queue and a run: a command whose deadline expires before it starts is never sent, a command already running is not interrupted, but :meth:`result` gives up waiting for it.
+
+    :param name: command name
+    :param deadline: seconds a caller is willing to wait; None waits forever
+    """
+
+    def __init__(self,name,deadline=None):
+        self.name = name
+        self.submitted = _monotonic()
+        self.deadline = None if deadline is None else self.submitted + deadline
+        self.started = None
+        self.finished = None
+        self.cancelled = False
+        self._value = None
+        self._error = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def done(self):
+        return self._done.is_set()
+
+    def expired(self):
+        return self.deadline is not None and _monotonic() >= self.deadline
+
+    def cancel(self):
+        """Drops a command that has not started yet.
+
+        :returns: False if a command has started already
+        """
+
+        with self._lock:
+            if self.started is not None or self._done.is_set():
+                return False
+            self.cancelled = True
+        self._finish(None,Dam1021Error(19,"Cancelled"))
+        return True
+
+    def _start(self):
+        with self._lock:
+            if self.cancelled or self._done.is_set():
+                return False
+            self.started = _monotonic()
+            return True
+
+    def _finish(self,value,error):
+        #an outcome is recorded once; callbacks run outside a lock, they may use a future
+        with self._lock:
+            if self._done.is_set():
+                return False
+            self._value, self._error = value, error
+            self.finished = _monotonic()
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+        return True
+
+    def add_done_callback(self,callback):
+        """Calls a callable with a future once a command finishes (at once if it has finished already)."""
+
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def exception(self,timeout=None):
+        """Waits for a command and returns its error, None on success.
+
+        :param timeout: seconds to wait at most, within a deadline
+        """
+
+        if self.deadline is not None:
+            remaining = max(0,self.deadline - _monotonic())
+            timeout = remaining if timeout is None else min(timeout,remaining)
+        if not self._done.wait(timeout):
+            return Dam1021Error(30,"{} timed out".format(self.name))
+        return self._error
+
+    def result(self,timeout=None):
+        """Waits for a command and returns its result; an error of a command is raised.
+
+        :param timeout: seconds to wait at most, within a deadline
+        """
+
+        error = self.exception(timeout)
+        if error is not None:
+            raise error
+        return self._value
+
+
+class Worker(object):
+    """Makes a connection safe to share between threads: a single background thread owns a connection and runs commands from a priority queue. Each call returns a :class:`Future` at once.
+
+    Commands are never interleaved on a serial line; a command runs as a whole (a download included). Direct commands (volume, input, filter set) go ahead of waiting uManager commands and downloads, so a volume change is delayed by a single running command at most, never by a backlog. Commands of equal priority run in submission order, so e.g. a listing queued after a download lists filters downloaded. A caller that needs a direct command to follow an uManager command waits for a future of the latter first.
+
+    An uManager session is kept open between uManager commands (a direct command closes it) and closed after idle_timeout seconds without commands.
+
+    Every call accepts a ``deadline`` (seconds, see :class:`Future`) and a ``priority`` (lower runs first) keyword argument.
+
+    :param conn: connection to own; it should not be used directly meanwhile
+    :param idle_timeout: seconds of inactivity after which an uManager session is closed
+    :param priorities: dict of a command name -> priority, overriding :attr:`priorities`
+
+    Usage::
+
+    >>> worker = dam1021.Worker(conn)
+    >>> download = worker.download(open('newfilter.skr','rb'))
+    >>> worker.set_current_volume_level(-20,deadline=0.5).result()
+    >>> download.result()
+    >>> worker.close()
+    """
+
+    #commands not listed run with priority 1
+    priorities = dict(set_current_volume_level=0,set_input_source=0,set_current_filter_set=0,pipeline=0,refresh=0,probe=0)
+
+    def __init__(self,conn,idle_timeout=1.0,priorities=None):
+        self.conn = conn
+        self.idle_timeout = idle_timeout
+        self.priorities = dict(self.priorities,**(priorities or {}))
+        self._heap = []
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run,name='dam1021-worker')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __getattr__(self,name):
+        if name.startswith('_') or not hasattr(self.conn,name) or not hasattr(getattr(self.conn,name),'__call__'):
+            raise AttributeError(name)
+        return partial(self.submit,name)
+
+    @property
+    def depth(self):
+        """Number of commands waiting to run."""
+
+        return len(self._heap)
+
+    def submit(self,name,*args,**kwargs):
+        """Queues a connection method call.
+
+        :param name: method name, e.g. set_current_volume_level
+        :returns: :class:`Future`
+        """
+
+        deadline = kwargs.pop('deadline',None)
+        priority = kwargs.pop('priority',self.priorities.get(name,1))
+        future = Future(name,deadline)
+        with self._cond:
+            if not self._running:
+                raise Dam1021Error(21,"Worker closed")
+            heapq.heappush(self._heap,(priority,self._seq,future,args,kwargs))
+            self._seq += 1
+            self._cond.notify()
+        return future
+
+    def close(self,timeout=None):
+        """Runs commands already queued, closes an uManager session and stops a background thread (a connection stays open)."""
+
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def _next(self,settled=False):
+        idle_since = _monotonic()
+        with self._cond:
+            while self._running and not self._heap:
+                if settled or self.conn.umanager_opened is False:
+                    self._cond.wait()
+                    continue
+                remaining = idle_since + self.idle_timeout - _monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            return heapq.heappop(self._heap) if self._heap else False
+
+    def _run(self):
+        conn = self.conn
+        conn.umanager_holds += 1
+        #an idle session has been dealt with, nothing to do until a command comes
+        settled = False
+        try:
+            while True:
+                item = self._next(settled)
+                if item is None or item is False:
+                    try:
+                        conn.close_umanager()
+                    except Exception as e:
+                        log.error(e)
+                        #a state is unknown, the next command probes a device first
+                        conn.umanager_opened = None
+                        conn.failures += 1
+                    settled = True
+                    if item is False:
+                        return
+                    continue
+                settled = False
+                future, args, kwargs = item[2:]
+                if future.expired():
+                    #never started, a cancelled future is finished already
+                    future._finish(None,Dam1021Error(30,"{} timed out in a queue".format(future.name)))
+                    continue
+                if not future._start():
+                    continue
+                if conn.metrics is not None:
+                    conn.metrics.observe('queued',future.started-future.submitted)
+                try:
+                    value, error = getattr(conn,future.name)(*args,**kwargs), None
+                except Exception as e:
+                    value, error = None, e
+                    if not isinstance(e,Dam1021Error):
+                        log.exception(e)
+                future._finish(value,error)
+        except BaseException as e:
+            log.exception(e)
+        finally:
+            conn.umanager_holds -= 1
+            #commands left behind by a thread that stopped would never finish
+            with self._cond:
+                self._running = False
+                pending, self._heap = self._heap, []
+            for item in pending:
+                item[2]._finish(None,Dam1021Error(21,"Worker stopped"))
+
+
+class Fleet(object):
+    """Runs the same command on many devices in parallel, each device over its own :class:`Connection`. Connections are opened on first use and kept open until :meth:`close`.
+
+    Commands are called by methods of the same name as in :class:`Connection` and return a list of :class:`FleetResult` tuples in order of devices; an error is an exception instance or None.
+
+    :param devices: list of serial devices; shell style wildcards are expanded (see :func:`expand_devices`)
+    :param workers: maximum number of devices served at once
+    :param deadline: time in seconds a command may take on a whole fleet; waits of a device are cut to it and devices not started by then get an error, None for no limit
+    :param kwargs: :class:`Connection` parameters shared by all devices (caches are thread safe)
+
+    Usage::
+
+    >>> with dam1021.Fleet(['/dev/ttyUSB*'],deadline=60) as fleet:
+    ...     for result in fleet.download(open('newfilter.skr','rb')):
+    ...         print(result.device, result.error, result.seconds)
+    """
+
+    commands = ('download','set_current_volume_level','set_flash_volume_level','set_mode','set_input_source',
+                'set_current_filter_set','set_flash_filter_set','list_current_filter_set','list_all_filters','pipeline')
+
+    def __init__(self,devices,workers=8,deadline=None,**kwargs):
+        self.devices = expand_devices(devices)
+        self.workers = workers
+        self.deadline = deadline
+        self.kwargs = kwargs
+        self.connections = {}
+        self.busy = set()
+        #busy devices whose connections are closed once a command returns
+        self._closing = set()
+        self._lock = threading.Lock()
+
+    def __getattr__(self,name):
+        if name not in self.commands:
+            raise AttributeError(name)
+        return partial(self.call,name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+    def call(self,method,*args,**kwargs):
+        """Runs a connection method on all devices and returns once every device is done. An image to download is read into memory once, up to MAX_IMAGE_SIZE bytes.
+
+        :returns: list of :class:`FleetResult` tuples in order of devices
+        """
+
+        if method == 'download' and hasattr(args[0],'read'):
+            #every worker needs its own stream, an image is read once and shared by all of them
+            data = args[0].read(MAX_IMAGE_SIZE+1)
+            if len(data) > MAX_IMAGE_SIZE:
+                raise Dam1021Error(27,"Not a dam1021 image: larger than {:d} bytes".format(MAX_IMAGE_SIZE))
+            args = (data,) + args[1:]
+
+        start = _monotonic()
+        deadline = None if self.deadline is None else start + self.deadline
+        jobs = queue.Queue()
+        for device in self.devices:
+            jobs.put(device)
+        results = {}
+
+        def work():
+            while True:
+                try:
+                    device = jobs.get_nowait()
+                except queue.Empty:
+                    return
+                began = _monotonic()
+                if deadline is not None and began >= deadline:
+                    result = FleetResult(device,None,Dam1021Error(24,"Fleet deadline expired"),0.0)
+                else:
+                    value, error = self._run(device,deadline,method,args,kwargs)
+                    result = FleetResult(device,value,error,_monotonic()-began)
+                results[device] = result
+
+        workers = []
+        for _ in range(min(self.workers,len(self.devices))):
+            worker = threading.Thread(target=work,name='dam1021-fleet')
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        #waits of a device are cut to a deadline, so workers finish soon after it
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(1.0)
+        rv = [ results[device] for device in self.devices ]
+
+        for result in rv:
+            log.debug("{}: {} in {:.3f} s".format(result.device,result.error or 'done',result.seconds))
+
+        return rv
+
+    def _run(self,device,deadline,method,args,kwargs):
+        with self._lock:
+            if device in self.busy:
+                return None, Dam1021Error(25,"Device still busy with a previous command")
+            self.busy.add(device)
+        try:
+            conn = self.connections.get(device)
+            if conn is None:
+                conn = self.connections[device] = Connection(device,**self.kwargs)
+            timeout = conn.timeout
+            if deadline is not None:
+                #a single wait, or a whole transfer, must not outlive a fleet deadline
+                conn.timeout = max(0.0,min(timeout,deadline-_monotonic()))
+                conn.deadline = deadline
+            try:
+                return getattr(conn,method)(*args,**kwargs), None
+            finally:
+                conn.timeout = timeout
+                conn.deadline = None
+        except Exception as e:
+            return None, e
+        finally:
+            with self._lock:
+                self.busy.discard(device)
+                orphan = self.connections.pop(device,None) if device in self._closing else None
+                self._closing.discard(device)
+            if orphan is not None:
+                self._close(orphan)
+
+    def close(self):
+        """Closes connections of all devices. A connection still running a command past a deadline is closed when the command returns."""
+
+        with self._lock:
+            idle = [ conn for device,conn in self.connections.items() if device not in self.busy ]
+            self._closing.update(self.busy)
+            self.connections = dict((device,conn) for device,conn in self.connections.items() if device in self.busy)
+        for conn in idle:
+            self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception as e:
+            log.error(e)
+
+
+class Monitor(object):
+    """Watches a device from a background thread and reports changes as :class:`StatusEvent` tuples, through a callback or :meth:`events`.
+
+    No dam1021 command is known to report a volume level or an input source, so a potentiometer can't be observed. What a device reveals is watched:
+
+    - state: umanager, direct or unresponsive, from :meth:`Connection.probe` (a single carriage return) every interval
+    - fset: a number of a currently selected filter set (1-4), from an uManager filter listing; a listing takes a whole uManager session, so it is read only when asked for (see :meth:`request_listing`), after a reset and when an image programmed over a connection changes
+
+    A device answering again after being unresponsive, or leaving uManager on its own, has most likely been power cycled: a reset event is emitted and settings remembered by a connection shadow are forgotten (see :meth:`Connection.refresh` to restore them).
+
+    A probe is sent only when a connection has been idle for quiet seconds and no operation is running, so commands of other threads are not delayed by more than a single probe.
+
+    :param conn: connection to watch; may be used by other threads meanwhile
+    :param interval: seconds between probes
+    :param quiet: seconds a connection must be idle before a probe
+    :param callback: callable invoked with each event from a monitor thread
+
+    Usage::
+
+    >>> monitor = dam1021.Monitor(conn,interval=2)
+    >>> monitor.start()
+    >>> for event in monitor.events():
+    ...     print(event)
+    """
+
+    def __init__(self,conn,interval=1.0,quiet=0.5,callback=None):
+        self.conn = conn
+        self.interval = interval
+        self.quiet = quiet
+        self.callback = callback
+        self.status = dict(state=None,fset=None)
+        self.probes = 0
+        self.skipped = 0
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = None
+        self._own_activity = None
+        self._listing_due = False
+        self._image = conn.image_sha
+
+    def request_listing(self):
+        """Makes the next poll read a currently selected filter set too."""
+
+        self._listing_due = True
+
+    def start(self):
+        """Starts watching in a background thread."""
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,name='dam1021-monitor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops watching; :meth:`events` generators end."""
+
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self._queue.put(None)
+
+    def events(self,timeout=None):
+        """Generates events until a monitor stops or no event comes for timeout seconds."""
+
+        while True:
+            try:
+                #a bounded wait keeps a consumer interruptible on Python 2
+                event = self._queue.get(timeout=timeout or 1.0)
+            except queue.Empty:
+                if timeout is None and self._thread is not None:
+                    continue
+                return
+            if event is None:
+                return
+            yield event
+
+    def _idle(self):
+        last = self.conn.last_activity
+        return last is None or last == self._own_activity or _monotonic() - last >= self.quiet
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            while not self._idle() and not self._stop.is_set():
+                self.skipped += 1
+                self._stop.wait(self.quiet)
+            if self._stop.is_set() or not self.conn.lock.acquire(False):
+                continue
+            try:
+                self.poll()
+            except Exception as e:
+                log.error(e)
+            finally:
+                self._own_activity = self.conn.last_activity
+                self.conn.lock.release()
+
+    def poll(self,listing=False):
+        """Probes a device once (and lists its filters when due) and reports changes.
+
+        :param listing: read a currently selected filter set regardless
+        :returns: list of :class:`StatusEvent` tuples
+        """
+
+        conn = self.conn
+        events = []
+        with conn.lock:
+            believed = conn.umanager_opened
+            state = conn.probe()
+            self.probes += 1
+            previous = self.status['state']
+
+            if state == 'direct' and believed:
+                #uManager left without us
+                conn.umanager_opened = False
+            elif state == 'umanager':
+                conn.umanager_opened = True
+            elif state == 'unresponsive':
+                conn.umanager_opened = None
+
+            if previous is not None and state != previous:
+                events.append(self._change('state',state))
+                if previous == 'unresponsive' or (previous == 'umanager' and believed and state == 'direct'):
+                    conn.invalidate('volume','input','fset')
+                    events.append(StatusEvent('reset',None,None,time.time()))
+                    #a device starts with a filter set from flash
+                    self._listing_due = True
+            elif previous is None:
+                self.status['state'] = state
+
+            due = listing or self._listing_due or conn.image_sha != self._image
+            if state != 'unresponsive' and due:
+                self._listing_due = False
+                self._image = conn.image_sha
+                banks = list(conn.filter_catalogue(current=True,refresh=True).banks)
+                fset = banks[0] if len(banks) == 1 else None
+                if fset != self.status['fset']:
+                    if self.status['fset'] is not None:
+                        if conn.shadow is not None and conn.shadow.get('fset') not in (None,FSET_EXT_NUM_TO_INT_D.get(str(fset))):
+                            conn.invalidate('fset')
+                        events.append(self._change('fset',fset))
+                    else:
+                        self.status['fset'] = fset
+
+        for event in events:
+            log.info("{0.field}: {0.old} -> {0.new}".format(event))
+            self._queue.put(event)
+            if hasattr(self.callback,'__call__'):
+                self.callback(event)
+
+        return events
+
+    def _change(self,field,value):
+        event = StatusEvent(field,self.status[field],value,time.time())
+        self.status[field] = value
+        return event
+
+
+class _DaemonHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in iter(self.rfile.readline,b''):
+            try:
+                request = json.loads(line.decode('utf-8'))
+                response = self.server.daemon.handle(request)
+            except ValueError as e:
+                response = dict(result=None,error=[22,"Malformed request: {}".format(e)])
+            self.wfile.write((json.dumps(response)+'\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class _DaemonServer(socketserver.ThreadingMixIn,socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon(object):
+    """Owns a connection and serves it to clients over a Unix domain socket. Requests are executed one by one by a single :class:`Worker`, so clients never interleave on a serial line; direct commands go ahead of waiting uManager commands and downloads.
+
+    An uManager session is kept open between requests and closed after a period of inactivity.
+
+    A socket is accessible to its owner only.
+
+    The protocol is line based JSON. A request is ``{"method": name, "args": [...], "kwargs": {...}}`` where a name is one of :attr:`methods`, or ``device`` returning a served device path; download data are passed base64 encoded as ``"data"``. A ``deadline`` keyword argument (seconds) limits a wait for a response. A response is ``{"result": value, "error": null}`` or ``{"result": null, "error": [code, message]}``.
+
+    :param conn: connection to serve
+    :param path: socket path
+    :param idle_timeout: seconds of inactivity after which an uManager session is closed
+    :param request_timeout: seconds a request without a deadline may wait for a response (a download of a large image included)
+    """
+
+    methods = ('download','set_current_volume_level','set_flash_volume_level','set_mode','set_input_source',
+               'set_current_filter_set','set_flash_filter_set','list_current_filter_set','list_all_filters')
+
+    def __init__(self,conn,path=DEFAULT_DAEMON_SOCKET,idle_timeout=5.0,request_timeout=3600.0):
+        self.conn = conn
+        self.path = os.path.expanduser(path)
+        self.idle_timeout = idle_timeout
+        self.request_timeout = request_timeout
+        self.worker = None
+        self.server = None
+
+    def handle(self,request):
+        """Queues a request and waits for its response."""
+
+        method = request.get('method')
+        if method == 'device':
+            return dict(result=self.conn.device,error=None)
+        if method not in self.methods:
+            return dict(result=None,error=[22,"Unsupported request: {}".format(method)])
+        args = list(request.get('args',[]))
+        if method == 'download':
+            args.insert(0,base64.b64decode(request.get('data','')))
+        kwargs = dict((str(key),value) for key,value in request.get('kwargs',{}).items())
+        kwargs.pop('priority',None)
+
+        try:
+            result = self.worker.submit(method,*args,**kwargs).result(self.request_timeout)
+        except Dam1021Error as e:
+            return dict(result=None,error=list(e.args[:2]))
+        except Exception as e:
+            return dict(result=None,error=[None,str(e)])
+        return dict(result=result,error=None)
+
+    def serve_forever(self):
+        """Serves requests until :meth:`shutdown` is called."""
+
+        if os.path.exists(self.path):
+            try:
+                Client(self.path).close()
+            except socket.error:
+                os.remove(self.path)
+            else:
+                raise Dam1021Error(20,"Daemon already running at {}".format(self.path))
+
+        #a socket is created by bind(), so a umask is the only way to keep other users out from the start
+        umask = os.umask(0o177)
+        try:
+            self.server = _DaemonServer(self.path,_DaemonHandler)
+        finally:
+            os.umask(umask)
+        self.server.daemon = self
+        self.worker = Worker(self.conn,self.idle_timeout)
+        log.info("Serving {} at {}".format(self.conn.device,self.path))
+        try:
+            self.server.serve_forever()
+        finally:
+            self.worker.close()
+            self.server.server_close()
+            os.remove(self.path)
+
+    def shutdown(self):
+        """Stops serving. Safe to call from another thread."""
+
+        if self.server:
+            self.server.shutdown()
+
+
+class Client(object):
+    """Talks to a :class:`Daemon`. Provides the same command methods as :class:`Connection`.
+
+    :param path: daemon socket path
+    """
+
+    def __init__(self,path=DEFAULT_DAEMON_SOCKET):
+        self.path = os.path.expanduser(path)
+        self.sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        try:
+            self.sock.connect(self.path)
+        except socket.error:
+            self.sock.close()
+            raise
+        self.rfile = self.sock.makefile('rb')
+
+    @property
+    def device(self):
+        """A device served by a daemon."""
+
+        return self.call('device')
+
+    def __getattr__(self,name):
+        if name not in Daemon.methods:
+            raise AttributeError(name)
+        return partial(self.call,name)
+
+    def call(self,method,*args,**kwargs):
+        """Executes a method of a daemon connection.
+
+        :returns: a method result
+        """
+
+        request = dict(method=method,args=list(args),kwargs=kwargs)
+        if method == 'download':
+            data = args[0].read() if hasattr(args[0],'read') else args[0]
+            request['data'] = base64.b64encode(data).decode('ascii')
+            request['args'] = list(args[1:])
+        self.sock.sendall((json.dumps(request)+'\n').encode('utf-8'))
+        line = self.rfile.readline()
+        if not line:
+            raise Dam1021Error(21,"Daemon closed connection")
+        response = json.loads(line.decode('utf-8'))
+        if response['error']:
+            raise Dam1021Error(*response['error'])
+        return response['result']
+
+    def list_current_filter_set(self,raw=False,refresh=False):
+        """User to list a currently selected filter set"""
+
+        return self._list('list_current_filter_set',raw,refresh)
+
+    def list_all_filters(self,raw=False,refresh=False):
+        """User to list all available filters"""
+
+        return self._list('list_all_filters',raw,refresh)
+
+    def _list(self,method,raw,refresh):
+        rv = buf = self.call(method,raw=True,refresh=refresh)
+        if not raw:
+            rv, buf = _organize_filters(rv)
+        log.info(buf)
+        return rv
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+class Shell(cmd.Cmd):
+    """Runs commands typed by a user or read from a script over a single open connection. A duration of every command is printed.
+
+    An uManager session is kept open across consecutive uManager commands (flash settings, downloads, listings); a direct command closes it.
+
+    :param conn: connection to use (a :class:`Connection` or a :class:`Client`)
+    :param stop_on_error: ignore commands following a failed one
+    :param stdin: command source [default: sys.stdin]
+    :param stdout: output [default: sys.stdout]
+    :param library: :class:`ImageLibrary` to look up images not found as files
+
+    Usage::
+
+    >>> shell = dam1021.Shell(conn)
+    >>> shell.run_script(['flash_volume -20','mode normal','volume -30'])
+    """
+
+    prompt = 'dam1021> '
+    intro = 'Type help or ? to list commands.'
+
+    def __init__(self,conn,stop_on_error=False,stdin=None,stdout=None,library=None):
+        cmd.Cmd.__init__(self,stdin=stdin,stdout=stdout)
+        self.conn = conn
+        self.library = library
+        self.stop_on_error = stop_on_error
+        self.failed = False
+
+    def preloop(self):
+        if hasattr(self.conn,'umanager_holds'):
+            self.conn.umanager_holds += 1
 
-        return rv, '\n'.join(rbuf)
+    def postloop(self):
+        if hasattr(self.conn,'umanager_holds'):
+            self.conn.umanager_holds -= 1
+            self.conn._release_umanager()
 
+    def run_script(self,lines):
+        """Runs commands one per line. Empty lines and lines starting with # are skipped.
+
+        :returns: False if a command failed
+        """
+
+        self.preloop()
+        try:
+            for line in lines:
+                if self.onecmd(self.precmd(line.strip())) or (self.failed and self.stop_on_error):
+                    break
+        finally:
+            self.postloop()
+        return not self.failed
+
+    def precmd(self,line):
+        return '' if line.lstrip().startswith('#') else line
+
+    def emptyline(self):
+        pass
+
+    def default(self,line):
+        raise Dam1021Error(26,"Unknown command: {}".format(line))
+
+    def onecmd(self,line):
+        if not line.strip():
+            return False
+        start = _monotonic()
+        try:
+            stop = cmd.Cmd.onecmd(self,line)
+        except (Dam1021Error,ValueError,IndexError,IOError,serial.SerialException) as e:
+            self.failed = True
+            self.stdout.write('{}: failed, {:.1f} ms: {}\n'.format(line,(_monotonic()-start)*1e3,e))
+            return False
+        if not stop:
+            self.stdout.write('{}: ok, {:.1f} ms\n'.format(line,(_monotonic()-start)*1e3))
+        return stop
+
+    def do_volume(self,arg):
+        """volume LEVEL: set a current volume level"""
+        self.conn.set_current_volume_level(int(arg))
+
+    def do_flash_volume(self,arg):
+        """flash_volume LEVEL: set a volume level on flash"""
+        self.conn.set_flash_volume_level(int(arg))
+
+    def do_input(self,arg):
+        """input SOURCE: set input source"""
+        self.conn.set_input_source(int(arg))
+
+    def do_filter(self,arg):
+        """filter SET: set a current filter set (by a number or a name)"""
+        self.conn.set_current_filter_set(arg.strip())
+
+    def do_flash_filter(self,arg):
+        """flash_filter SET: set a default filter set on flash"""
+        self.conn.set_flash_filter_set(arg.strip())
+
+    def do_mode(self,arg):
+        """mode MODE: select mode of operation"""
+        self.conn.set_mode(arg.strip())
+
+    def do_download(self,arg):
+        """download IMAGE [--1k] [--force]: download a new firmware or filter set (a file or an image from a library)"""
+        self._download(shlex.split(arg),False)
+
+    def do_update(self,arg):
+        """update IMAGE [--1k]: download a new firmware and update uManager"""
+        self._download(shlex.split(arg),True)
+
+    def _download(self,args,um_update):
+        paths = [ entry for entry in args if not entry.startswith('--') ]
+        if len(paths) != 1:
+            raise Dam1021Error(26,"Exactly one file expected")
+        with _open_image(paths[0],self.library) as f:
+            self.conn.download(f,um_update,block_size=1024 if '--1k' in args else None,force='--force' in args)
+
+    def do_list(self,arg):
+        """list [all|current] [--refresh]: show all available filters or a currently selected filter set"""
+        args = shlex.split(arg)
+        what = [ entry for entry in args if not entry.startswith('--') ] or ['all']
+        if what[0] == 'all':
+            self.conn.list_all_filters(refresh='--refresh' in args)
+        elif what[0] == 'current':
+            self.conn.list_current_filter_set(refresh='--refresh' in args)
+        else:
+            raise Dam1021Error(26,"Unknown listing: {}".format(what[0]))
+
+    def do_exit(self,arg):
+        """exit: leave a shell"""
+        return True
+
+    do_quit = do_EOF = do_exit
+
+
+def _open_image(key,library=None):
+    """Opens an image given by a path or, if there is no such file, by a name or a checksum from a library."""
+
+    if library is None or os.path.exists(key):
+        return open(key,'rb')
+    return library.open(key)
+
+def _interval(value):
+    """Parses a positive number of seconds given on a command line."""
+
+    from argparse import ArgumentTypeError
+
+    try:
+        rv = float(value)
+    except ValueError:
+        raise ArgumentTypeError("invalid number of seconds: {}".format(value))
+    if not rv > 0:
+        raise ArgumentTypeError("an interval must be positive: {}".format(value))
+    return rv
 
 def run():
     from argparse import ArgumentParser,FileType
@@ -452,18 +3110,62 @@ def run():
 
     parser.add_argument("-v", "--verbose", help="increase output verbosity",action="store_true")
     parser.add_argument("-V","--Version", action="version", version="%(prog)s {}".format(__version__))
-    parser.add_argument("-s", "--serial-device", dest="serial",
-                        help="serial device to use [default: {}]".format(DEFAULT_SERIAL_DEVICE),
-                        default=DEFAULT_SERIAL_DEVICE)
+    parser.add_argument("-s", "--serial-device", dest="serial", action="append", nargs="+",
+                        help="serial device to use; several devices or wildcards (e.g. '/dev/ttyUSB*') run a command on all of them in parallel [default: {}]".format(DEFAULT_SERIAL_DEVICE))
+    parser.add_argument("--stats", nargs="?", const="prometheus", choices=("prometheus","json"),
+                        help="print timings and counters of a run [default format: prometheus]")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="maximum number of devices served at once [default: 8]")
+    parser.add_argument("--deadline", type=float,
+                        help="time in seconds a command may take on all devices")
     parser.add_argument("-t", "--timeout",
                         help="serial read timeout to use in seconds [default: {}]".format(DEFAULT_SERIAL_TIMEOUT),
                         default=DEFAULT_SERIAL_TIMEOUT,type=float)
+    parser.add_argument("--1k", dest="xmodem1k", action="store_true",
+                        help="use XMODEM-1K blocks for downloads, falls back to 128 byte blocks if not supported")
+    parser.add_argument("--hash-cache",
+                        help="file recording images programmed into devices, an empty string disables it [default: {}]".format(DEFAULT_HASH_CACHE),
+                        default=DEFAULT_HASH_CACHE)
+    parser.add_argument("--catalogue-cache",
+                        help="file keeping filter listings of images programmed into devices, an empty string disables it [default: {}]".format(DEFAULT_CATALOGUE_CACHE),
+                        default=DEFAULT_CATALOGUE_CACHE)
+    parser.add_argument("--library",
+                        help="index of local images [default: {}]".format(DEFAULT_IMAGE_LIBRARY),
+                        default=DEFAULT_IMAGE_LIBRARY)
+    parser.add_argument("--no-check", dest="check", action="store_false",
+                        help="download data even if they do not look like an image")
+    parser.add_argument("--refresh", action="store_true",
+                        help="list filters from a device even if a listing is cached")
+    parser.add_argument("--force", action="store_true",
+                        help="download even if an image is already programmed")
+    parser.add_argument("--shadow", action="store_true",
+                        help="skip commands that would not change settings confirmed earlier (useful with --serve)")
+    parser.add_argument("--reconnect", action="store_true",
+                        help="reopen a device lost to a reset or a USB re-enumeration and retry a command; with --shadow runtime settings are restored too")
+    parser.add_argument("--socket",
+                        help="daemon socket; commands are sent to a daemon if one is running [default: {}]".format(DEFAULT_DAEMON_SOCKET),
+                        default=DEFAULT_DAEMON_SOCKET)
     group = parser.add_mutually_exclusive_group(required=True)
 
-    group.add_argument("-d","--download", help="download a new firmware or filter set",
-                       type=FileType('rb'))
-    group.add_argument("-u","--download-and-update", help="download a new firmware and update uManager",
-                       type=FileType('rb'))
+    group.add_argument("--serve", action="store_true",
+                       help="run as a daemon owning a serial device and serving commands over a socket")
+    group.add_argument("--shell", action="store_true",
+                       help="run commands typed interactively over a single connection")
+    group.add_argument("--script", type=FileType('r'),
+                       help="run commands from a file (one per line, see --shell) over a single connection; stops at the first failure")
+
+    group.add_argument("-d","--download", metavar="IMAGE",
+                       help="download a new firmware or filter set (a file, or a name or a checksum of an image in a library)")
+    group.add_argument("-u","--download-and-update", metavar="IMAGE",
+                       help="download a new firmware and update uManager")
+    group.add_argument("--inspect", metavar="FILE",
+                       help="check whether a file may be a dam1021 image, no device needed")
+    group.add_argument("--add-image", metavar="FILE",
+                       help="check an image and add it to a library")
+    group.add_argument("--images", action="store_true",
+                       help="list images in a library")
+    group.add_argument("--watch", metavar="SECONDS", type=_interval, nargs="?", const=1.0,
+                       help="report changes of a device state until interrupted, probing every SECONDS [default: 1]")
 
     group.add_argument("--mode", 
                        help="select mode of operation [{}]".format(','.join(OPMODES)),
@@ -500,29 +3202,69 @@ def run():
     else:
         log.level = logging.INFO
 
+    library = ImageLibrary(args.library)
+    if args.inspect or args.add_image or args.images:
+        return _run_library(args,library)
+    args.library = library
+
+    devices = expand_devices([ device for devices in args.serial for device in devices ]) if args.serial else [DEFAULT_SERIAL_DEVICE]
+    if len(devices) > 1 or (args.serial and not devices):
+        return _run_fleet(args,devices)
+    args.serial = devices[0]
+
+    metrics = Metrics() if args.stats else None
+    status = 1
+
     try:
-        conn = Connection(args.serial,args.timeout)
+        conn = None
+        if not args.serve and os.path.exists(os.path.expanduser(args.socket)):
+            try:
+                conn = Client(args.socket)
+                served = conn.device
+            except (socket.error,Dam1021Error):
+                served = None
+            #a daemon serving another device is left alone
+            if served is not None and _same_device(served,args.serial):
+                log.debug("Using daemon at {}".format(args.socket))
+                if metrics is not None:
+                    log.warning("Statistics are collected by a daemon process only")
+            elif conn is not None:
+                conn.close()
+                conn = None
+        if conn is None:
+            conn = Connection(args.serial,args.timeout,hash_cache=HashCache(args.hash_cache),shadow=args.shadow,
+                              catalogue_cache=CatalogueCache(args.catalogue_cache),metrics=metrics,
+                              auto_reconnect=args.reconnect,reapply=args.reconnect)
         try:
-            if args.download:
-                conn.download(args.download.read())
-            elif args.download_and_update:
-                conn.download(args.download_and_update.read(),True)
-            elif args.volume_level:
-                conn.set_current_volume_level(int(args.volume_level))
-            elif args.flash_volume_level:
-                conn.set_flash_volume_level(int(args.flash_volume_level))
-            elif args.input_source:
-                conn.set_input_source(int(args.input_source))
-            elif args.filter_set:
-                conn.set_current_filter_set(args.filter_set)
-            elif args.default_filter_set:
-                conn.set_flash_filter_set(args.default_filter_set)
-            elif args.current_filter_set:
-                conn.list_current_filter_set()
-            elif args.all_filters:
-                conn.list_all_filters()
-            elif args.mode:
-                conn.set_mode(args.mode)
+            if args.serve:
+                import signal
+                signal.signal(signal.SIGTERM,lambda signum,frame: sys.exit(0))
+                Daemon(conn,args.socket).serve_forever()
+            elif args.watch is not None:
+                if not isinstance(conn,Connection):
+                    raise Dam1021Error(29,"A device is owned by a daemon, stop it to watch a device")
+                monitor = Monitor(conn,args.watch)
+                monitor.request_listing()
+                monitor.start()
+                try:
+                    for event in monitor.events():
+                        print('{} {}: {} -> {}'.format(time.strftime('%H:%M:%S',time.localtime(event.time)),event.field,event.old,event.new))
+                finally:
+                    monitor.stop()
+            elif args.shell:
+                Shell(conn,library=library).cmdloop()
+            elif args.script:
+                if Shell(conn,stop_on_error=True,library=library).run_script(args.script):
+                    status = 0
+            else:
+                _cli_call(lambda method,*cargs,**ckwargs: getattr(conn,method)(*cargs,**ckwargs),args)
+                status = 0
+            if args.serve or args.watch is not None or args.shell:
+                status = 0
+        except KeyboardInterrupt:
+            #the way to stop a daemon, a monitor or a shell
+            if args.serve or args.watch is not None or args.shell:
+                status = 0
         except Exception as e:
             log.error(e)
         finally:
@@ -530,5 +3272,100 @@ def run():
     except Exception as e:
         log.error(e)
 
+    _print_stats(args,metrics)
+    return status
+
+def _same_device(a,b):
+    if a == b:
+        return True
+    try:
+        return os.path.samefile(a,b)
+    except OSError:
+        return False
+
+def _run_library(args,library):
+    try:
+        if args.inspect:
+            with open(args.inspect,'rb') as f:
+                info = inspect_image(f)
+            print('{0.name}: {0.size:d} bytes, SHA-1 {0.sha1}, kind {0.kind}'.format(info))
+            for problem in info.problems:
+                print('  {}'.format(problem))
+            return 1 if info.problems else 0
+        elif args.add_image:
+            info = library.add(args.add_image)
+            print('{0.name}: {0.size:d} bytes, SHA-1 {0.sha1}, kind {0.kind}'.format(info))
+        else:
+            for sha1,entry in sorted(library.entries.items(),key=lambda item: item[1]['name']):
+                print('{} {:>9d} {:<9s} {} ({})'.format(sha1[:12],entry['size'],entry['kind'],entry['name'],entry['path']))
+    except (Dam1021Error,IOError,OSError) as e:
+        log.error(e)
+        return 1
+    return 0
+
+def _run_fleet(args,devices):
+    if args.serve or args.shell or args.script or args.watch is not None:
+        log.error("A daemon, a shell or a monitor serves a single device")
+        return 1
+    if not devices:
+        log.error("No serial device found")
+        return 1
+
+    metrics = Metrics() if args.stats else None
+    failed = 0
+    with Fleet(devices,args.workers,args.deadline,timeout=args.timeout,hash_cache=HashCache(args.hash_cache),
+               catalogue_cache=CatalogueCache(args.catalogue_cache),metrics=metrics,auto_reconnect=args.reconnect) as fleet:
+        for result in _cli_call(fleet.call,args):
+            if result.error:
+                failed += 1
+                log.error("{}: {} ({:.3f} s)".format(result.device,result.error,result.seconds))
+            else:
+                log.info("{}: done ({:.3f} s)".format(result.device,result.seconds))
+    _print_stats(args,metrics)
+    return 1 if failed else 0
+
+def _print_stats(args,metrics):
+    if metrics is None:
+        return
+    print(metrics.json() if args.stats == 'json' else metrics.prometheus())
+
+def _cli_call(call,args):
+    """Runs a command given on a command line as call(method,*args,**kwargs). An image to download is closed afterwards."""
+
+    method, cargs, ckwargs = _cli_command(args)
+    if method != 'download':
+        return call(method,*cargs,**ckwargs)
+    with _open_image(cargs[0],args.library) as f:
+        return call(method,f,*cargs[1:],**ckwargs)
+
+def _cli_command(args):
+    """Translates parsed command-line arguments into a connection method call. An image to download is given by a key for :func:`_open_image`.
+
+    :returns: tuple of a method name, positional and keyword arguments
+    """
+
+    block_size = 1024 if args.xmodem1k else None
+
+    if args.download:
+        return 'download', (args.download,), dict(force=args.force,block_size=block_size,check=args.check)
+    elif args.download_and_update:
+        return 'download', (args.download_and_update,True), dict(block_size=block_size,check=args.check)
+    elif args.volume_level:
+        return 'set_current_volume_level', (int(args.volume_level),), {}
+    elif args.flash_volume_level:
+        return 'set_flash_volume_level', (int(args.flash_volume_level),), {}
+    elif args.input_source:
+        return 'set_input_source', (int(args.input_source),), {}
+    elif args.filter_set:
+        return 'set_current_filter_set', (args.filter_set,), {}
+    elif args.default_filter_set:
+        return 'set_flash_filter_set', (args.default_filter_set,), {}
+    elif args.current_filter_set:
+        return 'list_current_filter_set', (), dict(refresh=args.refresh)
+    elif args.all_filters:
+        return 'list_all_filters', (), dict(refresh=args.refresh)
+    elif args.mode:
+        return 'set_mode', (args.mode,), {}
+
 if __name__ == "__main__":
-    run()
+    sys.exit(run())
@@ -0,0 +1,554 @@
+# -*- coding: utf-8 -*-
+
+"""asyncio interface to a dam1021. AsyncConnection mirrors dam1021.Connection with awaitable commands, so a single event loop may serve other requests while a DAC is busy (e.g. during a filter upload). Requires Python 3.5+ and a POSIX platform."""
+
+__author__ = "Forta(a)"
+__copyright__ = "Copyright 2015, Forta(a)"
+
+__license__ = "GPL 3.0"
+
+import asyncio
+import binascii
+import io
+import logging
+import socket
+
+#not included in std python library
+import serial
+
+import dam1021
+from dam1021 import Dam1021Error, DownloadStats, _endswith, _contains, _fset_lookup, _stream_sha1, _validate_image, _HashingReader, _remaining, _BlockSizeRejected
+
+log=logging.getLogger('dam1021.aio')
+
+SOH = b'\x01'
+STX = b'\x02'
+EOT = b'\x04'
+ACK = b'\x06'
+NAK = b'\x15'
+CAN = b'\x18'
+
+
+def _deadline(method):
+    """Decorates a command so it accepts a per-call deadline keyword argument (seconds)."""
+
+    async def wrapper(self,*args,deadline=None,**kwargs):
+        if deadline is None:
+            return await method(self,*args,**kwargs)
+        return await asyncio.wait_for(method(self,*args,**kwargs),deadline)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class AsyncConnection(object):
+    """Creates object for asynchronous serial communication with a DAC. Commands are serialised, so concurrent tasks may share a connection.
+
+    Every command accepts a ``deadline`` keyword argument (seconds); :exc:`asyncio.TimeoutError` is raised when it expires. A cancelled or expired command leaves uManager state unknown, so the next uManager command starts with a fresh handshake.
+
+    :param device: serial device to use, or socket://host:port (rfc2217:// can't be attached to an event loop)
+    :param timeout: default timeout for serial communication
+    :param cautious: additional safeguards for non umanager command
+    :param hash_cache: :class:`dam1021.HashCache` used to skip downloads of an image already programmed
+
+    Usage::
+
+    >>> import asyncio, dam1021_aio
+    >>> async def main():
+    ...     async with dam1021_aio.AsyncConnection('/dev/ttyS0') as conn:
+    ...         await conn.set_current_volume_level(-14,deadline=1)
+    ...         await conn.download(open('newfilter.skr','rb'))
+    >>> asyncio.get_event_loop().run_until_complete(main())
+    """
+
+    def __init__(self,device=dam1021.DEFAULT_SERIAL_DEVICE,timeout=dam1021.DEFAULT_SERIAL_TIMEOUT,cautious=False,hash_cache=None):
+        self.cautious = cautious
+        self.timeout = timeout
+        self.device = device
+        self.device_id = dam1021.device_identity(device)
+        self.hash_cache = hash_cache
+
+        #cmdlist
+        self.cmd_umanager_invocation = '+++'
+        self.cmd_umanager_termination = 'exit'
+        self.cmd_download = 'download'
+        self.cmd_flash_volume = 'set volume={:+03d}'
+        self.cmd_current_volume = 'V{:+03d}'
+        self.cmd_input_selection = 'I{:d}'
+        self.cmd_update = 'update'
+        self.cmd_mode = 'set mode={:s}'
+        self.cmd_current_fset = 'F{:d}'
+        self.cmd_flash_fset = 'set filter={:s}'
+        self.cmd_current_filter_list = 'filters'
+        self.cmd_all_filter_list = 'filters all'
+
+        #internal stuff
+        self.cr = '\r'
+        self.umanager_prompt = b'# '
+        self.umanager_errtxt = b'invalid command'
+        self.umanager_opened = False
+        self.umanager_holds = 0
+        self.buf_on_exit = b'\r\n'
+        self.umanager_waitcoeff = 1.5
+        self.volume_inf = dam1021.VOLUME_INF
+        self.volume_sup = dam1021.VOLUME_SUP
+        self.volume_pot = dam1021.VOLUME_POT
+        self.fset_str_d = dam1021.FSET_EXT_STR_TO_INT_D
+        self.fset_num_d = dam1021.FSET_EXT_NUM_TO_INT_D
+        self.opmodes = dam1021.OPMODES
+        self.input_src_set = dam1021.INPUT_SRC_SET
+        self.xmodem_crc = b'C'
+        self.xmodem_block_size = 128
+        self.xmodem_retry = 16
+        self.xmodem_timeout = 60
+        self.resync_tries = 3
+        self.resync_quiet = 0.2
+        self.reprogram_ack = b'programmed'
+        self.update_confirmation = b'umanager firmware update, are you sure ? '
+        self.update_ack = 'y'
+        self.update_reset = b'updated, reset'
+        self.download_stats = None
+
+        self.ser = None
+        self._loop = None
+        self._rbuf = bytearray()
+        self._readable = None
+        self._lock = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self,exc_type,exc_value,traceback):
+        await self.close()
+
+    async def open(self):
+        """Opens a serial port and attaches it to a running event loop."""
+
+        self._loop = asyncio.get_event_loop()
+        self._readable = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self.ser = serial.serial_for_url(self.device,115200,timeout=0)
+        sock = getattr(self.ser,'_socket',None)
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        self._loop.add_reader(self.ser.fileno(),self._on_readable)
+        log.debug("Serial port opened")
+
+    def _on_readable(self):
+        try:
+            chunk = self.ser.read(self.ser.in_waiting or 1)
+        except serial.SerialException as e:
+            log.error(e)
+            self._loop.remove_reader(self.ser.fileno())
+            chunk = b''
+        if chunk:
+            self._rbuf.extend(chunk)
+            self._readable.set()
+
+    def _write(self,data):
+        if not isinstance(data,(bytes,bytearray)):
+            data = data.encode('ascii')
+        self.ser.write(data)
+
+    async def read_loop(self,exit_condition,timeout):
+        """Waits until data received satisfy an exit condition or a timeout expires.
+
+        :returns: tuple of a result and data received (bytes)
+        """
+
+        buf = bytearray()
+        rv = False
+        deadline = self._loop.time() + timeout
+        while True:
+            if self._rbuf:
+                buf.extend(self._rbuf)
+                del self._rbuf[:]
+                if exit_condition(buf):
+                    rv = True
+                    break
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                break
+            self._readable.clear()
+            try:
+                await asyncio.wait_for(self._readable.wait(),remaining)
+            except asyncio.TimeoutError:
+                pass
+
+        buf = bytes(buf)
+        log.debug(buf.__repr__())
+        return rv, buf
+
+    async def _getc(self,timeout):
+        if not self._rbuf:
+            rv = (await self.read_loop(lambda x: True,timeout))[1]
+            self._rbuf[:0] = rv
+        if not self._rbuf:
+            return None
+        c = bytes(self._rbuf[:1])
+        del self._rbuf[:1]
+        return c
+
+    async def _locked(self,coro):
+        async with self._lock:
+            try:
+                return await coro
+            except asyncio.CancelledError:
+                #a response may still be on its way
+                self.umanager_opened = None
+                del self._rbuf[:]
+                raise
+
+    async def close(self):
+        """Closes serial port"""
+
+        if self.ser is None:
+            return
+        try:
+            await self.close_umanager()
+        finally:
+            self._loop.remove_reader(self.ser.fileno())
+            self.ser.close()
+            self.ser = None
+            log.debug("Serial port closed")
+
+    #uManager session
+
+    async def _open_umanager(self):
+        if self.umanager_opened:
+            return
+        self._write(self.cmd_umanager_invocation)
+        rv = (await self.read_loop(_endswith(self.umanager_prompt),self.timeout*self.umanager_waitcoeff))[0]
+        if not rv:
+            self._write(self.cr)
+            rv = (await self.read_loop(_endswith(self.umanager_prompt),self.timeout))[0]
+        if not rv:
+            raise Dam1021Error(1,"Failed to open uManager")
+        self.umanager_opened = True
+        log.debug("uManager opened")
+
+    async def _close_umanager(self,force=False):
+        if not (force or self.umanager_opened or self.umanager_opened is None):
+            return
+        self._write(self.cr)
+        if (await self.read_loop(_endswith(self.umanager_prompt),self.timeout))[0]:
+            self._write(''.join((self.cmd_umanager_termination,self.cr)))
+            if (await self.read_loop(_endswith(self.buf_on_exit),self.timeout))[0]:
+                log.debug("uManager closed")
+            else:
+                raise Dam1021Error(2,"Failed to close uManager")
+        else:
+            log.debug("uManager already closed")
+        self.umanager_opened = False
+
+    async def _release_umanager(self):
+        if not self.umanager_holds:
+            await self._close_umanager()
+
+    async def _leave_umanager(self):
+        if self.cautious:
+            await self._close_umanager(True)
+        elif self.umanager_opened or self.umanager_opened is None:
+            await self._close_umanager()
+
+    async def _umanager_command(self,cmd):
+        self._write(''.join((cmd,self.cr)))
+        rv, buf = await self.read_loop(_endswith(self.umanager_prompt),self.timeout)
+        if not rv:
+            #no prompt, a session state is unknown
+            self.umanager_opened = None
+        return buf.lower().find(self.umanager_errtxt) == -1
+
+    @_deadline
+    async def open_umanager(self):
+        """Used to open an uManager session."""
+
+        await self._locked(self._open_umanager())
+
+    @_deadline
+    async def close_umanager(self,force=False):
+        """Used to close an uManager session.
+
+        :param force: try to close a session regardless of a connection object internal state
+        """
+
+        await self._locked(self._close_umanager(force))
+
+    def session(self):
+        """Keeps an uManager session open within an ``async with`` block, so consecutive flash commands share a single session."""
+
+        return _Session(self)
+
+    #direct commands
+
+    async def _direct_command(self,cmd):
+        await self._leave_umanager()
+        for _ in range(2):
+            self._write(''.join((cmd,self.cr)))
+            if (await self.read_loop(_endswith(cmd.encode('ascii'),True),self.timeout))[0]:
+                return True
+        return False
+
+    @_deadline
+    async def set_current_volume_level(self,level):
+        """Used to set current volume level. Not to be confused with a volume level stored in flash."""
+
+        if level != self.volume_pot and not (self.volume_inf <= level <= self.volume_sup):
+            raise Dam1021Error(6,"Forbbiden volume level")
+        if not await self._locked(self._direct_command(self.cmd_current_volume.format(level))):
+            raise Dam1021Error(7,"Failed to set current volume level")
+        log.info("Current volume level set to {0:d}".format(level))
+
+    @_deadline
+    async def set_input_source(self,input_src):
+        """Used to set input source for a DAC."""
+
+        if input_src not in self.input_src_set:
+            raise Dam1021Error(9,"Forbbiden input source")
+        if not await self._locked(self._direct_command(self.cmd_input_selection.format(input_src))):
+            raise Dam1021Error(10,"Failed to set input source")
+        log.info("Input source set to {0:d}".format(input_src))
+
+    @_deadline
+    async def set_current_filter_set(self,fset):
+        """Used to set current filter set."""
+
+        ftype = _fset_lookup(fset,self.fset_num_d,self.fset_str_d)[0]
+        if not await self._locked(self._direct_command(self.cmd_current_fset.format(ftype))):
+            raise Dam1021Error(12,"Failed to change filter set")
+        log.info("Current filter set is {0}".format(fset))
+
+    #flash commands
+
+    async def _flash_command(self,cmd):
+        await self._open_umanager()
+        try:
+            return await self._umanager_command(cmd)
+        finally:
+            await self._release_umanager()
+
+    @_deadline
+    async def set_flash_volume_level(self,level):
+        """Used to set volume level on flash. Not to be confused with current volume level."""
+
+        if level != self.volume_pot and not (self.volume_inf <= level <= self.volume_sup):
+            raise Dam1021Error(6,"Forbbiden volume level")
+        if not await self._locked(self._flash_command(self.cmd_flash_volume.format(level))):
+            raise Dam1021Error(8,"Failed to set flash volume level")
+        log.info("Flash volume level set to {0:d}".format(level))
+
+    @_deadline
+    async def set_mode(self,opmode):
+        """Used to set mode of operation."""
+
+        if opmode not in self.opmodes:
+            raise Dam1021Error(15,"Forbbiden mode")
+        if not await self._locked(self._flash_command(self.cmd_mode.format(opmode))):
+            raise Dam1021Error(8,"Failed to set flash volume level")
+        log.info("Mode of operation set to {0:s}".format(opmode))
+
+    @_deadline
+    async def set_flash_filter_set(self,fset):
+        """Used to set a default filter set on flash. Also changes current filter set."""
+
+        name = _fset_lookup(fset,self.fset_num_d,self.fset_str_d)[1]
+        if not await self._locked(self._flash_command(self.cmd_flash_fset.format(name))):
+            raise Dam1021Error(18,"Failed to set default filter set")
+        log.info("Default filter set changed to {0}".format(fset))
+
+    async def _list(self,cmd):
+        await self._open_umanager()
+        try:
+            self._write(''.join((cmd,self.cr)))
+            rv, buf = await self.read_loop(_endswith(self.umanager_prompt),self.timeout)
+            if not rv:
+                self.umanager_opened = None
+                return None
+            return buf.rstrip()[:-1].decode('ascii','replace')
+        finally:
+            await self._release_umanager()
+
+    @_deadline
+    async def list_current_filter_set(self,raw=False):
+        """User to list a currently selected filter set"""
+
+        buf = await self._locked(self._list(self.cmd_current_filter_list))
+        if buf is None:
+            raise Dam1021Error(16,"Failed to list currently selected filter set")
+        return buf if raw else dam1021._organize_filters(buf)[0]
+
+    @_deadline
+    async def list_all_filters(self,raw=False):
+        """User to list all available filters"""
+
+        buf = await self._locked(self._list(self.cmd_all_filter_list))
+        if buf is None:
+            raise Dam1021Error(17,"Failed to list all available filters")
+        return buf if raw else dam1021._organize_filters(buf)[0]
+
+    #download
+
+    async def _xmodem_send(self,stream,block_size,progress=None):
+        """Sends a stream via XMODEM (CRC mode). The receiver start request has to be consumed already.
+
+        :returns: tuple of a :class:`dam1021._HashingReader` and :class:`dam1021.DownloadStats`, None if a transfer failed
+        """
+
+        reader = _HashingReader(stream)
+        total = _remaining(stream)
+        header = STX if block_size == 1024 else SOH
+        sequence = 1
+        blocks = retransmits = 0
+        started = self._loop.time()
+
+        while True:
+            data = reader.read(block_size)
+            if not data:
+                break
+            data = data.ljust(block_size,b'\x1a')
+            crc = binascii.crc_hqx(data,0)
+            packet = b''.join((header,bytes((sequence,0xff-sequence)),data,bytes((crc >> 8,crc & 0xff))))
+            errors = 0
+            while True:
+                self._write(packet)
+                c = await self._getc(self.xmodem_timeout)
+                if c == ACK:
+                    break
+                #a device answering the very first 1K block with NAK or CAN doesn't take 1K blocks
+                if block_size == 1024 and not blocks and c in (NAK,CAN):
+                    raise _BlockSizeRejected()
+                if c == CAN or errors >= self.xmodem_retry:
+                    self._write(CAN*2)
+                    return None
+                errors += 1
+                retransmits += 1
+            blocks += 1
+            if progress is not None:
+                progress(min(blocks*block_size,reader.size),total,retransmits)
+            sequence = (sequence + 1) % 0x100
+
+        for _ in range(self.xmodem_retry):
+            self._write(EOT)
+            if await self._getc(self.xmodem_timeout) == ACK:
+                break
+        else:
+            return None
+
+        elapsed = self._loop.time() - started
+        return reader, DownloadStats(reader.size,blocks,retransmits,elapsed,reader.size/elapsed if elapsed else 0.0,1,0.0)
+
+    async def _drain(self,quiet,timeout):
+        """Drops incoming data until a line is quiet for a while or a timeout expires."""
+
+        deadline = self._loop.time() + timeout
+        while self._loop.time() < deadline:
+            if not (await self.read_loop(lambda x: True,quiet))[1]:
+                break
+
+    async def _resync_umanager(self):
+        """Cancels a receiver still waiting for data and brings an uManager prompt back."""
+
+        self._write(CAN*2)
+        #a cancellation left over on a command line is cleared by an empty command
+        await self._drain(self.resync_quiet,self.timeout*self.umanager_waitcoeff)
+        for _ in range(self.resync_tries):
+            self._write(self.cr)
+            if (await self.read_loop(_endswith(self.umanager_prompt),self.timeout))[0]:
+                await self._drain(self.resync_quiet,self.timeout)
+                return
+        self.umanager_opened = None
+        raise Dam1021Error(4,"Error during file download")
+
+    async def _download(self,stream,um_update,block_size,progress):
+        block_size = block_size or self.xmodem_block_size
+        try:
+            start = stream.tell()
+        except (AttributeError,IOError,OSError,ValueError):
+            start = None
+
+        await self._open_umanager()
+        while True:
+            self._write(''.join((self.cmd_download,self.cr)))
+            if not (await self.read_loop(_endswith(self.xmodem_crc),self.timeout))[0]:
+                raise Dam1021Error(3,"uManager is not ready to accept a data")
+            try:
+                sent = await self._xmodem_send(stream,block_size,progress)
+                break
+            except _BlockSizeRejected:
+                #data not seekable can't be sent again
+                if start is None:
+                    self._write(CAN*2)
+                    raise Dam1021Error(4,"Error during file download")
+                log.info("1K blocks rejected, falling back to 128 byte blocks")
+                block_size = 128
+                await self._resync_umanager()
+                stream.seek(start)
+        if sent is None:
+            raise Dam1021Error(4,"Error during file download")
+        reader, self.download_stats = sent
+        log.info("Data sent: {0.bytes} bytes in {0.blocks} blocks, {0.retransmits} retransmissions, {0.rate:.0f} bytes/s".format(self.download_stats))
+
+        if not (await self.read_loop(_contains(self.reprogram_ack),self.timeout))[0]:
+            raise Dam1021Error(5,"uManager accepted data and not reprogrammed")
+        skr_sum = reader.sha1.hexdigest()
+        log.info("File downloaded. Data SHA-1 checksum: {}".format(skr_sum))
+
+        if um_update:
+            self._write(''.join((self.cmd_update,self.cr)))
+            if not (await self.read_loop(_contains(self.update_confirmation),self.timeout*self.umanager_waitcoeff))[0]:
+                raise Dam1021Error(13,"Error during update command invocation")
+            self._write(self.update_ack)
+            if not (await self.read_loop(_contains(self.update_reset),self.timeout*self.umanager_waitcoeff))[0]:
+                raise Dam1021Error(14,"Update failed")
+            self.umanager_opened = False
+            log.info("uManager updated")
+        else:
+            await self._release_umanager()
+
+        return skr_sum
+
+    @_deadline
+    async def download(self,data,um_update=False,block_size=None,progress=None,force=False,check=True):
+        """Used to download firmware or filter set. See :meth:`dam1021.Connection.download`; a progress callback is called from an event loop."""
+
+        stream = data if hasattr(data,'read') else io.BytesIO(data)
+        cache = self.hash_cache
+        info = _validate_image(stream,um_update) if check else None
+
+        if cache is not None and not (force or um_update):
+            skr_sum = info.sha1 if info is not None else _stream_sha1(stream)
+            if skr_sum is not None and skr_sum == cache.get(self.device_id):
+                log.info("Data already programmed, download skipped. Data SHA-1 checksum: {}".format(skr_sum))
+                self.download_stats = None
+                return skr_sum
+
+        try:
+            skr_sum = await self._locked(self._download(stream,um_update,block_size,progress))
+        except BaseException:
+            if cache is not None:
+                cache.invalidate(self.device_id)
+            raise
+
+        if cache is not None:
+            if um_update:
+                cache.invalidate(self.device_id)
+            else:
+                cache.set(self.device_id,skr_sum)
+
+        return skr_sum
+
+
+class _Session(object):
+
+    def __init__(self,conn):
+        self.conn = conn
+
+    async def __aenter__(self):
+        self.conn.umanager_holds += 1
+        return self.conn
+
+    async def __aexit__(self,exc_type,exc_value,traceback):
+        self.conn.umanager_holds -= 1
+        if not self.conn.umanager_holds:
+            await self.conn.close_umanager()
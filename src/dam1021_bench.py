@@ -0,0 +1,462 @@
+# -*- coding: utf-8 -*-
+
+"""Latency and throughput benchmarks of the dam1021 module run against a simulated device (see dam1021_sim). Results may be stored as a baseline and compared with later runs."""
+
+__author__ = "Forta(a)"
+__copyright__ = "Copyright 2015, Forta(a)"
+
+__license__ = "GPL 3.0"
+
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import dam1021
+import dam1021_sim
+
+log=logging.getLogger('dam1021.bench')
+
+PERCENTILES = (50,90,99)
+
+
+def percentile(samples,pct):
+    """Returns a nearest-rank percentile of samples."""
+
+    ordered = sorted(samples)
+    rank = max(0,int(round(pct/100.0*len(ordered)+0.5))-1)
+    return ordered[min(rank,len(ordered)-1)]
+
+
+def measure(func,iterations):
+    """Calls func a number of times and returns a list of durations in seconds."""
+
+    samples = []
+    for _ in range(iterations):
+        start = time.time()
+        func()
+        samples.append(time.time()-start)
+    return samples
+
+
+def provisioning(conn):
+    """A typical provisioning sequence run in a single uManager session."""
+
+    with conn.session(stop_on_error=True) as batch:
+        batch.set_mode('normal')
+        batch.set_flash_filter_set('linear')
+        batch.set_flash_volume_level(-20)
+        batch.list_all_filters()
+    for result in batch.results:
+        if result.error:
+            raise result.error
+
+
+def scene(conn):
+    """Switches input, filter set and volume one command at a time."""
+
+    conn.set_input_source(1)
+    conn.set_current_filter_set('mixed')
+    conn.set_current_volume_level(-20)
+
+
+def scene_pipelined(conn):
+    """Switches input, filter set and volume in a single pipeline."""
+
+    for result in conn.pipeline([('input',1),('fset','mixed'),('volume',-20)]):
+        if result.error:
+            raise result.error
+
+
+def cases(conn):
+    """Returns a list of (name, callable) benchmark cases."""
+
+    return [
+        ('set_current_volume_level', lambda: conn.set_current_volume_level(-20)),
+        ('set_input_source', lambda: conn.set_input_source(1)),
+        ('set_current_filter_set', lambda: conn.set_current_filter_set('mixed')),
+        ('set_flash_volume_level', lambda: conn.set_flash_volume_level(-20)),
+        ('set_mode', lambda: conn.set_mode('normal')),
+        ('set_flash_filter_set', lambda: conn.set_flash_filter_set('linear')),
+        ('list_current_filter_set', lambda: conn.list_current_filter_set()),
+        ('list_all_filters', lambda: conn.list_all_filters()),
+        ('list_all_filters_refresh', lambda: conn.list_all_filters(refresh=True)),
+        ('session', lambda: provisioning(conn)),
+        ('scene', lambda: scene(conn)),
+        ('scene_pipelined', lambda: scene_pipelined(conn)),
+    ]
+
+
+class PollingConnection(dam1021.Connection):
+    """A connection reading responses the way read_loop did before it returned on the first match: fixed readsize chunks, each read blocking for a whole 0.25 s poll."""
+
+    poll = 0.25
+
+    def read_loop(self,exit_condition,timeout,callback=None):
+        buf = bytearray()
+        rv = False
+        while timeout > 0:
+            buf.extend(self.transport.read(self.readsize,self.poll))
+            if exit_condition(buf):
+                rv = True
+                break
+            timeout -= self.poll
+        self.failures = 0 if rv else self.failures + 1
+        self._sent_at = None
+        buf = bytes(buf)
+        if hasattr(callback,'__call__'):
+            callback(rv,buf,exit_condition)
+        return rv
+
+
+def read_loops(iterations=5,delay=0.002,baudrate=115200):
+    """Compares command latencies with a polling read loop (see :class:`PollingConnection`) and the incremental one of :class:`dam1021.Connection`, reproducing the before/after table of the read_loop rework.
+
+    :returns: dict of a command -> dict of median durations in seconds (polling, incremental)
+    """
+
+    commands = [
+        ('V (current volume)', lambda conn: conn.set_current_volume_level(-20)),
+        ('I (input)', lambda conn: conn.set_input_source(1)),
+        ('F (filter set)', lambda conn: conn.set_current_filter_set('mixed')),
+        ('set volume (flash)', lambda conn: conn.set_flash_volume_level(-20)),
+        ('filters all', lambda conn: conn.list_all_filters(refresh=True)),
+    ]
+    results = dict((name,dict()) for name,_ in commands)
+
+    with dam1021_sim.Simulator(delay=delay,baudrate=baudrate) as sim:
+        for variant,factory in (('polling',PollingConnection),('incremental',dam1021.Connection)):
+            conn = factory(sim.port)
+            try:
+                for name,func in commands:
+                    results[name][variant] = percentile(measure(lambda: func(conn),iterations),50)
+            finally:
+                conn.close()
+
+    return results
+
+
+def knob(steps=50,step_interval=0.02,delay=0.03,baudrate=115200):
+    """Emulates a rotary encoder turned one step at a time against a slower device.
+
+    :returns: dict with a lag in seconds between the last step and its application by a FIFO worker (every step sent) and by :class:`dam1021.Scheduler` (coalesced)
+    """
+
+    levels = [ -80 + i % 80 for i in range(steps) ]
+    results = dict()
+
+    with dam1021_sim.Simulator(delay=delay,baudrate=baudrate) as sim:
+        conn = dam1021.Connection(sim.port)
+        try:
+            requests = queue.Queue()
+            done = threading.Event()
+            def fifo():
+                while True:
+                    level = requests.get()
+                    if level is None:
+                        break
+                    conn.set_current_volume_level(level)
+                done.set()
+            worker = threading.Thread(target=fifo)
+            worker.start()
+            for level in levels:
+                requests.put(level)
+                time.sleep(step_interval)
+            last = time.time()
+            requests.put(None)
+            done.wait()
+            results['fifo'] = time.time() - last
+            worker.join()
+
+            sched = dam1021.Scheduler(conn)
+            for level in levels:
+                sched.submit('volume',level)
+                time.sleep(step_interval)
+            last = time.time()
+            sched.close()
+            results['coalesced'] = time.time() - last
+            assert sched.applied['volume'] == levels[-1]
+        finally:
+            conn.close()
+
+    return results
+
+
+def contention(image_size=8192,delay=0.002,baudrate=115200):
+    """Changes a volume level while a download runs and another download and a listing wait, once through a FIFO worker (a connection behind a global lock) and once through :class:`dam1021.Worker`.
+
+    :returns: dict with seconds from a volume change request to its completion
+    """
+
+    image = os.urandom(image_size)
+    results = dict()
+
+    with dam1021_sim.Simulator(delay=delay,baudrate=baudrate) as sim:
+        conn = dam1021.Connection(sim.port)
+        try:
+            requests = queue.Queue()
+            def fifo():
+                for func in iter(requests.get,None):
+                    func()
+            thread = threading.Thread(target=fifo)
+            thread.start()
+            done = threading.Event()
+            for func in (lambda: conn.download(image),lambda: conn.download(image),lambda: conn.list_all_filters(refresh=True)):
+                requests.put(func)
+            time.sleep(0.1)
+            start = time.time()
+            requests.put(lambda: (conn.set_current_volume_level(-20),done.set()))
+            done.wait()
+            results['fifo'] = time.time() - start
+            requests.put(None)
+            thread.join()
+
+            worker = dam1021.Worker(conn)
+            for args in (('download',image),('download',image),('list_all_filters',)):
+                worker.submit(*args)
+            time.sleep(0.1)
+            start = time.time()
+            worker.set_current_volume_level(-21).result()
+            results['worker'] = time.time() - start
+            worker.close()
+        finally:
+            conn.close()
+
+    return results
+
+
+def session_states(iterations=5,delay=0.002,baudrate=115200,latency=0.0):
+    """Measures opening and closing an uManager session for each state a device may start in, by a connection that does not know the state (and one that does, direct_known). Also measures a direct command sent by a cautious connection.
+
+    :returns: dict of a starting state -> median duration in seconds (a failure to open a session included)
+    """
+
+    results = dict()
+
+    with dam1021_sim.Simulator(delay=delay,baudrate=baudrate,latency=latency) as sim:
+        conn = dam1021.Connection(sim.port)
+        try:
+            #name, device state, connection state (None: unknown)
+            for state,umanager,silent,known in (('direct',False,False,None),('direct_known',False,False,False),
+                                                ('umanager',True,False,None),('unresponsive',False,True,None)):
+                samples = []
+                for _ in range(iterations):
+                    sim.umanager = umanager
+                    sim.silent = silent
+                    conn.umanager_opened = known
+                    start = time.time()
+                    try:
+                        conn.open_umanager()
+                        conn.close_umanager()
+                    except dam1021.Dam1021Error:
+                        pass
+                    samples.append(time.time()-start)
+                results[state] = percentile(samples,50)
+            sim.umanager = sim.silent = False
+            conn.cautious = True
+            results['cautious_direct'] = percentile(measure(lambda: conn.set_current_volume_level(-20),iterations),50)
+        finally:
+            sim.silent = False
+            conn.close()
+
+    return results
+
+
+def recovery(image_size=16384,delay=0.002,baudrate=115200,corrupt=0.02):
+    """Downloads an image over a noisy line (a share of damaged blocks) whose first transfer is cut off.
+
+    :returns: dict of download statistics (see :class:`dam1021.DownloadStats`) and a total duration in seconds
+    """
+
+    image = os.urandom(image_size)
+
+    with dam1021_sim.Simulator(delay=delay,baudrate=baudrate) as sim:
+        conn = dam1021.Connection(sim.port)
+        try:
+            sim.corrupt = corrupt
+            sim.abort_downloads = 1
+            start = time.time()
+            conn.download(image)
+            results = dict(conn.download_stats._asdict())
+            results['total'] = time.time() - start
+        finally:
+            conn.close()
+
+    return results
+
+
+def transports(iterations=20,delay=0.002,baudrate=115200,connections=5):
+    """Compares a pseudo-terminal with the same device exported over TCP (socket://), and connections opened one after another with and without a :class:`dam1021.TransportPool`.
+
+    :returns: dict of a case -> median duration in seconds
+    """
+
+    results = dict()
+
+    with dam1021_sim.Simulator(delay=delay,baudrate=baudrate) as sim:
+        conn = dam1021.Connection(sim.port)
+        try:
+            results['pty_volume'] = percentile(measure(lambda: conn.set_current_volume_level(-20),iterations),50)
+        finally:
+            conn.close()
+
+        url = sim.listen()
+        conn = dam1021.Connection(url)
+        try:
+            results['tcp_volume'] = percentile(measure(lambda: conn.set_current_volume_level(-20),iterations),50)
+        finally:
+            conn.close()
+
+        def connect(pool=None):
+            conn = dam1021.Connection(url,pool=pool)
+            conn.set_current_volume_level(-20)
+            conn.close()
+
+        results['tcp_connect'] = percentile(measure(connect,connections),50)
+        pool = dam1021.TransportPool()
+        try:
+            results['tcp_connect_pooled'] = percentile(measure(lambda: connect(pool),connections),50)
+        finally:
+            pool.close()
+
+    return results
+
+
+def outage(duration=0.5,delay=0.002,baudrate=115200,boot_time=0.2):
+    """Unplugs a simulated device (reached through a stable link, as /dev/serial/by-id provides) and plugs it back after a while, then changes a volume level over a connection with auto_reconnect enabled.
+
+    :returns: dict with seconds a command took, time to recover reported by a connection and an outage duration
+    """
+
+    link = os.path.join(tempfile.mkdtemp(),'dam1021')
+
+    with dam1021_sim.Simulator(delay=delay,baudrate=baudrate,link=link,boot_time=boot_time) as sim:
+        conn = dam1021.Connection(sim.port,auto_reconnect=True,shadow=True,reapply=True)
+        try:
+            conn.set_input_source(1)
+            sim.unplug()
+            threading.Timer(duration,sim.replug).start()
+            start = time.time()
+            conn.set_current_volume_level(-20)
+            results = dict(command=time.time()-start,recovery=conn.recovery_time,outage=duration)
+            assert sim.input_src == 1
+        finally:
+            conn.close()
+    os.rmdir(os.path.dirname(link))
+
+    return results
+
+
+def run_suite(iterations=20,delay=0.002,baudrate=115200,image_size=32768,latency=0.0):
+    """Runs all benchmark cases against a fresh simulator.
+
+    :returns: dict with per-case latency percentiles in seconds and download throughput (128 byte and 1K blocks) in bytes/s
+    """
+
+    results = dict(params=dict(iterations=iterations,delay=delay,baudrate=baudrate,image_size=image_size,latency=latency),latency=dict())
+    image = os.urandom(image_size)
+
+    with dam1021_sim.Simulator(delay=delay,baudrate=baudrate,latency=latency) as sim:
+        conn = dam1021.Connection(sim.port)
+        try:
+            for name,func in cases(conn):
+                samples = measure(func,iterations)
+                results['latency'][name] = dict(('p{}'.format(pct),percentile(samples,pct)) for pct in PERCENTILES)
+                results['latency'][name]['max'] = max(samples)
+            for name,block_size in (('download',128),('download_1k',1024)):
+                samples = measure(lambda: conn.download(image,block_size=block_size),max(1,iterations//10))
+                results[name] = dict(bytes=image_size,seconds=min(samples),rate=image_size/min(samples))
+        finally:
+            conn.close()
+
+    results['knob'] = knob(baudrate=baudrate)
+    results['read_loops'] = read_loops(max(1,iterations//4),delay,baudrate)
+    results['contention'] = contention(delay=delay,baudrate=baudrate)
+    results['session_states'] = session_states(max(1,iterations//4),delay,baudrate,latency)
+    results['recovery'] = recovery(delay=delay,baudrate=baudrate)
+    results['transports'] = transports(iterations,delay,baudrate)
+    results['outage'] = outage(delay=delay,baudrate=baudrate)
+
+    return results
+
+
+def report(results,baseline=None):
+    """Formats results as a table, optionally with a ratio of the median to a baseline median."""
+
+    rbuf = ['{:<26s} {:>9s} {:>9s} {:>9s} {:>9s}{}'.format('case','p50 ms','p90 ms','p99 ms','max ms',' vs base' if baseline else '')]
+    for name,entry in sorted(results['latency'].items()):
+        line = '{:<26s} {:9.2f} {:9.2f} {:9.2f} {:9.2f}'.format(name,entry['p50']*1e3,entry['p90']*1e3,entry['p99']*1e3,entry['max']*1e3)
+        if baseline and name in baseline.get('latency',{}):
+            line += ' {:7.2f}x'.format(entry['p50']/baseline['latency'][name]['p50'])
+        rbuf.append(line)
+    for name in ('download','download_1k'):
+        download = results.get(name)
+        if not download:
+            continue
+        line = '{}: {:d} bytes in {:.3f} s, {:.0f} bytes/s'.format(name,download['bytes'],download['seconds'],download['rate'])
+        if baseline and name in baseline:
+            line += ' ({:.2f}x baseline)'.format(download['rate']/baseline[name]['rate'])
+        rbuf.append(line)
+    for name,entry in sorted(results.get('read_loops',{}).items()):
+        rbuf.append('{:<20s} {:.3f} s polling read loop, {:.3f} s incremental'.format(name,entry['polling'],entry['incremental']))
+    if 'knob' in results:
+        rbuf.append('volume knob lag: {:.3f} s every step, {:.3f} s coalesced'.format(results['knob']['fifo'],results['knob']['coalesced']))
+    if 'contention' in results:
+        rbuf.append('volume change behind downloads: {:.3f} s FIFO, {:.3f} s worker'.format(results['contention']['fifo'],results['contention']['worker']))
+    if 'recovery' in results:
+        rbuf.append('noisy download: {0[attempts]:d} attempts, {0[retransmits]:d} retransmissions, {0[recovery]:.3f} s lost to recovery, {0[total]:.3f} s total'.format(results['recovery']))
+    if 'outage' in results:
+        rbuf.append('device lost for {0[outage]:.3f} s: recovered in {0[recovery]:.3f} s, command took {0[command]:.3f} s'.format(results['outage']))
+    for case,seconds in sorted(results.get('transports',{}).items()):
+        line = '{}: {:.2f} ms'.format(case,seconds*1e3)
+        if baseline and case in baseline.get('transports',{}):
+            line += ' ({:.2f}x baseline)'.format(seconds/baseline['transports'][case])
+        rbuf.append(line)
+    for state,seconds in sorted(results.get('session_states',{}).items()):
+        line = 'uManager open/close from {}: {:.3f} s'.format(state,seconds)
+        if baseline and state in baseline.get('session_states',{}):
+            line += ' ({:.2f}x baseline)'.format(seconds/baseline['session_states'][state])
+        rbuf.append(line)
+    return '\n'.join(rbuf)
+
+
+def run():
+    from argparse import ArgumentParser
+
+    logging.basicConfig()
+
+    parser = ArgumentParser(description="Benchmarks the dam1021 module against a simulated device.")
+    parser.add_argument("-n", "--iterations", type=int, default=20, help="iterations per case [default: 20]")
+    parser.add_argument("--delay", type=float, default=0.002, help="simulated response delay in seconds [default: 0.002]")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated response transit time in seconds [default: 0]")
+    parser.add_argument("--baudrate", type=int, default=115200, help="simulated line speed, 0 for unlimited [default: 115200]")
+    parser.add_argument("--image-size", type=int, default=32768, help="size of a downloaded image in bytes [default: 32768]")
+    parser.add_argument("--save", help="store results as a JSON baseline")
+    parser.add_argument("--baseline", help="compare results with a stored JSON baseline")
+
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = run_suite(args.iterations,args.delay,args.baudrate,args.image_size,args.latency)
+    print(report(results,baseline))
+
+    if args.save:
+        with open(args.save,'w') as f:
+            json.dump(results,f,indent=2,sort_keys=True)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(run())
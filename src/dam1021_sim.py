@@ -0,0 +1,468 @@
+# -*- coding: utf-8 -*-
+
+"""A simulated dam1021 attached to a pseudo-terminal. It speaks the subset of the protocol used by the dam1021 module and is meant for benchmarking and regression testing without real hardware."""
+
+__author__ = "Forta(a)"
+__copyright__ = "Copyright 2015, Forta(a)"
+
+__license__ = "GPL 3.0"
+
+import binascii
+import collections
+import hashlib
+import logging
+import os
+import pty
+import random
+import select
+import socket
+import threading
+import time
+import tty
+
+log=logging.getLogger('dam1021.sim')
+
+SOH = b'\x01'
+STX = b'\x02'
+EOT = b'\x04'
+ACK = b'\x06'
+NAK = b'\x15'
+CAN = b'\x18'
+CRC = b'C'
+
+#filter set number (as used by F command) -> name (as used by set filter=)
+FSETS = {4:'linear',5:'mixed',6:'minimum',7:'soft'}
+
+DEFAULT_FILTERS = [
+    (4,'linear phase, 0.1dB ripple, 120dB attenuation'),
+    (5,'mixed phase, 0.1dB ripple, 120dB attenuation'),
+    (6,'minimum phase, 0.1dB ripple, 120dB attenuation'),
+    (7,'soft knee, 0.5dB ripple, 100dB attenuation'),
+    (8,'linear phase, 0.1dB ripple, 120dB attenuation'),
+    (9,'mixed phase, 0.1dB ripple, 120dB attenuation'),
+    (10,'minimum phase, 0.1dB ripple, 120dB attenuation'),
+    (11,'soft knee, 0.5dB ripple, 100dB attenuation'),
+    (12,'iir 44.1kHz, 0.01dB ripple'),
+    (13,'iir 48kHz, 0.01dB ripple'),
+]
+
+
+class Simulator(object):
+    """Emulates a dam1021 on a pseudo-terminal. Use :attr:`port` as a serial device of a :class:`dam1021.Connection`.
+
+    :param delay: time in seconds a device needs to respond to a command (the device is busy meanwhile)
+    :param latency: time in seconds a response spends in transit, e.g. in a USB-serial adapter (the device is not blocked)
+    :param baudrate: emulated line speed; 0 disables throttling
+    :param filters: list of (type, description) tuples reported by the filters commands
+    :param onek: whether the XMODEM receiver accepts 1K blocks
+    :param link: path of a symbolic link to a pseudo-terminal, used as :attr:`port`; it survives :meth:`unplug` and :meth:`replug` like a /dev/serial/by-id name of a USB adapter does
+    :param boot_time: seconds a device ignores input after a reset
+
+    :meth:`listen` also exports a device over TCP, as a terminal server (e.g. ser2net) does.
+
+    Usage::
+
+    >>> import dam1021, dam1021_sim
+    >>> with dam1021_sim.Simulator(delay=0.005) as sim:
+    ...     conn = dam1021.Connection(sim.port)
+    ...     conn.set_current_volume_level(-14)
+    ...     conn.close()
+    """
+
+    def __init__(self,delay=0.0,baudrate=115200,filters=DEFAULT_FILTERS,onek=True,latency=0.0,link=None,boot_time=0.0):
+        self.delay = delay
+        self.latency = latency
+        self.baudrate = baudrate
+        self.filters = list(filters)
+        self.onek = onek
+
+        #device state
+        self.umanager = False
+        self.volume = -20
+        self.input_src = 0
+        self.fset = 4
+        self.flash_volume = -20
+        self.flash_fset = 4
+        self.mode = 'normal'
+        self.images = []
+        self.commands = []
+        #a silent device swallows input without answering
+        self.silent = False
+        #line errors: a probability a download block is damaged, a number of next downloads cut off after two blocks
+        self.corrupt = 0.0
+        self.abort_downloads = 0
+        self.boot_time = boot_time
+        self._booted_at = 0.0
+
+        self.link = link
+        self.plugged = False
+        self._plug()
+
+        self._rbuf = bytearray()
+        self._line = bytearray()
+        self._running = False
+        self._thread = None
+        self._outq = collections.deque()
+        self._outcond = threading.Condition()
+        self._writer = None
+        self._listener = None
+        self._bridge = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self,*exc):
+        self.stop()
+
+    def start(self):
+        """Starts serving a pseudo-terminal in a background thread."""
+
+        self._running = True
+        self._thread = threading.Thread(target=self._serve,name='dam1021-sim')
+        self._thread.daemon = True
+        self._thread.start()
+        if self.latency:
+            self._writer = threading.Thread(target=self._write_delayed,name='dam1021-sim-link')
+            self._writer.daemon = True
+            self._writer.start()
+
+    def _plug(self):
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        tty.setraw(self.master)
+        self.tty = self.port = os.ttyname(self.slave)
+        if self.link:
+            tmp = self.link + '.tmp'
+            os.symlink(self.tty,tmp)
+            os.rename(tmp,self.link)
+            self.port = self.link
+        self.plugged = True
+
+    def unplug(self):
+        """Emulates a device (or its USB adapter) disappearing: a pseudo-terminal is closed, an open port fails."""
+
+        self.plugged = False
+        fds, self.master, self.slave = (self.master,self.slave), -1, -1
+        for fd in fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        if self.link and os.path.lexists(self.link):
+            os.remove(self.link)
+        del self._rbuf[:]
+
+    def replug(self):
+        """Brings a device back on a new pseudo-terminal (a link points to it) after a power cycle."""
+
+        self._plug()
+        self.reset()
+
+    def stop(self):
+        """Stops a simulator and closes a pseudo-terminal."""
+
+        self._running = False
+        with self._outcond:
+            self._outcond.notify_all()
+        for thread in (self._thread,self._writer,self._bridge):
+            if thread:
+                thread.join()
+        if self._listener:
+            self._listener.close()
+        if self.plugged:
+            self.unplug()
+
+    def listen(self,host='127.0.0.1',port=0):
+        """Serves a device to a single TCP client at a time; a simulator has to be started first. A pseudo-terminal must not be used meanwhile.
+
+        :returns: pyserial URL of a device (socket://host:port)
+        """
+
+        self._listener = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        self._listener.bind((host,port))
+        self._listener.listen(1)
+        self._bridge = threading.Thread(target=self._serve_tcp,name='dam1021-sim-tcp')
+        self._bridge.daemon = True
+        self._bridge.start()
+        return 'socket://{}:{:d}'.format(*self._listener.getsockname()[:2])
+
+    def _serve_tcp(self):
+        while self._running:
+            if not select.select([self._listener],[],[],0.1)[0]:
+                continue
+            client = self._listener.accept()[0]
+            client.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+            try:
+                self._relay(client)
+            except (select.error,socket.error,OSError,ValueError) as e:
+                #a device unplugged, a terminal server drops its client
+                log.debug(e)
+            finally:
+                client.close()
+
+    def _relay(self,client):
+        while self._running:
+            for fd in select.select([client,self.slave],[],[],0.1)[0]:
+                if fd is client:
+                    data = client.recv(4096)
+                    if not data:
+                        return
+                    os.write(self.slave,data)
+                else:
+                    client.sendall(os.read(self.slave,4096))
+
+    def reset(self):
+        """Emulates a power cycle: runtime settings revert to flash values."""
+
+        self.umanager = False
+        self.volume = self.flash_volume
+        self.fset = self.flash_fset
+        self.input_src = 0
+        del self._line[:]
+        self._booted_at = time.time() + self.boot_time
+
+    #low level i/o
+
+    def _throttle(self,size):
+        if self.baudrate:
+            time.sleep(size*10.0/self.baudrate)
+
+    def _fill(self,timeout):
+        if not self.plugged:
+            time.sleep(timeout)
+            return False
+        try:
+            #short waits, so stop() and unplug() are noticed
+            if not select.select([self.master],[],[],min(timeout,0.1))[0]:
+                return False
+            chunk = os.read(self.master,4096)
+        except (select.error,OSError,ValueError):
+            return False
+        self._throttle(len(chunk))
+        self._rbuf.extend(chunk)
+        return bool(chunk)
+
+    def _getc(self,size=1,timeout=0.1):
+        deadline = time.time() + timeout
+        while len(self._rbuf) < size:
+            remaining = deadline - time.time()
+            #an unplugged device drops whatever it was receiving
+            if remaining <= 0 or not self._running or not self.plugged:
+                return None
+            self._fill(remaining)
+        data = bytes(self._rbuf[:size])
+        del self._rbuf[:size]
+        return data
+
+    def _put(self,data):
+        if not isinstance(data,bytes):
+            data = data.encode('ascii')
+        if self.latency:
+            with self._outcond:
+                self._outq.append((time.time()+self.latency,data))
+                self._outcond.notify()
+            return
+        self._throttle(len(data))
+        try:
+            os.write(self.master,data)
+        except OSError:
+            pass
+
+    def _write_delayed(self):
+        while self._running:
+            with self._outcond:
+                if not self._outq:
+                    self._outcond.wait(0.1)
+                    continue
+                due, data = self._outq[0]
+                if due > time.time():
+                    self._outcond.wait(due-time.time())
+                    continue
+                self._outq.popleft()
+            self._throttle(len(data))
+            try:
+                os.write(self.master,data)
+            except OSError:
+                pass
+
+    def _respond(self,data):
+        if self.delay:
+            time.sleep(self.delay)
+        self._put(data)
+
+    def _serve(self):
+        while self._running:
+            if not self.plugged:
+                time.sleep(0.05)
+                continue
+            c = self._getc(1,0.05)
+            if c is None or self.silent or time.time() < self._booted_at:
+                continue
+            if self.umanager:
+                self._umanager_char(c)
+            else:
+                self._direct_char(c)
+
+    #direct command mode
+
+    def _direct_char(self,c):
+        if c in b'\r\n':
+            line = bytes(self._line).decode('ascii','replace')
+            del self._line[:]
+            self.commands.append(line)
+            self._direct_command(line)
+            return
+        self._line.extend(c)
+        if self._line.endswith(b'+++'):
+            del self._line[:]
+            self.umanager = True
+            self.commands.append('+++')
+            self._respond('\r\nuManager\r\n# ')
+
+    def _direct_command(self,line):
+        try:
+            cmd, val = line[:1], int(line[1:])
+        except ValueError:
+            cmd, val = None, None
+        if cmd == 'V' and (-80 <= val <= 10 or val == -99):
+            self.volume = val
+        elif cmd == 'I' and 0 <= val <= 3:
+            self.input_src = val
+        elif cmd == 'F' and val in FSETS:
+            self.fset = val
+        self._respond(line+'\r\n')
+
+    #uManager
+
+    def _umanager_char(self,c):
+        if c in b'\r\n':
+            line = bytes(self._line).decode('ascii','replace').strip()
+            del self._line[:]
+            self.commands.append(line)
+            self._umanager_command(line)
+            return
+        self._line.extend(c)
+        self._put(c)
+
+    def _umanager_command(self,line):
+        prompt = '\r\n# '
+        if not line:
+            self._respond(prompt)
+        elif line == 'exit':
+            self.umanager = False
+            self._respond('\r\n')
+        elif line.startswith('set '):
+            key, _, val = line[4:].partition('=')
+            if key == 'volume' and val.lstrip('+-').isdigit() and (-80 <= int(val) <= 10 or int(val) == -99):
+                self.flash_volume = int(val)
+            elif key == 'mode' and val in ('normal','invert','bal-left','bal-right'):
+                self.mode = val
+            elif key == 'filter' and val in FSETS.values():
+                self.flash_fset = self.fset = [k for k,v in FSETS.items() if v == val][0]
+            else:
+                self._respond('\r\ninvalid command'+prompt)
+                return
+            self._respond(prompt)
+        elif line == 'filters':
+            self._respond(self._filter_list([self.fset,self.fset+4])+prompt)
+        elif line == 'filters all':
+            self._respond(self._filter_list()+prompt)
+        elif line == 'download':
+            self._respond('\r\n')
+            data = self._xmodem_recv()
+            if data is None:
+                self._respond('\r\ndownload failed'+prompt)
+            else:
+                self.images.append(hashlib.sha1(data).hexdigest())
+                self._respond('\r\nprogrammed'+prompt)
+        elif line == 'update':
+            self._respond('\r\numanager firmware update, are you sure ? ')
+            if self._getc(1,5) == b'y':
+                self._respond('y\r\nupdated, reset\r\n')
+                self.reset()
+            else:
+                self._respond(prompt)
+        else:
+            self._respond('\r\ninvalid command'+prompt)
+
+    def _filter_list(self,types=None):
+        lines = ['\r\n{:02d} {}'.format(eid,desc) for eid,desc in self.filters if types is None or eid in types or eid > 11]
+        return ''.join(lines)
+
+    def _xmodem_recv(self):
+        data = bytearray()
+        sequence = 1
+        for _ in range(10):
+            self._put(CRC)
+            c = self._getc(1,1)
+            if c is not None:
+                break
+        else:
+            return None
+        while True:
+            if c == EOT:
+                self._put(ACK)
+                return bytes(data).rstrip(b'\x1a')
+            elif c == STX and not self.onek:
+                while self._getc(1,0.05) is not None:
+                    pass
+                self._put(NAK)
+            elif c in (SOH,STX):
+                size = 128 if c == SOH else 1024
+                block = self._getc(size+4,2)
+                if block is None:
+                    self._put(NAK)
+                else:
+                    seq, nseq = bytearray(block[:2])
+                    payload = block[2:-2]
+                    crc = bytearray(block[-2:])
+                    if seq + nseq != 0xff or binascii.crc_hqx(payload,0) != (crc[0] << 8 | crc[1]) or random.random() < self.corrupt:
+                        self._put(NAK)
+                    elif seq == 3 and self.abort_downloads:
+                        self.abort_downloads -= 1
+                        self._put(CAN+CAN)
+                        return None
+                    elif seq == sequence:
+                        data.extend(payload)
+                        sequence = (sequence + 1) % 0x100
+                        self._respond(ACK)
+                    elif seq == (sequence - 1) % 0x100:
+                        self._put(ACK)
+                    else:
+                        self._put(CAN+CAN)
+                        return None
+            elif c == CAN:
+                return None
+            c = self._getc(1,10)
+            if c is None:
+                return None
+
+
+def run():
+    from argparse import ArgumentParser
+
+    logging.basicConfig()
+
+    parser = ArgumentParser(description="Runs a simulated dam1021 on a pseudo-terminal until interrupted.")
+    parser.add_argument("--delay", type=float, default=0.0, help="response delay in seconds [default: 0]")
+    parser.add_argument("--latency", type=float, default=0.0, help="response transit time in seconds [default: 0]")
+    parser.add_argument("--baudrate", type=int, default=115200, help="emulated line speed, 0 for unlimited [default: 115200]")
+    parser.add_argument("--tcp", metavar="PORT", type=int, help="serve a device over TCP instead of a pseudo-terminal")
+
+    args = parser.parse_args()
+
+    sim = Simulator(args.delay,args.baudrate,latency=args.latency)
+    sim.start()
+    print("Simulated dam1021 available at {}".format(sim.listen('127.0.0.1',args.tcp) if args.tcp is not None else sim.port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.stop()
+
+if __name__ == "__main__":
+    run()
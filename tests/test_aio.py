@@ -0,0 +1,73 @@
+import os
+import sys
+
+import pytest
+
+if sys.version_info < (3,5):
+    pytest.skip("dam1021_aio requires Python 3.5+",allow_module_level=True)
+
+import asyncio
+
+import dam1021
+import dam1021_aio
+import dam1021_sim
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+@pytest.fixture
+def sim():
+    with dam1021_sim.Simulator() as sim:
+        yield sim
+
+
+@pytest.fixture
+def conn(sim):
+    conn = dam1021_aio.AsyncConnection(sim.port,timeout=0.5)
+    run(conn.open())
+    yield conn
+    run(conn.close())
+
+
+@pytest.mark.parametrize('onek',[True,False])
+def test_download_falls_back_to_128_byte_blocks(onek):
+    with dam1021_sim.Simulator(onek=onek) as sim:
+        conn = dam1021_aio.AsyncConnection(sim.port,timeout=1)
+        run(conn.open())
+        try:
+            data = os.urandom(4096)
+            run(conn.download(data,check=False,block_size=1024))
+            assert conn.download_stats.blocks == (4 if onek else 32)
+            assert len(sim.images) == 1
+        finally:
+            run(conn.close())
+
+
+def test_rejected_flash_command_closes_session(sim,conn):
+    handle = sim._umanager_command
+    def reject(line):
+        if line.startswith('set volume'):
+            sim._respond('\r\ninvalid command\r\n# ')
+        else:
+            handle(line)
+    sim._umanager_command = reject
+    with pytest.raises(dam1021.Dam1021Error):
+        run(conn.set_flash_volume_level(-10))
+    assert conn.umanager_opened is False and not sim.umanager
+
+
+def test_failed_listing_closes_session(sim,conn):
+    handle = sim._umanager_command
+    def drop(line):
+        if line.startswith('filters'):
+            sim._respond('\r\n')
+        else:
+            handle(line)
+    sim._umanager_command = drop
+    with pytest.raises(dam1021.Dam1021Error):
+        run(conn.list_all_filters())
+    assert conn.umanager_opened is False and not sim.umanager
+    run(conn.set_current_volume_level(-33))
+    assert sim.volume == -33
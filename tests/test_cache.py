@@ -0,0 +1,64 @@
+import hashlib
+import os
+
+import pytest
+
+import dam1021
+import dam1021_sim
+
+
+DATA = os.urandom(4096)
+SHA1 = hashlib.sha1(DATA).hexdigest()
+
+
+@pytest.fixture
+def sim():
+    with dam1021_sim.Simulator(baudrate=0) as sim:
+        yield sim
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return dam1021.HashCache(str(tmpdir.join('hashes.json')))
+
+
+@pytest.fixture
+def conn(sim,cache):
+    conn = dam1021.Connection(sim.port,timeout=1,hash_cache=cache)
+    yield conn
+    conn.close()
+
+
+def test_same_image_is_skipped(sim,conn,cache):
+    assert conn.download(DATA,check=False) == SHA1
+    assert cache.get(conn.device_id) == SHA1
+    assert conn.download(DATA,check=False) == SHA1
+    assert conn.download_stats is None
+    assert sim.commands.count('download') == 1
+    #a record survives a process
+    assert dam1021.HashCache(cache.path).get(conn.device_id) == SHA1
+
+
+def test_force_downloads_again(sim,conn):
+    conn.download(DATA,check=False)
+    conn.download(DATA,check=False,force=True)
+    assert conn.download_stats is not None
+    assert sim.images == [SHA1,SHA1]
+
+
+def test_other_image_is_downloaded(sim,conn,cache):
+    other = os.urandom(4096)
+    conn.download(DATA,check=False)
+    conn.download(other,check=False)
+    assert cache.get(conn.device_id) == hashlib.sha1(other).hexdigest()
+    assert len(sim.images) == 2
+
+
+def test_failed_download_invalidates_record(sim,conn,cache):
+    conn.download(DATA,check=False)
+    sim.abort_downloads = 1
+    with pytest.raises(dam1021.Dam1021Error):
+        conn.download(os.urandom(4096),check=False,retries=0)
+    assert cache.get(conn.device_id) is None
+    conn.download(DATA,check=False)
+    assert sim.images == [SHA1,SHA1]
@@ -0,0 +1,20 @@
+import argparse
+import sys
+
+import pytest
+
+import dam1021
+
+
+@pytest.mark.parametrize('value',['0','-1','nan','abc'])
+def test_watch_interval_must_be_positive(value,monkeypatch):
+    monkeypatch.setattr(sys,'argv',['dam1021.py','-s','/dev/null','--watch',value])
+    with pytest.raises(SystemExit) as e:
+        dam1021.run()
+    assert e.value.code == 2
+
+
+def test_interval_parses_seconds():
+    assert dam1021._interval('0.25') == 0.25
+    with pytest.raises(argparse.ArgumentTypeError):
+        dam1021._interval('0')
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import socket
+import stat
+import threading
+import time
+
+import pytest
+
+import dam1021
+import dam1021_sim
+
+
+@pytest.fixture
+def sim():
+    with dam1021_sim.Simulator(baudrate=0) as sim:
+        yield sim
+
+
+@pytest.fixture
+def daemon(sim,tmpdir):
+    conn = dam1021.Connection(sim.port,timeout=1)
+    daemon = dam1021.Daemon(conn,str(tmpdir.join('dam1021.sock')),idle_timeout=0.2)
+    thread = threading.Thread(target=daemon.serve_forever)
+    thread.start()
+    deadline = time.time() + 5
+    while daemon.server is None or not os.path.exists(daemon.path):
+        assert time.time() < deadline
+        time.sleep(0.01)
+    yield daemon
+    daemon.shutdown()
+    thread.join(5)
+    conn.close()
+
+
+@pytest.fixture
+def client(daemon):
+    client = dam1021.Client(daemon.path)
+    yield client
+    client.close()
+
+
+def raw_request(path,request):
+    sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall((json.dumps(request)+'\n').encode('utf-8'))
+        return json.loads(sock.makefile('rb').readline().decode('utf-8'))
+    finally:
+        sock.close()
+
+
+def test_commands_reach_device(sim,daemon,client):
+    assert client.device == sim.port
+    assert client.set_current_volume_level(-33) is None
+    client.set_flash_volume_level(-12)
+    assert (sim.volume,sim.flash_volume) == (-33,-12)
+    assert set(client.list_all_filters()) == set(['FIR','IIR'])
+    assert 'iir 48kHz' in client.list_all_filters(raw=True)
+
+
+def test_download_data_are_sent_base64(sim,client):
+    data = os.urandom(3000)
+    assert client.download(data,check=False) == hashlib.sha1(data).hexdigest()
+    assert sim.images == [hashlib.sha1(data).hexdigest()]
+
+
+def test_errors_keep_their_codes(client):
+    with pytest.raises(dam1021.Dam1021Error) as e:
+        client.set_current_volume_level(50)
+    assert e.value.args[0] == 6
+    #a connection goes on after an error
+    client.set_current_volume_level(-40)
+
+
+def test_protocol_is_line_based_json(sim,daemon):
+    assert raw_request(daemon.path,dict(method='set_input_source',args=[2])) == dict(result=None,error=None)
+    assert sim.input_src == 2
+    response = raw_request(daemon.path,dict(method='close'))
+    assert response['result'] is None and response['error'][0] == 22
+    assert raw_request(daemon.path,dict(method='device')) == dict(result=sim.port,error=None)
+
+
+def test_socket_belongs_to_owner_only(daemon):
+    assert stat.S_IMODE(os.stat(daemon.path).st_mode) & 0o077 == 0
+
+
+def test_second_daemon_is_refused(sim,daemon):
+    other = dam1021.Daemon(dam1021.Connection(sim.port,timeout=1),daemon.path)
+    with pytest.raises(dam1021.Dam1021Error) as e:
+        other.serve_forever()
+    assert e.value.args[0] == 20
+    other.conn.close()
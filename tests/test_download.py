@@ -0,0 +1,93 @@
+import hashlib
+import io
+import os
+import time
+
+import pytest
+
+import dam1021
+import dam1021_sim
+
+
+@pytest.fixture
+def sim():
+    with dam1021_sim.Simulator(baudrate=0) as sim:
+        yield sim
+
+
+@pytest.fixture
+def conn(sim):
+    conn = dam1021.Connection(sim.port,timeout=1,metrics=dam1021.Metrics())
+    yield conn
+    conn.close()
+
+
+def test_first_block_is_sent_at_once(sim,conn):
+    stamps = []
+    started = time.time()
+    conn.download(os.urandom(1024),check=False,progress=lambda sent,total,retransmits: stamps.append(time.time()))
+    #a receiver start request is not awaited twice
+    assert stamps[0] - started < 0.5
+    assert conn.download_stats.seconds < 0.5
+
+
+class Unseekable(object):
+    def __init__(self,data):
+        self.stream = io.BytesIO(data)
+
+    def read(self,size=-1):
+        return self.stream.read(size)
+
+
+def test_failed_transfer_is_retried(sim,conn):
+    data = os.urandom(4096)
+    conn.download_backoff = 0.01
+    sim.abort_downloads = 2
+    assert conn.download(data,check=False) == hashlib.sha1(data).hexdigest()
+    assert conn.download_stats.attempts == 3
+    assert conn.metrics.counters['retries'] == 2
+    assert sim.images == [hashlib.sha1(data).hexdigest()]
+
+
+def test_retries_run_out(sim,conn):
+    conn.download_backoff = 0.01
+    sim.abort_downloads = 3
+    with pytest.raises(dam1021.Dam1021Error) as e:
+        conn.download(os.urandom(4096),check=False,retries=1)
+    assert e.value.args[0] == 4
+    assert sim.abort_downloads == 1 and not sim.images
+    #a prompt was brought back, a session goes on
+    assert conn.umanager_opened
+    conn.set_flash_volume_level(-15)
+    assert sim.flash_volume == -15
+
+
+def test_unseekable_data_are_not_sent_again(sim,conn):
+    sim.abort_downloads = 1
+    with pytest.raises(dam1021.Dam1021Error) as e:
+        conn.download(Unseekable(os.urandom(4096)),check=False)
+    assert e.value.args[0] == 4
+    assert sim.commands.count('download') == 1
+
+
+def test_only_transfer_errors_are_retried(sim,conn,monkeypatch):
+    calls = []
+    def transfer(stream,block_size,progress):
+        calls.append(block_size)
+        raise dam1021.Dam1021Error(5,"uManager accepted data and not reprogrammed")
+    monkeypatch.setattr(conn,'_transfer',transfer)
+    with pytest.raises(dam1021.Dam1021Error) as e:
+        conn.download(os.urandom(4096),check=False)
+    assert e.value.args[0] == 5 and len(calls) == 1
+
+
+def test_1k_blocks_fall_back_to_128():
+    with dam1021_sim.Simulator(baudrate=0,onek=False) as sim:
+        conn = dam1021.Connection(sim.port,timeout=1)
+        try:
+            data = os.urandom(4096)
+            conn.download(data,check=False,block_size=1024)
+            assert conn.download_stats.blocks == 32 and conn.download_stats.attempts == 1
+            assert sim.images == [hashlib.sha1(data).hexdigest()]
+        finally:
+            conn.close()
@@ -0,0 +1,40 @@
+import io
+import os
+import threading
+
+import pytest
+
+import dam1021
+import dam1021_sim
+
+
+def fleet_threads():
+    return [ thread for thread in threading.enumerate() if thread.name == 'dam1021-fleet' ]
+
+
+def test_call_returns_after_workers_finish():
+    with dam1021_sim.Simulator() as first, dam1021_sim.Simulator() as second:
+        second.silent = True
+        with dam1021.Fleet([first.port,second.port],deadline=1,timeout=0.5) as fleet:
+            results = fleet.set_current_volume_level(-20)
+            assert not fleet_threads()
+            assert not fleet.busy
+        assert results[0].error is None and first.volume == -20
+        assert isinstance(results[1].error,dam1021.Dam1021Error)
+
+
+def test_download_gives_every_device_the_whole_image():
+    data = os.urandom(3000)
+    with dam1021_sim.Simulator(baudrate=0) as first, dam1021_sim.Simulator(baudrate=0) as second:
+        with dam1021.Fleet([first.port,second.port],timeout=1) as fleet:
+            results = fleet.download(io.BytesIO(data),check=False)
+        assert [ result.error for result in results ] == [None,None]
+        assert first.images == second.images == [results[0].value]
+
+
+def test_download_rejects_oversized_image(monkeypatch):
+    monkeypatch.setattr(dam1021,'MAX_IMAGE_SIZE',1024)
+    with dam1021.Fleet(['/dev/null']) as fleet:
+        with pytest.raises(dam1021.Dam1021Error) as e:
+            fleet.download(io.BytesIO(os.urandom(1025)))
+    assert e.value.args[0] == 27
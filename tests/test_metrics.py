@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+import dam1021
+import dam1021_sim
+
+
+def test_histogram_and_counters():
+    seen = []
+    metrics = dam1021.Metrics(hooks=[lambda *args: seen.append(args)])
+    metrics.observe('probe',0.003)
+    metrics.observe('probe',0.3,error=dam1021.Dam1021Error(31,"Device not responding"))
+    metrics.observe('probe',60.0)
+    metrics.count('retries')
+    metrics.count('bytes_read',10)
+    snapshot = metrics.snapshot()
+    probe = snapshot['operations']['probe']
+    assert (probe['count'],probe['errors']) == (3,1)
+    assert probe['sum'] == pytest.approx(60.303)
+    buckets = dict(probe['buckets'])
+    #cumulative counts, None is +Inf
+    assert (buckets[0.0025],buckets[0.005],buckets[0.5],buckets[10.0],buckets[None]) == (0,1,2,2,3)
+    assert snapshot['counters']['retries'] == 1 and snapshot['counters']['bytes_read'] == 10
+    assert snapshot['counters']['reconnects'] == 0
+    assert [ args[:3] for args in seen ] == [('latency','probe',0.003),('latency','probe',0.3),('latency','probe',60.0),('counter','retries',1),('counter','bytes_read',10)]
+
+
+def test_json_export():
+    metrics = dam1021.Metrics()
+    metrics.observe('download',1.5)
+    metrics.count('retransmits',2)
+    doc = json.loads(metrics.json())
+    assert doc['counters']['retransmits'] == 2
+    assert doc['operations']['download']['count'] == 1
+    assert doc['operations']['download']['buckets'][-1] == [None,1]
+
+
+def test_prometheus_export():
+    metrics = dam1021.Metrics()
+    metrics.observe('set_current_volume_level',0.004)
+    metrics.observe('set_current_volume_level',0.02,error=dam1021.Dam1021Error(7,"Failed to set current volume level"))
+    metrics.count('timeouts')
+    lines = metrics.prometheus().split('\n')
+    assert '# TYPE dam1021_timeouts_total counter' in lines
+    assert 'dam1021_timeouts_total 1' in lines
+    assert '# TYPE dam1021_operation_seconds histogram' in lines
+    assert 'dam1021_operation_seconds_bucket{operation="set_current_volume_level",le="0.005"} 1' in lines
+    assert 'dam1021_operation_seconds_bucket{operation="set_current_volume_level",le="+Inf"} 2' in lines
+    assert 'dam1021_operation_seconds_count{operation="set_current_volume_level"} 2' in lines
+    assert 'dam1021_operation_errors_total{operation="set_current_volume_level"} 1' in lines
+    assert metrics.prometheus(prefix='dac').startswith('# TYPE dac_')
+
+
+def test_connection_counts_traffic():
+    metrics = dam1021.Metrics()
+    with dam1021_sim.Simulator(baudrate=0) as sim:
+        conn = dam1021.Connection(sim.port,timeout=0.5,metrics=metrics)
+        try:
+            conn.set_current_volume_level(-30)
+            conn.open_umanager()
+            conn.close_umanager()
+        finally:
+            conn.close()
+    counters = metrics.counters
+    assert counters['bytes_written'] > 0 and counters['bytes_read'] > 0
+    assert counters['sessions_opened'] == counters['sessions_closed'] == 1
+    assert metrics.operations['set_current_volume_level']['count'] == 1
@@ -0,0 +1,84 @@
+import pytest
+
+import dam1021
+import dam1021_sim
+
+
+def match(echoes,*chunks):
+    matcher = dam1021._EchoMatcher(echoes)
+    rv = False
+    buf = b''
+    for chunk in chunks:
+        buf += chunk
+        rv = matcher(buf)
+    return rv, matcher.matched
+
+
+def test_echo_is_a_whole_line():
+    assert match(['V-2'],b'V-20\r\n') == (False,0)
+    assert match(['V-20'],b'V-2\r\n') == (False,0)
+    assert match(['V-2'],b'V-20\r\nV-2\r\n') == (True,1)
+    #an echo is not complete until its line ends
+    assert match(['V-2'],b'V-2') == (False,0)
+    assert match(['V-2'],b'V-2',b'\r\n') == (True,1)
+
+
+def test_echoes_match_in_order():
+    assert match(['I1','V-20'],b'I1\r\n',b'V-20\r\n') == (True,2)
+    #a missing echo ends what is confirmed, the last one ends a wait
+    assert match(['I1','F2','V-20'],b'I1\r\nV-20\r\n') == (True,1)
+    #an echo found before an earlier command's echo doesn't count
+    assert match(['I1','V-20'],b'V-20\r\nI1\r\n') == (False,1)
+
+
+def test_ambiguous_last_echo_needs_every_echo():
+    assert match(['V-20','I1','V-20'],b'V-20\r\n') == (False,1)
+    assert match(['V-20','I1','V-20'],b'V-20\r\nI1\r\nV-20\r\n') == (True,3)
+
+
+@pytest.fixture
+def sim():
+    with dam1021_sim.Simulator(baudrate=0) as sim:
+        yield sim
+
+
+@pytest.fixture
+def conn(sim):
+    conn = dam1021.Connection(sim.port,timeout=0.5)
+    yield conn
+    conn.close()
+
+
+def test_pipeline_applies_settings(sim,conn):
+    results = conn.pipeline([('input',1),('fset','mixed'),('volume',-20)])
+    assert [ result.error for result in results ] == [None,None,None]
+    assert (sim.input_src,sim.volume) == (1,-20)
+    assert sim.fset == dam1021.FSET_EXT_STR_TO_INT_D['mixed']
+
+
+def test_pipeline_retries_from_first_missing_echo(sim,conn):
+    handle = sim._direct_command
+    dropped = []
+    def drop_once(line):
+        if line == 'I1' and not dropped:
+            dropped.append(line)
+            return
+        handle(line)
+    sim._direct_command = drop_once
+    results = conn.pipeline([('volume',-40),('input',1),('volume',-30),('fset','mixed'),('volume',-25)])
+    assert [ result.error for result in results ] == [None]*5
+    #a retry sends a repeated setting with its last value only
+    fset = 'F{:d}'.format(dam1021.FSET_EXT_STR_TO_INT_D['mixed'])
+    assert sim.commands[-3:] == ['I1',fset,'V-25']
+    assert (sim.volume,sim.input_src) == (-25,1)
+
+
+def test_pipeline_reports_commands_never_echoed(sim,conn):
+    handle = sim._direct_command
+    sim._direct_command = lambda line: None if line == 'I2' else handle(line)
+    results = conn.pipeline([('volume',-30),('input',2),('volume',-28)],tries=2)
+    assert results[0].error is None
+    assert results[1].error.args[0] == 10
+    #an echo after a missing one doesn't confirm a command
+    assert results[2].error.args[0] == 7
+    assert sim.commands.count('I2') == 2
@@ -0,0 +1,161 @@
+import hashlib
+import io
+import os
+import threading
+import time
+
+import pytest
+import serial
+
+import dam1021
+import dam1021_sim
+
+
+DATA = os.urandom(4*1024)
+SHA1 = hashlib.sha1(DATA).hexdigest()
+
+
+@pytest.fixture
+def sim(tmpdir):
+    with dam1021_sim.Simulator(link=str(tmpdir.join('tty'))) as sim:
+        yield sim
+
+
+def connect(sim,**kwargs):
+    return dam1021.Connection(sim.port,timeout=1,metrics=dam1021.Metrics(),**kwargs)
+
+
+def outage(sim,after=1024,duration=0.3):
+    """Returns a progress callback unplugging a device once after bytes are sent and plugging it back later."""
+
+    fired = []
+    def progress(sent,total,retransmits):
+        if sent >= after and not fired:
+            fired.append(True)
+            sim.unplug()
+            threading.Timer(duration,sim.replug).start()
+    return progress
+
+
+def test_silent_device_fails_fast(sim):
+    conn = connect(sim)
+    try:
+        sim.silent = True
+        with pytest.raises(dam1021.Dam1021Error):
+            conn.set_current_volume_level(-30)
+        start = time.time()
+        with pytest.raises(dam1021.Dam1021Error) as info:
+            conn.set_current_volume_level(-31)
+        assert info.value.args[0] == 31
+        assert time.time() - start < conn.timeout
+    finally:
+        conn.close()
+
+
+def test_lost_port_is_a_link_error(sim):
+    conn = connect(sim)
+    try:
+        sim.unplug()
+        with pytest.raises(dam1021._LinkError):
+            conn.set_current_volume_level(-30)
+    finally:
+        conn.close()
+
+
+def test_reconnect_after_replug(sim):
+    conn = connect(sim,auto_reconnect=True)
+    try:
+        conn.set_current_volume_level(-30)
+        sim.unplug()
+        threading.Timer(0.3,sim.replug).start()
+        conn.set_current_volume_level(-25)
+        assert sim.volume == -25
+        assert conn.metrics.counters['reconnects'] == 1
+        assert conn.recovery_time is not None
+    finally:
+        conn.close()
+
+
+def test_download_resumes_from_start_after_reconnect(sim):
+    conn = connect(sim,auto_reconnect=True)
+    try:
+        assert conn.download(io.BytesIO(DATA),check=False,progress=outage(sim)) == SHA1
+        assert sim.images[-1] == SHA1
+        assert conn.metrics.counters['reconnects'] == 1
+    finally:
+        conn.close()
+
+
+def test_update_is_not_repeated_after_reconnect(sim):
+    conn = connect(sim,auto_reconnect=True)
+    try:
+        with pytest.raises(dam1021._LinkError):
+            conn.download(io.BytesIO(DATA),True,check=False,progress=outage(sim))
+        assert sim.images == []
+        #a link is restored for the next command
+        conn.set_current_volume_level(-25)
+        assert sim.volume == -25
+    finally:
+        conn.close()
+
+
+def test_stream_error_is_not_a_link_error(sim):
+    class Failing(io.BytesIO):
+        def read(self,size=-1):
+            if self.tell() > 1024:
+                raise IOError("disk failed")
+            return io.BytesIO.read(self,size)
+
+    conn = connect(sim,auto_reconnect=True)
+    try:
+        with pytest.raises(IOError) as info:
+            conn.download(Failing(DATA),check=False)
+        assert not isinstance(info.value,dam1021._LinkError)
+        assert conn.metrics.counters.get('reconnects',0) == 0
+    finally:
+        conn.close()
+
+
+def test_update_waits_for_a_slow_boot():
+    with dam1021_sim.Simulator(boot_time=1.5) as sim:
+        conn = connect(sim)
+        try:
+            conn.download(DATA,um_update=True,check=False)
+            assert conn.failures == 0 and conn.umanager_opened is False
+            conn.set_current_volume_level(-25)
+            assert sim.volume == -25
+        finally:
+            conn.close()
+
+
+def test_update_gives_up_on_a_device_that_never_boots():
+    with dam1021_sim.Simulator(boot_time=60) as sim:
+        conn = connect(sim)
+        conn.boot_timeout = 0.5
+        try:
+            start = time.time()
+            conn.download(DATA,um_update=True,check=False)
+            assert time.time() - start < 5
+            assert conn.failures
+            with pytest.raises(dam1021.Dam1021Error) as e:
+                conn.set_current_volume_level(-25)
+            assert e.value.args[0] == 31
+        finally:
+            conn.close()
+
+
+def test_batch_stops_on_a_lost_link(sim):
+    conn = connect(sim)
+    try:
+        with conn.session() as batch:
+            batch.set_flash_volume_level(-10)
+            batch.download(DATA,check=False,progress=lambda *args: sim.unplug())
+            batch.list_all_filters()
+        flash, download, listing = batch.results
+        assert flash.error is None and sim.flash_volume == -10
+        assert isinstance(download.error,serial.SerialException)
+        assert listing.error.args[0] == 19 and listing.value is None
+        assert conn.umanager_opened is None
+    finally:
+        sim.replug()
+        conn.close()
@@ -0,0 +1,36 @@
+import pytest
+
+import dam1021
+import dam1021_sim
+
+
+@pytest.fixture
+def conn():
+    with dam1021_sim.Simulator(baudrate=0) as sim:
+        conn = dam1021.Connection(sim.port,timeout=0.5)
+        conn.sim = sim
+        yield conn
+        conn.close()
+
+
+def test_latest_value_is_applied(conn):
+    sched = dam1021.Scheduler(conn)
+    for level in range(-40,-20):
+        sched.submit('volume',level)
+    sched.submit('input',2)
+    assert sched.flush(5)
+    assert sched.applied == dict(volume=-21,input=2)
+    assert (conn.sim.volume,conn.sim.input_src) == (-21,2)
+    sched.close()
+
+
+def test_close_applies_pending_settings_and_refuses_new_ones(conn):
+    sched = dam1021.Scheduler(conn)
+    sched.submit('volume',-35)
+    sched.close(5)
+    assert conn.sim.volume == -35
+    assert not sched._thread.is_alive()
+    with pytest.raises(dam1021.Dam1021Error) as e:
+        sched.submit('volume',-30)
+    assert e.value.args[0] == 21
+    assert not sched.pending and conn.sim.volume == -35
@@ -0,0 +1,86 @@
+import hashlib
+import os
+import socket
+
+import pytest
+
+import dam1021
+import dam1021_sim
+
+
+@pytest.fixture
+def sim():
+    with dam1021_sim.Simulator() as sim:
+        yield sim
+
+
+def test_open_transport_picks_class_by_scheme(sim):
+    url = sim.listen()
+    network = dam1021.open_transport(url)
+    try:
+        assert isinstance(network,dam1021.NetworkTransport)
+        assert network.ser._socket.getsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY)
+    finally:
+        network.close()
+    local = dam1021.open_transport(sim.tty)
+    try:
+        assert type(local) is dam1021.Transport
+    finally:
+        local.close()
+
+
+def test_commands_over_socket(sim):
+    conn = dam1021.Connection(sim.listen(),timeout=1)
+    try:
+        conn.set_current_volume_level(-30)
+        conn.set_flash_volume_level(-12)
+        data = os.urandom(2048)
+        assert conn.download(data,check=False) == hashlib.sha1(data).hexdigest()
+        assert conn.filter_catalogue(refresh=True).banks
+    finally:
+        conn.close()
+    assert (sim.volume,sim.flash_volume) == (-30,-12)
+    assert sim.images == [hashlib.sha1(data).hexdigest()]
+
+
+def test_pool_reuses_transport_and_session(sim):
+    url = sim.listen()
+    pool = dam1021.TransportPool()
+    try:
+        conn = dam1021.Connection(url,pool=pool)
+        transport = conn.transport
+        conn.set_flash_volume_level(-12)
+        conn.close()
+        assert pool.idle == {url:transport}
+
+        conn = dam1021.Connection(url,pool=pool)
+        assert conn.transport is transport
+        #what a previous connection learnt about a device carries over
+        assert conn.umanager_opened is False
+        assert conn.latency is not None and conn.latency == transport.session['latency']
+        conn.set_current_volume_level(-30)
+        conn.close()
+    finally:
+        pool.close()
+    assert pool.idle == {}
+
+
+def test_pool_waits_for_transport_in_use(sim):
+    pool = dam1021.TransportPool(wait=0.1)
+    try:
+        conn = dam1021.Connection(sim.port,pool=pool)
+        with pytest.raises(dam1021.Dam1021Error) as info:
+            dam1021.Connection(sim.port,pool=pool)
+        assert info.value.args[0] == 25
+        conn.close()
+        dam1021.Connection(sim.port,pool=pool).close()
+    finally:
+        pool.close()
+
+
+def test_pool_discards_failed_transport(sim):
+    pool = dam1021.TransportPool()
+    transport = pool.acquire(sim.port)
+    pool.release(transport,discard=True)
+    assert pool.idle == {} and pool.busy == set()
+    assert not transport.ser.is_open
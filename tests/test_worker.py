@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+
+import pytest
+
+import dam1021
+import dam1021_sim
+
+
+@pytest.fixture
+def worker():
+    with dam1021_sim.Simulator(delay=0.01) as sim:
+        conn = dam1021.Connection(sim.port,timeout=1)
+        worker = dam1021.Worker(conn,idle_timeout=0.2)
+        worker.sim = sim
+        yield worker
+        worker.close()
+        conn.close()
+
+
+def test_direct_commands_go_ahead_of_queued_ones(worker):
+    order = []
+    #holds a worker until a queue is filled
+    gate = threading.Event()
+    blocker = worker.submit('list_all_filters',refresh=True)
+    blocker.add_done_callback(lambda future: gate.wait())
+    worker.set_flash_volume_level(-12).add_done_callback(lambda future: order.append('flash'))
+    listing = worker.submit('list_all_filters',refresh=True)
+    listing.add_done_callback(lambda future: order.append('listing'))
+    volume = worker.set_current_volume_level(-30)
+    volume.add_done_callback(lambda future: order.append('volume'))
+    gate.set()
+    listing.result(5)
+    volume.result(5)
+    assert order == ['volume','flash','listing']
+    assert worker.sim.volume == -30
+
+
+def test_equal_priorities_run_in_submission_order(worker):
+    data = os.urandom(1024)
+    download = worker.download(data,check=False)
+    listing = worker.list_current_filter_set(refresh=True)
+    download.result(10)
+    listing.result(10)
+    assert download.finished <= listing.started
+
+
+def test_deadline_expires_in_queue(worker):
+    gate = threading.Event()
+    blocker = worker.submit('list_all_filters',refresh=True)
+    blocker.add_done_callback(lambda future: gate.wait())
+    late = worker.set_flash_volume_level(-12,deadline=0.05)
+    with pytest.raises(dam1021.Dam1021Error) as info:
+        late.result()
+    assert info.value.args[0] == 30
+    #a command queued after it runs after it is dropped
+    after = worker.list_current_filter_set(refresh=True)
+    gate.set()
+    after.result(5)
+    assert late.done() and late.started is None
+    assert 'timed out in a queue' in str(late.exception())
+    assert worker.sim.flash_volume != -12
+
+
+def test_cancel_and_callbacks(worker):
+    gate = threading.Event()
+    blocker = worker.submit('list_all_filters',refresh=True)
+    blocker.add_done_callback(lambda future: gate.wait())
+    queued = worker.set_flash_volume_level(-12)
+    assert queued.cancel()
+    seen = []
+    queued.add_done_callback(seen.append)
+    assert seen == [queued]
+    gate.set()
+    blocker.result(5)
+    assert not blocker.cancel()
+    with pytest.raises(dam1021.Dam1021Error) as info:
+        queued.result()
+    assert info.value.args[0] == 19
+    assert queued.started is None
+
+
+def test_unplug_during_idle_close(worker):
+    worker.set_flash_volume_level(-12).result(5)
+    assert worker.conn.umanager_opened
+    worker.sim.unplug()
+    #an idle session is closed over a dead link
+    time.sleep(worker.idle_timeout+0.3)
+    assert worker._thread.is_alive()
+    assert worker.conn.umanager_opened is None
+    future = worker.set_current_volume_level(-30)
+    assert isinstance(future.exception(5),dam1021.Dam1021Error)
+
+
+def test_stopped_thread_fails_commands(worker):
+    gate = threading.Event()
+    blocker = worker.submit('list_all_filters',refresh=True)
+    blocker.add_done_callback(lambda future: gate.wait())
+    queued = worker.set_flash_volume_level(-12)
+    def broken(settled=False):
+        raise RuntimeError("broken")
+    worker._next = broken
+    gate.set()
+    with pytest.raises(dam1021.Dam1021Error) as info:
+        queued.result(5)
+    assert info.value.args[0] == 21
+    with pytest.raises(dam1021.Dam1021Error):
+        worker.set_current_volume_level(-30)